@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from iiif_pipeline.derivatives import (calculate_layers,  # noqa: E402
+                                       create_access_pdf, create_jp2)
+from iiif_pipeline.helpers import get_page_number, matching_files  # noqa: E402
+from iiif_pipeline.manifests import ManifestMaker  # noqa: E402
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+
+def generate_tiffs(directory, pages, width, height, bits=8, samples=3, seed=0):
+    """Writes a set of synthetic page images.
+
+    Each page is a gradient with a block of dark "text" and some noise, so that
+    it compresses more like a scanned page than pure noise or a flat image.
+
+    Args:
+        directory (str): Directory in which to write the TIFF files.
+        pages (int): Number of pages.
+        width (int): Pixel width of each page.
+        height (int): Pixel height of each page.
+        bits (int): Bits per sample, 8 or 16. 16-bit pages have one sample.
+        samples (int): Samples per pixel for 8-bit pages, 1 or 3.
+        seed (int): Seed for the noise, so that runs are repeatable.
+    Returns:
+        files (list): Paths of the TIFF files.
+    """
+    random = np.random.RandomState(seed)
+    maximum = 65535 if bits == 16 else 255
+    files = []
+    for page in range(pages):
+        rows = np.linspace(0.75, 0.95, height, dtype=np.float32)[:, None]
+        pixels = np.repeat(rows, width, axis=1)
+        pixels[height // 8:height * 7 // 8:8, width // 8:width * 7 // 8] = 0.1
+        pixels += random.normal(0, 0.02, (height, width)).astype(np.float32)
+        pixels = (np.clip(pixels, 0, 1) * maximum).astype(np.uint16 if bits == 16 else np.uint8)
+        image = Image.fromarray(np.dstack([pixels] * 3) if (bits == 8 and samples == 3) else pixels)
+        path = os.path.join(directory, "benchmark_{:03d}.tif".format(page + 1))
+        image.save(path)
+        files.append(path)
+    return files
+
+
+def measure(func, repeat=1):
+    """Times a function, keeping the fastest of several runs.
+
+    Args:
+        func (callable): Function to time.
+        repeat (int): Number of runs.
+    Returns:
+        seconds (float): Elapsed time of the fastest run.
+    """
+    best = None
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_benchmarks(work_dir, pages=10, width=2000, height=3000, bits=8, samples=3,
+                   canvases=5000, files=20000, workers=4, repeat=3, only=None):
+    """Measures the throughput of derivative, manifest and file scanning functions.
+
+    `create_jp2_grayscale` encodes the same pages as `create_jp2` with the
+    grayscale profile, which is used for RGB pages without color, so that its
+    cost can be compared with the default profile. `calculate_layers` reads
+    the header of each synthetic TIFF in turn, a thousand times in all.
+
+    Args:
+        work_dir (str): Directory in which to create fixtures and derivatives.
+        pages (int): Number of synthetic pages to encode and assemble into a PDF.
+        width (int): Pixel width of each page.
+        height (int): Pixel height of each page.
+        bits (int): Bits per sample of each page.
+        samples (int): Samples per pixel of each 8-bit page.
+        canvases (int): Number of canvases in the benchmark manifest.
+        files (int): Number of files in the directory scanned by `matching_files`.
+        workers (int): Number of pages encoded or prepared concurrently.
+        repeat (int): Number of times each benchmark is run; the fastest is kept.
+        only (list): Names of the benchmarks to run. All are run if this is not set.
+    Returns:
+        results (dict): Number of items, seconds and items per second, keyed by benchmark.
+    """
+    tiff_dir = os.path.join(work_dir, "tif")
+    jp2_dir = os.path.join(work_dir, "jp2")
+    for directory in [tiff_dir, jp2_dir]:
+        os.makedirs(directory)
+    tiffs = generate_tiffs(tiff_dir, pages, width, height, bits, samples)
+    jp2s = [os.path.join(jp2_dir, "benchmark_{:03d}.jp2".format(page + 1)) for page in range(pages)]
+    layer_files = [tiffs[number % pages] for number in range(1000)]
+    scan_dir = os.path.join(work_dir, "scan")
+    os.makedirs(scan_dir)
+    for number in range(files):
+        open(os.path.join(scan_dir, "{}_{:05d}.tif".format("abcdefghij"[number % 10], number)), "w").close()
+    manifest_pages = [{"derivative": "benchmark_{:05d}.jp2".format(number), "width": width, "height": height}
+                      for number in range(canvases)]
+    manifest_dir = os.path.join(work_dir, "manifests")
+    os.makedirs(manifest_dir)
+    ocr = shutil.which("tesseract") is not None
+    benchmarks = [
+        ("create_jp2", pages, lambda: create_jp2(
+            tiffs, "benchmark", jp2_dir, replace=True, workers=workers)),
+        ("create_jp2_grayscale", pages, lambda: create_jp2(
+            tiffs, "benchmark", jp2_dir, replace=True, workers=workers,
+            analyses={get_page_number(tiff): {"grayscale": True} for tiff in tiffs})),
+        ("calculate_layers", len(layer_files), lambda: [
+            calculate_layers(tiff) for tiff in layer_files]),
+        ("create_manifest", canvases, lambda: ManifestMaker("http://example.com", manifest_dir).create_manifest(
+            [page["derivative"] for page in manifest_pages], jp2_dir, "benchmark",
+            {"title": "Benchmark", "dates": "1945-1950"}, replace=True, pages=manifest_pages)),
+        ("create_access_pdf", pages, lambda: create_access_pdf(
+            jp2s, "benchmark", work_dir, replace=True, ocr=ocr, workers=workers)),
+        ("matching_files", files, lambda: matching_files(scan_dir, prefix="a", suffix=".tif", skip=True))]
+    results = {}
+    for name, count, func in benchmarks:
+        if only and name not in only:
+            continue
+        if name == "create_access_pdf" and not os.path.isfile(jp2s[-1]):
+            create_jp2(tiffs, "benchmark", jp2_dir, replace=True, workers=workers)
+        seconds = measure(func, repeat)
+        results[name] = {"count": count, "seconds": seconds, "per_second": count / seconds if seconds else 0}
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Finds benchmarks which are slower than their baseline.
+
+    Args:
+        results (dict): Results of `run_benchmarks`.
+        baseline (dict): Results saved from an earlier run.
+        threshold (float): Fraction by which throughput may fall before it
+            counts as a regression.
+    Returns:
+        regressions (list): Name, baseline and current throughput, and change,
+            of each benchmark which regressed.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]["per_second"]
+        change = (result["per_second"] - expected) / expected if expected else 0
+        if change < -threshold:
+            regressions.append((name, expected, result["per_second"], change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures the throughput of derivative and manifest creation with synthetic pages, "
+                    "and fails if it is slower than a saved baseline.")
+    parser.add_argument("--pages", type=int, default=10, help="Number of synthetic pages.")
+    parser.add_argument("--width", type=int, default=2000, help="Pixel width of each page.")
+    parser.add_argument("--height", type=int, default=3000, help="Pixel height of each page.")
+    parser.add_argument("--bits", type=int, choices=[8, 16], default=8,
+                        help="Bits per sample. 16-bit pages are grayscale.")
+    parser.add_argument("--samples", type=int, choices=[1, 3], default=3,
+                        help="Samples per pixel of 8-bit pages.")
+    parser.add_argument("--canvases", type=int, default=5000, help="Number of canvases in the manifest.")
+    parser.add_argument("--files", type=int, default=20000, help="Number of files in the scanned directory.")
+    parser.add_argument("--workers", type=int, default=4, help="Number of pages processed concurrently.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each benchmark.")
+    parser.add_argument("--only", help="Comma-separated names of the benchmarks to run.")
+    parser.add_argument("--baseline", help="Path of the baseline JSON file. Defaults to one named for this host.")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Fraction by which throughput may fall below the baseline before the run fails.")
+    parser.add_argument("--save_baseline", action="store_true", help="Save the results as the new baseline.")
+    args = parser.parse_args()
+    parameters = {key: getattr(args, key) for key in ["pages", "width", "height", "bits", "samples",
+                                                      "canvases", "files", "workers"]}
+    baseline_path = args.baseline or os.path.join(BASELINE_DIR, "{}.json".format(socket.gethostname()))
+    work_dir = tempfile.mkdtemp()
+    try:
+        results = run_benchmarks(work_dir, repeat=args.repeat,
+                                 only=args.only.split(",") if args.only else None, **parameters)
+    finally:
+        shutil.rmtree(work_dir)
+    print("benchmark\titems\tseconds\titems/s")
+    for name, result in results.items():
+        print("{}\t{}\t{:.3f}\t{:.1f}".format(name, result["count"], result["seconds"], result["per_second"]))
+    if args.save_baseline:
+        if not os.path.isdir(os.path.dirname(baseline_path)):
+            os.makedirs(os.path.dirname(baseline_path))
+        with open(baseline_path, "w") as f:
+            json.dump({"parameters": parameters, "results": results}, f, indent=2, sort_keys=True)
+        print("Baseline saved to {}".format(baseline_path))
+        return
+    if not os.path.isfile(baseline_path):
+        print("No baseline at {}; run with --save_baseline to create one".format(baseline_path))
+        return
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline["parameters"] != parameters:
+        sys.exit("Baseline {} was recorded with different parameters: {}".format(
+            baseline_path, baseline["parameters"]))
+    regressions = compare(results, baseline["results"], args.threshold)
+    for name, expected, actual, change in regressions:
+        print("Regression in {}: {:.1f} items/s, baseline {:.1f} items/s ({:.0%})".format(
+            name, actual, expected, change))
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from configparser import ConfigParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import boto3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from iiif_pipeline.instrumentation import add_sink, remove_sink  # noqa: E402
+from iiif_pipeline.pipeline import IIIFPipeline  # noqa: E402
+from run_benchmarks import generate_tiffs  # noqa: E402
+
+REPOSITORY = "101"
+BUCKET = "iiif-scale-test"
+
+
+class ArchivesSpaceStub(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.05, jitter=0.05, seed=0):
+        """A local stand-in for the ArchivesSpace API.
+
+        Answers logins, version requests, `find_by_id` lookups and archival
+        object requests for any ref_id. Each response is delayed by the
+        latency plus a share of the jitter which depends only on the seed and
+        the request path, so that repeated runs see the same delays.
+
+        Args:
+            latency (float): Minimum delay of each response in seconds.
+            jitter (float): Maximum additional delay of each response in seconds.
+            seed (int): Seed for the additional delays.
+        """
+        super().__init__(("127.0.0.1", 0), _ArchivesSpaceHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.seed = seed
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def delay(self, path):
+        """Gets the delay of the response to a request."""
+        return self.latency + random.Random("{}{}".format(self.seed, path)).random() * self.jitter
+
+
+class _ArchivesSpaceHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self._respond({"session": "scale-test"})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/version":
+            self._respond("ArchivesSpace (v2.8.0)")
+        elif url.path.endswith("/find_by_id/archival_objects"):
+            ref_id = parse_qs(url.query)["ref_id[]"][0]
+            self._respond({"archival_objects": [
+                {"ref": "/repositories/{}/archival_objects/{}".format(REPOSITORY, ref_id)}]})
+        elif "/archival_objects/" in url.path:
+            ref_id = url.path.split("/")[-1]
+            self._respond({"title": "scale test object {}".format(ref_id), "uri": url.path,
+                           "dates": [{"expression": "1945-1950"}]})
+        else:
+            self.send_error(404)
+
+    def _respond(self, data):
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.delay(self.path))
+        body = (data if isinstance(data, str) else json.dumps(data)).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LatencySink:
+    def __init__(self):
+        """Collects the duration of every object, stage, lookup, page and upload."""
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.failed = 0
+
+    def start(self, span):
+        pass
+
+    def finish(self, span):
+        name = span.name
+        if span.labels.get("stage"):
+            name = "stage {}".format(span.labels["stage"])
+        elif span.labels.get("command"):
+            name = "command {}".format(span.labels["command"])
+        with self.lock:
+            self.durations.setdefault(name, []).append(span.wall_seconds)
+            if span.name == "object" and span.failed:
+                self.failed += 1
+
+    def percentiles(self):
+        """Gets the 50th, 95th and 99th percentile and maximum duration of each kind of span."""
+        with self.lock:
+            return {name: {"count": len(durations),
+                           "p50": _percentile(durations, 50),
+                           "p95": _percentile(durations, 95),
+                           "p99": _percentile(durations, 99),
+                           "max": max(durations)}
+                    for name, durations in sorted(self.durations.items())}
+
+
+def generate_objects(source_dir, objects, pages, width, height, seed=0):
+    """Creates refid directories of synthetic pages.
+
+    The number of pages of each object is chosen at random between one and
+    twice the average, from the seed. A small pool of distinct page images is
+    generated once and linked into every object.
+
+    Args:
+        source_dir (str): Directory in which to create the refid directories.
+        objects (int): Number of objects.
+        pages (int): Average number of pages per object.
+        width (int): Pixel width of each page.
+        height (int): Pixel height of each page.
+        seed (int): Seed for the number of pages and their content.
+    Returns:
+        total_pages (int): Number of pages created.
+    """
+    rng = random.Random(seed)
+    pool_dir = os.path.join(os.path.dirname(source_dir), "pool")
+    os.makedirs(pool_dir)
+    pool = generate_tiffs(pool_dir, 8, width, height, seed=seed)
+    total_pages = 0
+    for number in range(objects):
+        ref_id = "scale{:06d}".format(number)
+        master_dir = os.path.join(source_dir, ref_id, "master")
+        os.makedirs(master_dir)
+        for page in range(rng.randint(1, max(1, 2 * pages - 1))):
+            source = rng.choice(pool)
+            destination = os.path.join(master_dir, "{}_{:03d}.tif".format(ref_id, page + 1))
+            try:
+                os.link(source, destination)
+            except OSError:
+                shutil.copyfile(source, destination)
+            total_pages += 1
+    return total_pages
+
+
+def run_scale_test(work_dir, objects=1000, pages=5, width=1000, height=1500, seed=0,
+                   latency=0.05, jitter=0.05, settings=None):
+    """Runs the whole pipeline against local stand-ins for ArchivesSpace and S3.
+
+    Args:
+        work_dir (str): Directory in which to create source files and derivatives.
+        objects (int): Number of objects.
+        pages (int): Average number of pages per object.
+        width (int): Pixel width of each page.
+        height (int): Pixel height of each page.
+        seed (int): Seed for the objects and the ArchivesSpace delays.
+        latency (float): Minimum delay of each ArchivesSpace response in seconds.
+        jitter (float): Maximum additional delay of each ArchivesSpace response.
+        settings (dict): Configuration which overrides the defaults, keyed by
+            section and then option.
+    Returns:
+        report (dict): Throughput, durations and resource use of the run.
+    """
+    from moto.server import ThreadedMotoServer
+
+    source_dir = os.path.join(work_dir, "source")
+    target_dir = os.path.join(work_dir, "target")
+    os.makedirs(source_dir)
+    total_pages = generate_objects(source_dir, objects, pages, width, height, seed)
+    archivesspace = ArchivesSpaceStub(latency, jitter, seed)
+    threading.Thread(target=archivesspace.serve_forever, daemon=True).start()
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    s3_port = _free_port()
+    s3 = ThreadedMotoServer(ip_address="127.0.0.1", port=s3_port, verbose=False)
+    s3.start()
+    s3_url = "http://127.0.0.1:{}".format(s3_port)
+    try:
+        boto3.client("s3", region_name="us-east-1", endpoint_url=s3_url,
+                     aws_access_key_id="scale", aws_secret_access_key="scale").create_bucket(Bucket=BUCKET)
+        config = ConfigParser()
+        config.read_dict({
+            "ArchivesSpace": {"baseurl": archivesspace.url, "username": "admin", "password": "admin",
+                              "repository": REPOSITORY, "prefetch_workers": "8"},
+            "S3": {"bucketname": BUCKET, "aws_access_key_id": "scale", "aws_secret_access_key": "scale",
+                   "region_name": "us-east-1", "endpoint_url": s3_url, "upload_workers": "8"},
+            "ImageServer": {"baseurl": "http://example.com"},
+            "Pipeline": {"journal": os.path.join(work_dir, "journal.db"), "metadata_workers": "2",
+                         "image_workers": "1", "pdf_workers": "1", "upload_workers": "1", "queue_size": "2"},
+            "Derivatives": {"jp2_workers": "4", "ocr_workers": "4", "analysis_workers": "4"}})
+        config.read_dict(settings or {})
+        pipeline = IIIFPipeline()
+        pipeline.config = config
+        latencies = LatencySink()
+        add_sink(latencies)
+        start = time.time()
+        try:
+            pipeline.run(source_dir, target_dir, False, False, False)
+        finally:
+            remove_sink(latencies)
+        elapsed = time.time() - start
+    finally:
+        s3.stop()
+        archivesspace.shutdown()
+        archivesspace.server_close()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "objects": objects,
+        "pages": total_pages,
+        "failed": latencies.failed,
+        "elapsed_seconds": elapsed,
+        "objects_per_hour": objects / elapsed * 3600,
+        "pages_per_hour": total_pages / elapsed * 3600,
+        "archivesspace_requests": archivesspace.requests,
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+        "peak_child_rss_mb": children.ru_maxrss / 1024,
+        "cpu_seconds": usage.ru_utime + usage.ru_stime,
+        "child_cpu_seconds": children.ru_utime + children.ru_stime,
+        "durations": latencies.percentiles(),
+        "parameters": {"objects": objects, "pages": pages, "width": width, "height": height, "seed": seed,
+                       "latency": latency, "jitter": jitter},
+        "settings": {section: dict(config[section]) for section in config.sections()}}
+
+
+def _percentile(values, percent):
+    """Gets a percentile of a list of values, by the nearest rank."""
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(percent / 100 * len(ordered))) - 1))]
+
+
+def _free_port():
+    """Finds a free local TCP port."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs the whole pipeline on synthetic objects against local stand-ins for "
+                    "ArchivesSpace and S3, and reports throughput, tail latencies and resource use.")
+    parser.add_argument("--objects", type=int, default=1000, help="Number of objects.")
+    parser.add_argument("--pages", type=int, default=5, help="Average number of pages per object.")
+    parser.add_argument("--width", type=int, default=1000, help="Pixel width of each page.")
+    parser.add_argument("--height", type=int, default=1500, help="Pixel height of each page.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the objects and ArchivesSpace delays.")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Minimum delay of each ArchivesSpace response in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.05,
+                        help="Maximum additional delay of each ArchivesSpace response in seconds.")
+    parser.add_argument("--set", action="append", default=[], metavar="SECTION.OPTION=VALUE",
+                        help="Override a configuration option, such as Pipeline.image_workers=2.")
+    parser.add_argument("--output", help="Path at which to write the report as JSON.")
+    args = parser.parse_args()
+    settings = {}
+    for setting in args.set:
+        option, value = setting.split("=", 1)
+        section, option = option.split(".", 1)
+        settings.setdefault(section, {})[option] = value
+    work_dir = tempfile.mkdtemp()
+    try:
+        report = run_scale_test(work_dir, args.objects, args.pages, args.width, args.height, args.seed,
+                                args.latency, args.jitter, settings)
+    finally:
+        shutil.rmtree(work_dir)
+    print("{} objects ({} pages, {} failed) in {:.1f}s: {:.0f} objects/hour, {:.0f} pages/hour".format(
+        report["objects"], report["pages"], report["failed"], report["elapsed_seconds"],
+        report["objects_per_hour"], report["pages_per_hour"]))
+    print("Peak RSS {:.0f} MB (commands {:.0f} MB), CPU {:.0f}s (commands {:.0f}s)".format(
+        report["peak_rss_mb"], report["peak_child_rss_mb"], report["cpu_seconds"], report["child_cpu_seconds"]))
+    print("span\tcount\tp50 (s)\tp95 (s)\tp99 (s)\tmax (s)")
+    for name, durations in report["durations"].items():
+        print("{}\t{}\t{:.3f}\t{:.3f}\t{:.3f}\t{:.3f}".format(
+            name, durations["count"], durations["p50"], durations["p95"], durations["p99"], durations["max"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,9 +8,11 @@ def main():
         description="Generates JPEG2000 images from TIF files based on input and output directories.")
     parser.add_argument(
         "source_directory",
+        nargs="?",
         help="A directory containing subdirectories (named using ref ids) for archival objects.")
     parser.add_argument(
         "target_directory",
+        nargs="?",
         help="A directory in which to create generated image derivatives and manifests.")
     parser.add_argument(
         "--skip",
@@ -24,13 +26,71 @@ def main():
         "--cleanup_source",
         action="store_true",
         help="Delete source files if they are successfully processed.")
+    parser.add_argument(
+        "--bypass_cache",
+        action="store_true",
+        help="Ignore cached ArchivesSpace data and JPEG2000 files, and refresh them.")
+    progress = parser.add_mutually_exclusive_group()
+    progress.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue objects from the first step not completed in an earlier run, and keep derivatives of failed objects.")
+    progress.add_argument(
+        "--restart",
+        action="store_true",
+        help="Discard progress and local derivatives from earlier runs.")
+    parser.add_argument(
+        "--priority",
+        help="Comma-separated ref ids of objects to process before all others, in order.")
+    parser.add_argument(
+        "--metrics",
+        metavar="DIRECTORY",
+        help="Write the time, CPU time, bytes and pages of each stage to a Prometheus textfile and a JSON summary in this directory.")
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="Write a timeline of every object, stage, page, command and S3 request to a Chrome trace file, which can be viewed with Perfetto.")
+    parser.add_argument(
+        "--profile",
+        metavar="DIRECTORY",
+        help="Profile the Python code run for each stage and object with cProfile and write reports to this directory.")
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="Show the progress of objects recorded in the journal and exit.")
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Report the pages, expected output size, estimated time and existing derivatives of each object in source_directory and exit.")
+    parser.add_argument(
+        "--benchmark_encoders",
+        action="store_true",
+        help="Encode the TIFF files in source_directory with every available JPEG2000 encoder, report their speed and exit.")
     args = parser.parse_args()
+    if args.status:
+        IIIFPipeline().status()
+        return
+    if not (args.source_directory and args.target_directory):
+        parser.error("source_directory and target_directory are required")
+    if args.plan:
+        IIIFPipeline().plan(args.source_directory, args.target_directory, args.skip)
+        return
+    if args.benchmark_encoders:
+        IIIFPipeline().benchmark_encoders(args.source_directory, args.target_directory)
+        return
     IIIFPipeline().run(
         args.source_directory,
         args.target_directory,
         args.skip,
         args.replace,
-        args.cleanup_source)
+        args.cleanup_source,
+        args.bypass_cache,
+        args.resume,
+        args.restart,
+        args.priority.split(",") if args.priority else None,
+        args.metrics,
+        args.trace,
+        args.profile)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from .encoders import can_stream, read_rows
+from .probe import probe_tiff
+from .scheduling import ANALYSIS_MEMORY_FACTOR, MemoryBudget, estimate_memory
+
+READ_SAMPLES = 2 ** 22
+
+
+def analyze_page(file, size=512, variance_threshold=25.0, ink_threshold=0.002,
+                 ink_contrast=64, color_tolerance=4):
+    """Classifies a page image as blank or not, and as grayscale or color.
+
+    The image is decoded at a reduced size. Uncompressed TIFFs are read a
+    band of rows at a time and reduced as they are read, so memory use is
+    proportional to the width of the page rather than its area; other images
+    are decoded whole with Pillow and then reduced. A page is blank if its pixels
+    barely vary and almost none of them are much darker than the paper, such
+    as a separator sheet or an empty verso. Faint pages, such as pencil
+    manuscripts or low-contrast photographs, vary too much to be blank even
+    though they have little ink. A page is grayscale if it has a single
+    channel, or if the channels of almost all of its pixels differ by no more
+    than the color tolerance.
+
+    Args:
+        file (str): Path to an image file.
+        size (int): Approximate length of the longest side of the decoded image.
+        variance_threshold (float): Pixel variance (on a scale of 0 to 255)
+            below which a page is blank.
+        ink_threshold (float): Fraction of pixels which are ink below which a
+            page is blank.
+        ink_contrast (int): Number of levels darker than the median (paper)
+            level at which a pixel counts as ink.
+        color_tolerance (int): Number of levels by which the channels of a
+            grayscale pixel may differ.
+    Returns:
+        analysis (dict): Whether the page is blank, its pixel variance and ink
+            coverage, its color mode and whether it is grayscale.
+    """
+    info = _probe(file)
+    with Image.open(file) as img:
+        mode = img.mode
+        factor = max(1, max(img.size) // size)
+        if info and can_stream(info):
+            scale = 1 / 257 if info["bits_per_sample"][0] == 16 else 1
+            pixels = read_reduced(file, info, factor)
+        else:
+            scale = 1 / 257 if img.mode.startswith("I;16") else 1
+            if img.mode.startswith("I;16"):
+                img = img.convert("I")
+            elif img.mode in ("1", "P"):
+                img = img.convert("L")
+            elif img.mode in ("CMYK", "YCbCr", "LAB", "HSV"):
+                img = img.convert("RGB")
+            pixels = np.asarray(img.reduce(factor) if factor > 1 else img)
+    pixels = pixels.astype(np.float32) * scale
+    grayscale = True
+    if pixels.ndim == 3:
+        spread = pixels[:, :, :3].max(axis=2) - pixels[:, :, :3].min(axis=2)
+        grayscale = np.percentile(spread, 99.9) <= color_tolerance
+        pixels = pixels[:, :, :3].mean(axis=2)
+    variance = float(pixels.var())
+    ink_coverage = float(np.count_nonzero(
+        pixels < np.median(pixels) - ink_contrast)) / pixels.size
+    return {
+        "blank": variance < variance_threshold and ink_coverage < ink_threshold,
+        "variance": variance,
+        "ink_coverage": ink_coverage,
+        "mode": mode,
+        "grayscale": bool(grayscale)}
+
+
+def read_reduced(file, info, factor):
+    """Reads an uncompressed TIFF reduced by a factor, a band of rows at a time.
+
+    Each pixel of the result is the mean of a box of pixels of the source,
+    as with Pillow's `Image.reduce`. Boxes at the right and bottom edges may
+    be smaller.
+
+    Args:
+        file (str): Path to the TIFF file.
+        info (dict): Result of `probe_tiff` for the TIFF.
+        factor (int): Size of the box of pixels averaged for each pixel.
+    Returns:
+        pixels (numpy.ndarray): Reduced pixels with the shape (rows, columns)
+            for grayscale images or (rows, columns, samples) otherwise.
+    """
+    width, height, samples = info["width"], info["height"], info["samples_per_pixel"]
+    columns = np.arange(0, width, factor)
+    sums = np.zeros((-(-height // factor), len(columns), samples), dtype=np.uint64)
+    band_rows = _band_rows(info)
+    with open(file, "rb") as f:
+        for top in range(0, height, band_rows):
+            bottom = min(height, top + band_rows)
+            band = np.add.reduceat(read_rows(f, info, top, bottom), columns, axis=1, dtype=np.uint64)
+            np.add.at(sums, np.arange(top, bottom) // factor, band)
+    row_counts = np.minimum(factor, height - np.arange(0, height, factor))
+    column_counts = np.minimum(factor, width - columns)
+    pixels = sums / (row_counts[:, None, None] * column_counts[None, :, None])
+    return pixels[:, :, 0] if samples == 1 else pixels
+
+
+def analyze_pages(files, workers=1, budget=None, **kwargs):
+    """Classifies many page images concurrently.
+
+    Analysis only starts once the memory it is estimated to need, from the
+    TIFF header of the page, can be reserved from `budget`. Uncompressed
+    pages only need a band of rows, but other pages are fully decoded before
+    they are reduced.
+
+    Args:
+        files (list): Paths of the TIFF files.
+        workers (int): Number of pages to analyze concurrently.
+        budget (MemoryBudget): Memory budget shared with other work.
+        kwargs: Thresholds passed to `analyze_page`.
+    Returns:
+        analyses (list): Results for each file, in the same order as the files.
+    """
+    budget = budget or MemoryBudget()
+
+    def analyze(file):
+        info = probe_tiff(file)
+        with budget.reserve(estimate_memory(
+                info["width"], _band_rows(info) if can_stream(info) else info["height"],
+                info["samples_per_pixel"], max(8, max(info["bits_per_sample"])), ANALYSIS_MEMORY_FACTOR)):
+            return analyze_page(file, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(executor.map(analyze, files))
+
+
+def _band_rows(info):
+    """Gets the number of rows of an uncompressed TIFF read at a time."""
+    return max(1, min(info["height"], READ_SAMPLES // (info["width"] * info["samples_per_pixel"])))
+
+
+def _probe(file):
+    """Probes a TIFF file, or returns None if the file is not a TIFF."""
+    try:
+        return probe_tiff(file)
+    except ValueError:
+        return None
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024):
+        """A thread-safe in-memory cache which discards its least recently used entries.
+
+        Args:
+            maxsize (int): Maximum number of entries to keep.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Gets a cached value.
+
+        Args:
+            key (str): Key of the entry.
+            default: Value to return if there is no entry for the key.
+        Returns:
+            value: The cached value, or the default.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """Stores a value, discarding the least recently used entry if the cache is full.
+
+        Args:
+            key (str): Key of the entry.
+            value: Value to cache.
+        """
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+class MetadataCache:
+    def __init__(self, path, ttl=None):
+        """A persistent cache of formatted ArchivesSpace data, keyed by ref_id.
+
+        Args:
+            path (str): Path to the SQLite database file used to store the cache.
+            ttl (int): Number of seconds after which an entry expires. Entries
+                never expire if this is not set.
+        """
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS metadata (ref_id TEXT PRIMARY KEY, data TEXT, created REAL)")
+
+    def get(self, ref_id):
+        """Gets cached data for a ref_id.
+
+        Args:
+            ref_id (str): An ArchivesSpace refid.
+        Returns:
+            data (dict): Cached data, or None if there is no unexpired entry.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT data, created FROM metadata WHERE ref_id = ?", (ref_id,)).fetchone()
+            if row and (self.ttl is None or time.time() - row[1] < self.ttl):
+                self.hits += 1
+                return json.loads(row[0])
+            self.misses += 1
+            return None
+
+    def set(self, ref_id, data):
+        """Stores data for a ref_id, replacing any existing entry.
+
+        Args:
+            ref_id (str): An ArchivesSpace refid.
+            data (dict): Data to cache.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO metadata (ref_id, data, created) VALUES (?, ?, ?)",
+                (ref_id, json.dumps(data), time.time()))
+
+
+class DerivativeCache:
+    def __init__(self, directory, max_size, bypass=False):
+        """A persistent cache of derivative files, keyed by the content of their source.
+
+        Args:
+            directory (str): Directory in which cached files and their index are stored.
+            max_size (int): Maximum total size of cached files in bytes. The least
+                recently used files are removed when it is exceeded.
+            bypass (bool): Never return cached files, but keep adding new ones.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_size = max_size
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            os.path.join(directory, "index.db"), check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS derivatives (key TEXT PRIMARY KEY, size INTEGER, accessed REAL)")
+
+    @property
+    def hit_rate(self):
+        """Fraction of lookups which found a cached file."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def key(self, source, options):
+        """Creates a cache key from the content of a source file and encoding options.
+
+        Args:
+            source (str): Path to the source file.
+            options (list): Options which affect the content of the derivative.
+        Returns:
+            key (str): A SHA-256 hex digest.
+        """
+        digest = hashlib.sha256()
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        digest.update(json.dumps(options).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key, destination):
+        """Links or copies a cached file to a destination.
+
+        A file which is evicted between being found and being linked counts
+        as a miss.
+
+        Args:
+            key (str): Cache key of the file.
+            destination (str): Path at which to create the file.
+        Returns:
+            boolean: True if a cached file was found, false otherwise.
+        """
+        path = self.path(key)
+        with self.lock:
+            found = not self.bypass and self.connection.execute(
+                "SELECT key FROM derivatives WHERE key = ?", (key,)).fetchone() and os.path.isfile(path)
+            if found:
+                with self.connection:
+                    self.connection.execute(
+                        "UPDATE derivatives SET accessed = ? WHERE key = ?", (time.time(), key))
+        if found:
+            try:
+                _link_or_copy(path, destination)
+            except FileNotFoundError:
+                found = False
+        with self.lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return bool(found)
+
+    def put(self, key, source):
+        """Adds a file to the cache, removing least recently used files if the cache is full.
+
+        The file is copied rather than linked, so that writing to the source
+        later cannot change the cached file.
+
+        Args:
+            key (str): Cache key of the file.
+            source (str): Path of the file to cache.
+        """
+        path = self.path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        os.close(handle)
+        try:
+            shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO derivatives (key, size, accessed) VALUES (?, ?, ?)",
+                (key, os.path.getsize(path), time.time()))
+            total = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM derivatives").fetchone()[0]
+            for evicted, size in self.connection.execute(
+                    "SELECT key, size FROM derivatives ORDER BY accessed").fetchall():
+                if total <= self.max_size:
+                    break
+                self.connection.execute("DELETE FROM derivatives WHERE key = ?", (evicted,))
+                if os.path.isfile(self.path(evicted)):
+                    os.remove(self.path(evicted))
+                total -= size
+
+    def path(self, key):
+        """Gets the path of a cached file."""
+        return os.path.join(self.directory, key[:2], key)
+
+
+def _link_or_copy(source, destination):
+    """Hardlinks a file to a destination, copying it if a link cannot be made."""
+    if os.path.isfile(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
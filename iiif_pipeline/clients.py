@@ -1,38 +1,69 @@
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 from asnake import utils
 from asnake.aspace import ASpace
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+from .cache import LRUCache
+from .instrumentation import in_current_span, span
+
+_MISSING = object()
+
 
 class ArchivesSpaceClient:
-    def __init__(self, baseurl, username, password, repository):
+    def __init__(self, baseurl, username, password, repository,
+                 cache=None, bypass_cache=False, lru_size=1024):
         self.client = ASpace(
             baseurl=baseurl,
             username=username,
             password=password,
             repository=repository).client
         self.repository = repository
+        self.cache = cache
+        self.bypass_cache = bypass_cache
+        self.records = LRUCache(lru_size)
+        self.date_displays = LRUCache(lru_size)
+
+    @property
+    def requests_saved(self):
+        """Number of ArchivesSpace requests answered from memory."""
+        return self.records.hits + self.date_displays.hits
 
     def get_object(self, ref_id):
         """Gets archival object title and date from an ArchivesSpace refid.
 
+        If a cache is set, formatted data is read from it unless the cache is
+        bypassed, and data fetched from ArchivesSpace is written to it.
+
         Args:
             ident (str): an ArchivesSpace refid.
         Returns:
             obj (dict): A dictionary representation of an archival object from ArchivesSpace.
         """
-        results = self.client.get(
-            'repositories/{}/find_by_id/archival_objects?ref_id[]={}'.format(self.repository, ref_id)).json()
-        if not results.get("archival_objects"):
-            raise Exception(
-                "Could not find an ArchivesSpace object matching refid: {}".format(ref_id))
-        else:
-            obj_ref = results["archival_objects"][0]["ref"]
-            obj = self.client.get(obj_ref).json()
-            obj["dates"] = utils.find_closest_value(obj, 'dates', self.client)
-            return self.format_data(obj)
+        with span("archivesspace_lookup", {"cached": "false"}, ref_id=ref_id) as current:
+            if self.cache and not self.bypass_cache:
+                cached = self.cache.get(ref_id)
+                if cached:
+                    current.labels["cached"] = "true"
+                    return cached
+            results = self.client.get(
+                'repositories/{}/find_by_id/archival_objects?ref_id[]={}'.format(self.repository, ref_id)).json()
+            if not results.get("archival_objects"):
+                raise Exception(
+                    "Could not find an ArchivesSpace object matching refid: {}".format(ref_id))
+            else:
+                obj_ref = results["archival_objects"][0]["ref"]
+                obj = self.client.get(obj_ref).json()
+                data = self.format_data(obj)
+                if self.cache:
+                    self.cache.set(ref_id, data)
+                return data
 
     def format_data(self, data):
         """Parses ArchivesSpace data.
@@ -43,58 +74,198 @@ class ArchivesSpaceClient:
             parsed (dict): Parsed data, with only required fields present.
         """
         title = data.get("title", data.get("display_string")).title()
-        dates = ", ".join([utils.get_date_display(d, self.client)
-                           for d in data.get("dates", [])])
+        dates = self.get_closest_dates(data)
         return {"title": title, "dates": dates, "uri": data["uri"]}
 
+    def get_closest_dates(self, obj):
+        """Gets a display string for the dates of an archival object or its closest dated ancestor.
+
+        Ancestors are checked from the closest upwards. Ancestor records and
+        the date display rendered for each ancestor are kept in in-memory LRU
+        caches keyed by URI, so siblings do not fetch the same ancestors again.
+
+        Args:
+            obj (dict): ArchivesSpace data for an archival object.
+        Returns:
+            dates (str): Date expressions, separated by commas.
+        """
+        if obj.get("dates"):
+            return self.render_dates(obj["dates"])
+        for ancestor in obj.get("ancestors", []):
+            uri = ancestor["ref"]
+            dates = self.date_displays.get(uri, _MISSING)
+            if dates is _MISSING:
+                record = self.get_record(uri)
+                dates = self.render_dates(record["dates"]) if record.get("dates") else None
+                self.date_displays.set(uri, dates)
+            if dates:
+                return dates
+        return ""
+
+    def get_record(self, uri):
+        """Gets an ArchivesSpace record, using the in-memory cache if possible.
+
+        Args:
+            uri (str): URI of the record.
+        Returns:
+            record (dict): ArchivesSpace data for the record.
+        """
+        record = self.records.get(uri)
+        if record is None:
+            record = self.client.get(uri).json()
+            self.records.set(uri, record)
+        return record
+
+    def render_dates(self, dates):
+        """Joins the display strings of ArchivesSpace dates.
+
+        Args:
+            dates (list): ArchivesSpace date subrecords.
+        Returns:
+            dates (str): Date expressions, separated by commas.
+        """
+        return ", ".join([utils.get_date_display(d, self.client) for d in dates])
+
 
 class AWSClient:
-    def __init__(self, region_name, access_key, secret_key, bucket):
+    def __init__(self, region_name, access_key, secret_key, bucket,
+                 workers=1, chunk_size=8, part_workers=4, endpoint_url=None):
+        """Sets up a single S3 connection pool which is shared by all uploads.
+
+        Args:
+            region_name (str): AWS region of the bucket.
+            access_key (str): AWS access key id.
+            secret_key (str): AWS secret access key.
+            bucket (str): Name of the bucket to upload to.
+            workers (int): Number of files uploaded concurrently.
+            chunk_size (int): Size in MB of each part of a multipart upload.
+            part_workers (int): Number of parts of a file uploaded concurrently.
+            endpoint_url (str): URL of an S3-compatible service to use instead of AWS.
+        """
+        self.workers = max(1, workers)
         self.s3 = boto3.resource(
             service_name='s3',
             region_name=region_name,
             aws_access_key_id=access_key,
-            aws_secret_access_key=secret_key)
+            aws_secret_access_key=secret_key,
+            endpoint_url=endpoint_url,
+            config=Config(max_pool_connections=max(10, self.workers * part_workers)))
+        self.transfer_config = TransferConfig(
+            multipart_threshold=chunk_size * 1024 * 1024,
+            multipart_chunksize=chunk_size * 1024 * 1024,
+            max_concurrency=part_workers)
         self.bucket = bucket
+        self.key_index = {}
+        self.key_index_lock = threading.Lock()
 
     def upload_files(self, files, destination_dir, replace=False):
         """Iterates over directories and conditionally uploads files to S3.
 
+        All files are checked before any are uploaded. Files are then uploaded
+        concurrently, and files larger than the chunk size are uploaded in parts.
+
+        Existing keys are looked up with a single listing of the longest
+        prefix shared by all the files.
+
         Args:
             files (list): Filepaths to be uploaded.
             destination_dir (str): Path in the bucket in which the file should be stored.
             replace (bool): Upload files even if they exist.
+        Returns:
+            stats (dict): Number of files and bytes uploaded, elapsed seconds and bytes per second.
         """
-        for file in files:
-            key = os.path.splitext(os.path.basename(file))[0]
-            bucket_path = os.path.join(destination_dir, key)
-            if (self.object_in_bucket(bucket_path) and not replace):
+        uploads = [(file, os.path.join(destination_dir, os.path.splitext(os.path.basename(file))[0]))
+                   for file in files]
+        prefix = os.path.commonprefix([bucket_path for _, bucket_path in uploads])
+        for file, bucket_path in uploads:
+            if (self.object_in_bucket(bucket_path, prefix) and not replace):
                 raise FileExistsError(
                     "Error uploading files to AWS: {} already exists in {}".format(bucket_path, self.bucket))
-            else:
-                content_type = "image/jp2"
-                if file.endswith(".json"):
-                    content_type = "application/json"
-                elif file.endswith(".pdf"):
-                    content_type = "application/pdf"
-                self.s3.meta.client.upload_file(
-                    file, self.bucket, bucket_path,
-                    ExtraArgs={'ContentType': content_type})
-
-    def object_in_bucket(self, object_path):
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            upload_file = in_current_span(self.upload_file)
+            for future in [executor.submit(upload_file, file, bucket_path)
+                           for file, bucket_path in uploads]:
+                future.result()
+        elapsed = time.time() - start
+        size = sum(os.path.getsize(file) for file, _ in uploads)
+        return {"files": len(uploads), "bytes": size, "seconds": elapsed,
+                "bytes_per_second": size / elapsed if elapsed else 0}
+
+    def upload_file(self, file, bucket_path):
+        """Uploads a single file to S3.
+
+        Args:
+            file (str): Filepath to be uploaded.
+            bucket_path (str): Key of the object in the bucket.
+        """
+        content_type = "image/jp2"
+        if file.endswith(".json"):
+            content_type = "application/json"
+        elif file.endswith(".pdf"):
+            content_type = "application/pdf"
+        with span("upload_file", {"content_type": content_type}, key=bucket_path) as current:
+            self.s3.meta.client.upload_file(
+                file, self.bucket, bucket_path,
+                ExtraArgs={'ContentType': content_type},
+                Config=self.transfer_config)
+            current.add(bytes_out=os.path.getsize(file))
+        with self.key_index_lock:
+            for prefix, keys in self.key_index.items():
+                if bucket_path.startswith(prefix):
+                    keys.add(bucket_path)
+
+    def object_in_bucket(self, object_path, prefix=None):
         """Checks if a file already exists in an S3 bucket.
 
         Args:
             object_path (str): Path to the object in the bucket.
+            prefix (str): Prefix to list in order to find the object. Defaults
+                to the object path.
         Returns:
             boolean: True if file exists, false otherwise.
         """
-        try:
-            self.s3.Object(
-                self.bucket, object_path).load()
-            return True
-        except ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                return False
-            else:
+        return object_path in self.list_keys(prefix or object_path)
+
+    def existing_objects(self, identifier):
+        """Finds objects for an identifier which already exist in an S3 bucket.
+
+        Args:
+            identifier (str): Identifier of the derivative files.
+        Returns:
+            existing (list): Paths in the bucket of images, PDFs and manifests
+                for the identifier.
+        """
+        existing = []
+        for destination_dir in ["images", "pdfs", "manifests"]:
+            existing += sorted(self.list_keys(
+                os.path.join(destination_dir, identifier)))
+        return existing
+
+    def list_keys(self, prefix):
+        """Gets the keys in an S3 bucket which start with a prefix.
+
+        Keys are fetched with one paginated listing per prefix and cached for
+        the lifetime of the client. A prefix which falls within a prefix that
+        has already been listed is answered from the cache.
+
+        Args:
+            prefix (str): Prefix of the keys to list.
+        Returns:
+            keys (set): Keys in the bucket which start with the prefix.
+        """
+        with self.key_index_lock:
+            for listed_prefix, keys in self.key_index.items():
+                if prefix.startswith(listed_prefix):
+                    return set(k for k in keys if k.startswith(prefix))
+        keys = set()
+        with span("list_keys", prefix=prefix):
+            try:
+                paginator = self.s3.meta.client.get_paginator("list_objects_v2")
+                for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+                    keys.update(obj["Key"] for obj in page.get("Contents", []))
+            except ClientError as e:
                 raise Exception("Error connecting to AWS: {}".format(e)) from e
+        with self.key_index_lock:
+            self.key_index[prefix] = keys
+        return set(keys)
@@ -1,26 +1,73 @@
+import io
 import math
 import os
+import shutil
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from mimetypes import MimeTypes
 
+import img2pdf
+import pikepdf
 from PIL import Image
 
+from .encoders import OpenJPEGEncoder, StreamingEncoder, can_stream
 from .helpers import get_page_number
+from .instrumentation import in_current_span, run_command, span
+from .probe import probe_files, probe_jp2, probe_tiff
+from .scheduling import (JP2_MEMORY_FACTOR, OCR_MEMORY_FACTOR,
+                         PDF_MEMORY_FACTOR, MemoryBudget, estimate_memory)
+
+ENCODING_PROFILES = {
+    "default": {"rate": 1.5,
+                "precincts": [(256, 256), (256, 256), (128, 128)],
+                "code_block": (64, 64),
+                "progression": "RPCL"},
+    "grayscale": {"rate": 1.5,
+                  "precincts": [(256, 256), (256, 256), (128, 128)],
+                  "code_block": (64, 64),
+                  "progression": "RPCL",
+                  "mode": "L"},
+    "bitonal": {"rate": None,
+                "precincts": [(256, 256), (256, 256), (128, 128)],
+                "code_block": (64, 64),
+                "progression": "RPCL"},
+    "high_bit_depth": {"rate": 3,
+                       "precincts": [(256, 256), (256, 256), (128, 128)],
+                       "code_block": (64, 64),
+                       "progression": "RPCL"},
+}
+PDF_MAX_PIXELS = 40000000
+DERIVATIVE_FORMATS = {
+    "jp2": {},
+    "htj2k": {"block_coder": "ht"},
+}
 
 
 def calculate_layers(file):
     """Calculates the number of layers based on pixel dimensions.
 
-    For TIFF files, image tag 256 is the width, and 257 is the height.
+    For TIFF files, image tag 256 is the width, and 257 is the height. Only
+    the TIFF header is read.
 
     Args:
         file (str): filename of a TIFF image file.
     Returns:
         layers (int): number of layers to convert to
     """
-    with Image.open(file) as img:
-        width = [w for w in img.tag[256]][0]
-        height = [h for h in img.tag[257]][0]
+    info = probe_tiff(file)
+    return layers_for_dimensions(info["width"], info["height"])
+
+
+def layers_for_dimensions(width, height):
+    """Calculates the number of layers for an image of a given size.
+
+    Args:
+        width (int): Pixel width of the image.
+        height (int): Pixel height of the image.
+    Returns:
+        layers (int): number of layers to convert to
+    """
     return math.ceil((math.log(max(width, height)) / math.log(2)
                       ) - ((math.log(96) / math.log(2)))) + 1
 
@@ -37,43 +84,189 @@ def is_tiff(file):
     return True if content_type == "image/tiff" else False
 
 
-def create_jp2(files, identifier, derivative_dir, replace=False):
+def create_jp2(files, identifier, derivative_dir, replace=False, workers=1,
+               on_page_complete=None, cache=None, analyses=None, encoder=None,
+               derivative_format="jp2", stream_pixels=None, budget=None):
     """Creates JPEG2000 files from TIFF files.
 
-    The default options for conversion below are:
+    The default options for conversion are:
     - Compression ration of `1.5`
     - Precinct size: `[256,256]` for first two layers and then `[128,128]` for all others
     - Code block size of `[64,64]`
     - Progression order of `RPCL`
 
+    Each page is encoded with one of the `ENCODING_PROFILES`, chosen by
+    `encoding_profile` from its TIFF header and its page analysis. With the
+    `htj2k` derivative format, the profile uses the High-Throughput block
+    coder (HTJ2K) but keeps its layers, precincts and progression order.
+
+    Pages with at least `stream_pixels` pixels are encoded a band of rows at
+    a time by the `StreamingEncoder`, which keeps memory use bounded, if
+    their TIFF is uncompressed and the streaming encoder can apply their
+    profile. Other pages are encoded by `encoder`.
+
+    The memory needed to encode each page is estimated from its TIFF header,
+    and a page only starts once that memory can be reserved from `budget`.
+
+    All files are checked, and the headers of the TIFF files are read, before
+    any encoding starts. Pages are then encoded by a pool of `workers`
+    threads, each of which drives the encoder. If a page fails, pages which have not yet started are
+    cancelled and an exception listing every failed page is raised once the
+    running pages have finished.
+
     Args:
         files (list): Filepaths for source files, which include source directory.
         derivative_dir (str): Path to directory location to save JP2 files.
         identifier (str): A unique identifier to use for derivative image filenaming.
         replace (bool): Replace existing derivative files.
+        workers (int): Number of pages to encode concurrently.
+        on_page_complete (callable): Function called with the record of each
+            page once it has been encoded.
+        cache (DerivativeCache): Cache of JP2 files keyed by the content of
+            their source TIFF and the encoding options. Pages found in the
+            cache are linked or copied instead of being encoded.
+        analyses (dict): Results of `analyze_page` for each source TIFF, keyed
+            by page number.
+        encoder (Encoder): Encoder used to create the JP2 files. Defaults to
+            `opj_compress`.
+        derivative_format (str): One of the `DERIVATIVE_FORMATS`.
+        stream_pixels (int): Number of pixels above which pages are streamed
+            through the encoder. Pages are never streamed if this is not set.
+        budget (MemoryBudget): Memory budget shared with other work.
+    Returns:
+        pages (list): A record for each page, with the source and derivative
+            paths, pixel dimensions, number of layers, TIFF header information,
+            encoding profile, encoder and estimated memory.
     """
-    default_options = ["-r", "1.5",
-                       "-c", "[256,256],[256,256],[128,128]",
-                       "-b", "64,64",
-                       "-p", "RPCL"]
+    analyses = analyses or {}
+    encoder = encoder or OpenJPEGEncoder()
+    streaming_encoder = StreamingEncoder()
+    if derivative_format not in DERIVATIVE_FORMATS:
+        raise Exception(
+            "Error creating JPEG2000: unknown derivative format {}".format(derivative_format))
+    pages = []
     for original_file in files:
         derivative_path = os.path.join(derivative_dir, "{}_{}.jp2".format(
             identifier, get_page_number(original_file)))
         if (os.path.isfile(derivative_path) and not replace):
             raise FileExistsError(
                 "Error creating JPEG2000: {} already exists".format(derivative_path))
-        else:
-            if is_tiff(original_file):
-                layers = calculate_layers(original_file)
-                cmd = ["/usr/local/bin/opj_compress",
-                       "-i", original_file,
-                       "-o", derivative_path,
-                       "-n", str(layers),
-                       "-SOP"] + default_options
-                subprocess.run(cmd, check=True)
-            else:
-                raise Exception(
-                    "Error creating JPEG2000: {} is not a valid TIFF".format(original_file))
+        elif not is_tiff(original_file):
+            raise Exception(
+                "Error creating JPEG2000: {} is not a valid TIFF".format(original_file))
+        pages.append({"source": original_file,
+                      "derivative": derivative_path,
+                      "page": get_page_number(original_file)})
+    try:
+        tiff_info = probe_files(files, probe_tiff, workers)
+    except Exception as e:
+        raise Exception(
+            "Error creating JPEG2000: {}".format(e)) from e
+    jobs = []
+    for page, info in zip(pages, tiff_info):
+        page.update({
+            "width": info["width"],
+            "height": info["height"],
+            "layers": layers_for_dimensions(info["width"], info["height"]),
+            "tiff": info})
+        page["profile"] = encoding_profile(page, analyses.get(page["page"]))
+        profile = dict(ENCODING_PROFILES[page["profile"]], **DERIVATIVE_FORMATS[derivative_format])
+        stream = (stream_pixels and info["width"] * info["height"] >= stream_pixels and
+                  can_stream(info) and streaming_encoder.available() and
+                  streaming_encoder.supports(profile))
+        page_encoder = streaming_encoder if stream else encoder
+        page["encoder"] = page_encoder.name
+        page["memory"] = estimate_memory(
+            info["width"],
+            min(info["height"], streaming_encoder.band_rows(page["layers"])) if stream else info["height"],
+            info["samples_per_pixel"], max(info["bits_per_sample"]), JP2_MEMORY_FACTOR)
+        jobs.append((page, profile, page_encoder))
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {
+            executor.submit(in_current_span(encode_jp2), page, profile, cache, page_encoder, budget): page
+            for page, profile, page_encoder in jobs}
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                future.result()
+                if on_page_complete:
+                    on_page_complete(futures[future])
+            except Exception as e:
+                errors.append("{}: {}".format(futures[future]["source"], e))
+                for pending in futures:
+                    pending.cancel()
+    if errors:
+        raise Exception(
+            "Error creating JPEG2000: {} of {} pages failed: {}".format(
+                len(errors), len(pages), "; ".join(sorted(errors))))
+    return pages
+
+
+def encoding_profile(page, analysis=None):
+    """Chooses how to encode a page from its image characteristics.
+
+    - `bitonal`: 1-bit pages, which are encoded losslessly.
+    - `high_bit_depth`: pages with more than 8 bits per sample, which are
+      compressed at twice the ratio so they use as many bits per pixel as
+      8-bit pages.
+    - `grayscale`: 8-bit RGB pages whose channels are the same, which are
+      converted to a single channel before they are encoded.
+    - `default`: all other pages.
+
+    Args:
+        page (dict): Record for the page, including its TIFF header information.
+        analysis (dict): Result of `analyze_page` for the page's source TIFF.
+    Returns:
+        profile (str): Name of one of the `ENCODING_PROFILES`.
+    """
+    bits = max(page["tiff"]["bits_per_sample"])
+    if bits == 1:
+        return "bitonal"
+    elif bits > 8:
+        return "high_bit_depth"
+    elif page["tiff"]["samples_per_pixel"] >= 3 and analysis and analysis.get("grayscale"):
+        return "grayscale"
+    return "default"
+
+
+def encode_jp2(page, profile, cache=None, encoder=None, budget=None):
+    """Encodes a single TIFF file as a JPEG2000 file.
+
+    An existing derivative is removed before encoding rather than written
+    over, since it may be a link to a cached file.
+
+    Args:
+        page (dict): Record for the page, including source and derivative paths,
+            the number of layers, the name of the encoding profile and the
+            estimated memory needed to encode it.
+        profile (dict): Encoding settings, one of the `ENCODING_PROFILES`.
+        cache (DerivativeCache): Cache in which to look for, and store, the JP2 file.
+        encoder (Encoder): Encoder used to create the JP2 file. Defaults to
+            `opj_compress`.
+        budget (MemoryBudget): Memory budget from which to reserve the memory
+            needed to encode the page.
+    """
+    encoder = encoder or OpenJPEGEncoder()
+    budget = budget or MemoryBudget()
+    with span("encode_page", {"encoder": encoder.name, "cached": "false"},
+              page=page.get("page"), source=page["source"]) as current:
+        current.add(pages=1, bytes_in=os.path.getsize(page["source"]))
+        if cache:
+            key = cache.key(page["source"], [
+                encoder.name, encoder.options(page["layers"], profile), page.get("profile", "default")])
+            if cache.get(key, page["derivative"]):
+                current.labels["cached"] = "true"
+                current.add(bytes_out=os.path.getsize(page["derivative"]))
+                return
+        if os.path.isfile(page["derivative"]):
+            os.remove(page["derivative"])
+        with budget.reserve(page.get("memory", 0)):
+            encoder.encode(page["source"], page["derivative"], page["layers"], profile)
+        current.add(bytes_out=os.path.getsize(page["derivative"]))
+        if cache:
+            cache.put(key, page["derivative"])
 
 
 def create_pdf(files, identifier, pdf_dir, replace=False):
@@ -127,3 +320,172 @@ def ocr_pdf(identifier, pdf_dir):
                     "--output-type", "pdf",
                     "--optimize", "0",
                     "--quiet"])
+
+
+def create_access_pdf(files, identifier, pdf_dir, replace=False, ocr=True,
+                      scale=0.75, quality=50, workers=1, cache=None,
+                      blank_pages=None, budget=None, max_pixels=PDF_MAX_PIXELS):
+    """Creates a compressed, OCRed PDF from JPEG2000 files in a single pass.
+
+    Produces the same result as `create_pdf`, `compress_pdf` and `ocr_pdf`
+    without writing the PDF three times. Each page is decoded once and
+    downsampled to screen resolution, which is what Ghostscript's `/screen`
+    setting does to the 96 DPI pages created by `img2pdf`, and encoded as a
+    JPEG. Pages are prepared and OCRed concurrently, and the text layer of
+    each page is laid over its image when the PDF is assembled, so the only
+    file written is the final PDF. Decoding, OCRing and assembling only start
+    once the memory they are estimated to need can be reserved from `budget`.
+
+    Args:
+        files (list): Filepaths of JPEG2000 files.
+        identifier (str): Identifier of created PDF file.
+        pdf_dir (str): Directory in which to save the PDF file.
+        replace (bool): Replace existing derivative files.
+        ocr (bool): Add an OCR text layer.
+        scale (float): Factor by which to scale the pixel dimensions of each page.
+        quality (int): JPEG quality of the downsampled pages.
+        workers (int): Number of pages to prepare and OCR concurrently.
+        cache (DerivativeCache): Cache of the text layers of pages, keyed by
+            the content of their source image.
+        blank_pages (set): Page numbers of blank pages, which are not OCRed.
+        budget (MemoryBudget): Memory budget shared with other work.
+        max_pixels (int): Number of pixels above which pages are scaled down
+            further, see `downsample_page`.
+    """
+    budget = budget or MemoryBudget()
+    blank_pages = blank_pages or set()
+    pdf_path = "{}.pdf".format(os.path.join(pdf_dir, identifier))
+    if (os.path.isfile(pdf_path) and not replace):
+        raise FileExistsError(
+            "Error creating PDF: {} already exists".format(pdf_path))
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        info = probe_files(files, probe_jp2, workers)
+
+        def prepare(file, info):
+            _, reduce = downsample_levels(info, scale, max_pixels)
+            with span("pdf_downsample", source=file) as current, budget.reserve(estimate_memory(
+                    -(-info["width"] // 2 ** reduce), -(-info["height"] // 2 ** reduce),
+                    info["components"], 8, PDF_MEMORY_FACTOR)):
+                page = downsample_page(file, scale, quality, max_pixels)
+                current.add(pages=1, bytes_in=os.path.getsize(file), bytes_out=len(page))
+                return page
+
+        def recognize(file, page, info):
+            if get_page_number(file) in blank_pages:
+                return None
+            page_scale, _ = downsample_levels(info, scale, max_pixels)
+            with span("pdf_ocr", source=file) as current, budget.reserve(estimate_memory(
+                    info["width"] * page_scale, info["height"] * page_scale, 1, 8, OCR_MEMORY_FACTOR)):
+                text_layer = ocr_page(file, page, tmp_dir, [scale, quality, max_pixels], cache)
+                current.add(pages=1, bytes_in=len(page), bytes_out=os.path.getsize(text_layer))
+                return text_layer
+
+        pages = list(executor.map(in_current_span(prepare), files, info))
+        text_layers = list(executor.map(in_current_span(recognize), files, pages, info)) if ocr else []
+        with span("pdf_assemble", identifier=identifier) as current, \
+                budget.reserve(sum(len(page) for page in pages) * PDF_MEMORY_FACTOR):
+            current.add(pages=len(pages), bytes_in=sum(len(page) for page in pages))
+            pdf = img2pdf.convert(pages)
+            if not ocr:
+                with open(pdf_path, "wb") as f:
+                    f.write(pdf)
+                current.add(bytes_out=len(pdf))
+                return
+            with pikepdf.open(io.BytesIO(pdf)) as document:
+                for page, text_layer in zip(document.pages, text_layers):
+                    if not text_layer:
+                        continue
+                    with pikepdf.open(text_layer) as text:
+                        pikepdf.Page(page).add_overlay(text.pages[0])
+                document.save(pdf_path)
+            current.add(bytes_out=os.path.getsize(pdf_path))
+
+
+def ocr_page(file, page, tmp_dir, options, cache=None):
+    """Creates a PDF page containing only the OCRed text of an image.
+
+    Args:
+        file (str): Path to the source image of the page.
+        page (bytes): The JPEG which is OCRed.
+        tmp_dir (str): Directory in which to write the text layer.
+        options (list): Options used to create the JPEG from the source image.
+        cache (DerivativeCache): Cache of text layers.
+    Returns:
+        text_layer (str): Path to a single page PDF with invisible text.
+    """
+    cmd = ["tesseract", "-c", "textonly_pdf=1"]
+    base = os.path.join(tmp_dir, os.path.splitext(os.path.basename(file))[0])
+    text_layer = "{}.pdf".format(base)
+    if cache:
+        key = cache.key(file, cmd + options)
+        if cache.get(key, text_layer):
+            return text_layer
+    image = "{}.jpg".format(base)
+    with open(image, "wb") as f:
+        f.write(page)
+    tesseract = shutil.which(cmd[0])
+    if not tesseract:
+        raise Exception("Error creating OCR layer: {} is not installed".format(cmd[0]))
+    env = dict(os.environ, OMP_THREAD_LIMIT="1")
+    run_command([tesseract, image, base] + cmd[1:] + ["pdf"],
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                env=env, check=True)
+    os.remove(image)
+    if cache:
+        cache.put(key, text_layer)
+    return text_layer
+
+
+def downsample_levels(info, scale, max_pixels=None):
+    """Chooses the scale of a downsampled page and the resolution level to decode it from.
+
+    Args:
+        info (dict): Result of `probe_jp2` for the JPEG2000 file.
+        scale (float): Factor by which to scale the pixel dimensions.
+        max_pixels (int): Number of pixels above which the page is scaled down further.
+    Returns:
+        scale (float): Factor by which the pixel dimensions are scaled.
+        reduce (int): Number of resolution levels by which to reduce the
+            image when it is decoded, so that it is no smaller than the page.
+    """
+    if max_pixels and info["width"] * info["height"] * scale ** 2 > max_pixels:
+        scale = math.sqrt(max_pixels / (info["width"] * info["height"]))
+    return scale, max(0, min(info.get("levels", 0), int(math.log2(1 / scale))))
+
+
+def downsample_page(file, scale=0.75, quality=50, max_pixels=None):
+    """Decodes an image and encodes a downsampled copy as a JPEG.
+
+    The resolution of the JPEG is scaled along with its pixel dimensions, so
+    that the page has the same physical size as a 96 DPI page at full
+    resolution. Pages which would have more than `max_pixels` pixels are
+    scaled down further. JPEG2000 files are decoded at the smallest
+    resolution level which is no smaller than the JPEG, so large pages are
+    not decoded at full resolution.
+
+    Args:
+        file (str): Path to an image file.
+        scale (float): Factor by which to scale the pixel dimensions.
+        quality (int): JPEG quality.
+        max_pixels (int): Number of pixels above which pages are scaled down further.
+    Returns:
+        page (bytes): The encoded JPEG.
+    """
+    with Image.open(file) as img:
+        info = probe_jp2(file) if img.format == "JPEG2000" else {"width": img.width, "height": img.height}
+        scale, reduce = downsample_levels(info, scale, max_pixels)
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        if reduce:
+            img.reduce = reduce
+            img.load()
+        if img.mode.startswith("I"):
+            img = img.convert("I").point(lambda i: i * (1 / 256)).convert("L")
+        elif img.mode == "1":
+            img = img.convert("L")
+        elif img.mode not in ("L", "RGB"):
+            img = img.convert("RGB")
+        img = img.resize(size, Image.LANCZOS, reducing_gap=2.0)
+    page = io.BytesIO()
+    img.save(page, "JPEG", quality=quality, dpi=(96 * scale, 96 * scale))
+    return page.getvalue()
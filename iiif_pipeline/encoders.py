@@ -0,0 +1,486 @@
+import multiprocessing
+import os
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image, features
+
+from .instrumentation import run_command
+from .probe import probe_tiff
+
+try:
+    import glymur
+except ImportError:
+    glymur = None
+
+# Large maps exceed Pillow's decompression bomb limit. The memory used to
+# decode them is limited by the memory budget instead.
+Image.MAX_IMAGE_PIXELS = None
+
+CONVERSION_PIXELS = 2 ** 22
+
+
+class Encoder:
+    """Encodes TIFF files as JPEG2000 files.
+
+    Encoding settings are given as a profile, a dict with:
+    - `rate`: Compression ratio, or None for lossless compression.
+    - `precincts`: Precinct sizes, from the highest resolution level down.
+    - `code_block`: Code block size.
+    - `progression`: Progression order.
+    - `mode`: Optional image mode to convert the source to before encoding.
+    - `block_coder`: Optional block coder, either `classic` (the default) or
+      `ht` for High-Throughput JPEG2000 (HTJ2K).
+
+    Subclasses map a profile to the options of a particular encoder.
+    """
+    name = None
+    block_coders = ("classic",)
+
+    def available(self):
+        """Checks whether the encoder can be used on this host."""
+        return True
+
+    def supports(self, profile):
+        """Checks whether the encoder can apply a profile."""
+        return profile.get("block_coder", "classic") in self.block_coders
+
+    def options(self, layers, profile):
+        """Maps a profile to options for the encoder.
+
+        Args:
+            layers (int): Number of resolution levels.
+            profile (dict): Encoding settings.
+        Returns:
+            options (list): Options which determine the content of the JP2 file.
+        """
+        raise NotImplementedError
+
+    def encode(self, source, destination, layers, profile):
+        """Encodes a TIFF file as a JPEG2000 file.
+
+        If the profile has a mode, the source is converted to a temporary TIFF
+        in that mode with `convert_tiff`, which is encoded instead, since
+        command line encoders cannot select the components of their input.
+        The temporary file is hidden and written beside the destination, on
+        the same disk as the derivatives rather than the system's temporary
+        directory.
+
+        Args:
+            source (str): Path to the TIFF file.
+            destination (str): Path at which to create the JP2 file.
+            layers (int): Number of resolution levels.
+            profile (dict): Encoding settings.
+        """
+        if not profile.get("mode"):
+            self.encode_file(source, destination, layers, profile)
+            return
+        handle, converted = tempfile.mkstemp(prefix=".", suffix=".tif", dir=os.path.dirname(destination) or None)
+        os.close(handle)
+        try:
+            convert_tiff(source, converted, profile["mode"])
+            self.encode_file(converted, destination, layers, profile)
+        finally:
+            os.remove(converted)
+
+    def encode_file(self, source, destination, layers, profile):
+        """Encodes a TIFF file without converting it."""
+        raise NotImplementedError
+
+
+class CommandLineEncoder(Encoder):
+    """Encodes files with an OpenJPEG compatible command line tool."""
+    command = None
+    sop = None
+
+    def available(self):
+        return os.access(self.command, os.X_OK)
+
+    def options(self, layers, profile):
+        options = ["-n", str(layers), self.sop]
+        if profile["rate"]:
+            options += ["-r", str(profile["rate"])]
+        options += [
+            "-c", ",".join("[{},{}]".format(*size) for size in profile["precincts"]),
+            "-b", "{},{}".format(*profile["code_block"]),
+            "-p", profile["progression"]]
+        if profile.get("block_coder", "classic") == "ht":
+            options += ["-M", "64"]
+        return options
+
+    def encode_file(self, source, destination, layers, profile):
+        if not self.supports(profile):
+            raise Exception("{} cannot encode HTJ2K".format(self.command))
+        run_command([self.command, "-i", source, "-o", destination] +
+                    self.options(layers, profile), check=True)
+
+
+class OpenJPEGEncoder(CommandLineEncoder):
+    """Encodes files with the OpenJPEG `opj_compress` command line tool."""
+    name = "opj"
+    command = "/usr/local/bin/opj_compress"
+    sop = "-SOP"
+
+
+class GrokEncoder(CommandLineEncoder):
+    """Encodes files with the Grok `grk_compress` command line tool.
+
+    Grok can also encode HTJ2K, using the HT block coder (code block style 64).
+    """
+    name = "grok"
+    command = "/usr/local/bin/grk_compress"
+    sop = "-S"
+    block_coders = ("classic", "ht")
+
+
+class PillowEncoder(Encoder):
+    """Encodes files in process with Pillow's OpenJPEG bindings.
+
+    Pillow applies a single precinct size to every resolution level, so the
+    size for the highest level is used, and does not write SOP markers.
+    """
+    name = "pillow"
+
+    def available(self):
+        return features.check("jpg_2000")
+
+    def options(self, layers, profile):
+        options = {
+            "num_resolutions": layers,
+            "codeblock_size": tuple(profile["code_block"]),
+            "precinct_size": tuple(profile["precincts"][0]),
+            "progression": profile["progression"],
+            "irreversible": bool(profile["rate"])}
+        if profile["rate"]:
+            options.update({"quality_mode": "rates", "quality_layers": [profile["rate"]]})
+        return options
+
+    def encode(self, source, destination, layers, profile):
+        if not self.supports(profile):
+            raise Exception("Pillow cannot encode HTJ2K")
+        with Image.open(source) as img:
+            if profile.get("mode"):
+                img = img.convert(profile["mode"])
+            elif img.mode == "1":
+                img = img.convert("L")
+            img.save(destination, "JPEG2000", **self.options(layers, profile))
+
+    def encode_file(self, source, destination, layers, profile):
+        self.encode(source, destination, layers, dict(profile, mode=None))
+
+
+class StreamingEncoder(Encoder):
+    """Encodes uncompressed TIFFs a band of rows at a time with glymur.
+
+    The JP2 file is written as a grid of tiles. The rows of the source
+    needed for each row of tiles are read from its strips or tiles, which
+    are memory-mapped if they are contiguous in the file, and written to the
+    encoder tile by tile. Peak memory is proportional to the width of the
+    page rather than its area.
+    """
+    name = "streaming"
+
+    def available(self):
+        # Writing tile by tile needs glymur 0.9.4 or later, which needs Python 3.7.
+        return glymur is not None and hasattr(glymur.Jp2k, "get_tilewriters")
+
+    def options(self, layers, profile):
+        options = {
+            "numres": layers,
+            "psizes": [tuple(size) for size in profile["precincts"]],
+            "cbsize": tuple(profile["code_block"]),
+            "prog": profile["progression"],
+            "sop": True}
+        if profile["rate"]:
+            options.update({"cratios": [profile["rate"]], "irreversible": True})
+        return options
+
+    def encode(self, source, destination, layers, profile):
+        if not self.supports(profile):
+            raise Exception("glymur cannot encode HTJ2K")
+        info = probe_tiff(source)
+        if not can_stream(info):
+            raise Exception("{} is compressed or has an unsupported layout and cannot be streamed".format(source))
+        samples = info["samples_per_pixel"]
+        if profile.get("mode") == "L" and samples == 3:
+            samples = 1
+        elif profile.get("mode"):
+            raise Exception("Cannot convert {} to mode {} while streaming".format(source, profile["mode"]))
+        tile_size = self.band_rows(layers)
+        tile_height, tile_width = min(tile_size, info["height"]), min(tile_size, info["width"])
+        shape = (info["height"], info["width"]) + ((samples,) if samples > 1 else ())
+        tiles_across = -(-info["width"] // tile_width)
+        with open(source, "rb") as f:
+            if (tile_height, tile_width) == (info["height"], info["width"]):
+                glymur.Jp2k(destination, data=self._band(f, info, 0, info["height"], samples),
+                            **self.options(layers, profile))
+                return
+            jp2 = glymur.Jp2k(
+                destination, shape=shape, tilesize=(tile_height, tile_width),
+                **self.options(layers, profile))
+            for index, tile_writer in enumerate(jp2.get_tilewriters()):
+                row, column = divmod(index, tiles_across)
+                if column == 0:
+                    band = self._band(
+                        f, info, row * tile_height, min((row + 1) * tile_height, info["height"]), samples)
+                tile_writer[:] = band[:, column * tile_width:(column + 1) * tile_width]
+
+    def band_rows(self, layers):
+        """Gets the number of rows read at a time, which is also the tile size.
+
+        Tiles must have at least one pixel at the lowest resolution level.
+        """
+        return max(1024, 2 ** (layers - 1))
+
+    def _band(self, f, info, top, bottom, samples):
+        """Reads a band of rows, converting RGB to grayscale if a single sample is wanted."""
+        band = read_rows(f, info, top, bottom)
+        return band if samples > 1 else to_grayscale(band)
+
+    def encode_file(self, source, destination, layers, profile):
+        self.encode(source, destination, layers, dict(profile, mode=None))
+
+
+def can_stream(info):
+    """Checks whether a TIFF's pixels can be read directly from its strips or tiles.
+
+    Args:
+        info (dict): Result of `probe_tiff` for the TIFF.
+    Returns:
+        boolean: True if the TIFF is uncompressed, interleaved, grayscale or RGB
+            and has 8 or 16 bits per sample.
+    """
+    return (info["compression"] == 1 and
+            info["planar_configuration"] == 1 and
+            info.get("photometric") in (0, 1, 2) and
+            info["samples_per_pixel"] in (1, 3) and
+            len(set(info["bits_per_sample"])) == 1 and
+            info["bits_per_sample"][0] in (8, 16))
+
+
+def to_grayscale(rows):
+    """Converts rows of pixels to grayscale with the ITU-R 601-2 luma transform, as Pillow does.
+
+    Args:
+        rows (numpy.ndarray): Pixels with the shape (rows, width, samples),
+            where samples is 1 or 3.
+    Returns:
+        rows (numpy.ndarray): Pixels with the shape (rows, width).
+    """
+    if rows.shape[2] == 3:
+        return np.dot(rows, [0.299, 0.587, 0.114]).round().astype(rows.dtype)
+    return rows[:, :, 0]
+
+
+def convert_tiff(source, destination, mode):
+    """Converts a TIFF to another mode.
+
+    Uncompressed grayscale and RGB TIFFs are converted to grayscale a band of
+    rows at a time, so memory use is proportional to the width of the page
+    rather than its area. Other TIFFs and modes are decoded whole with Pillow.
+
+    Args:
+        source (str): Path to the TIFF file.
+        destination (str): Path at which to write the converted TIFF.
+        mode (str): Pillow image mode to convert to.
+    """
+    info = probe_tiff(source)
+    if mode != "L" or not can_stream(info):
+        with Image.open(source) as img:
+            img.convert(mode).save(destination)
+        return
+    band_rows = max(1, CONVERSION_PIXELS // info["width"])
+    with open(source, "rb") as f:
+        write_rows(destination, info["width"], info["height"], info["bits_per_sample"][0], (
+            to_grayscale(read_rows(f, info, top, min(info["height"], top + band_rows)))
+            for top in range(0, info["height"], band_rows)))
+
+
+def write_rows(destination, width, height, bits, bands):
+    """Writes a grayscale image as an uncompressed TIFF with a single strip, a band of rows at a time.
+
+    A BigTIFF is written if the pixels do not fit in a classic TIFF.
+
+    Args:
+        destination (str): Path at which to write the TIFF.
+        width (int): Pixel width.
+        height (int): Pixel height.
+        bits (int): Bits per sample, 8 or 16.
+        bands (iterable): Arrays of pixels with the shape (rows, width), from
+            the top of the image down.
+    """
+    size = width * height * bits // 8
+    big = size > 2 ** 32 - 1024
+    offset_type, offset_format = (16, "Q") if big else (4, "I")
+    tags = [(256, 4, width), (257, 4, height), (258, 3, bits), (259, 3, 1), (262, 3, 1),
+            (273, offset_type, None), (277, 3, 1), (278, 4, height), (279, offset_type, size),
+            (284, 3, 1)]
+    if big:
+        header = struct.pack("<2sHHHQ", b"II", 43, 8, 0, 16)
+        directory_size = 8 + 20 * len(tags) + 8
+    else:
+        header = struct.pack("<2sHI", b"II", 42, 8)
+        directory_size = 2 + 12 * len(tags) + 4
+    offset = len(header) + directory_size
+    entries = []
+    for tag, value_type, value in tags:
+        value = struct.pack("<" + {3: "H", 4: "I", 16: "Q"}[value_type], offset if value is None else value)
+        entries.append(struct.pack("<HH" + offset_format, tag, value_type, 1) +
+                       value.ljust(struct.calcsize(offset_format), b"\0"))
+    dtype = np.dtype("<u{}".format(bits // 8))
+    with open(destination, "wb") as f:
+        f.write(header + struct.pack("<" + ("Q" if big else "H"), len(tags)) + b"".join(entries) +
+                struct.pack("<" + offset_format, 0))
+        for band in bands:
+            f.write(band.astype(dtype, copy=False).tobytes())
+
+
+def read_rows(f, info, top, bottom):
+    """Reads a band of rows from an uncompressed TIFF.
+
+    Args:
+        f (file): The TIFF file, opened in binary mode.
+        info (dict): Result of `probe_tiff` for the TIFF.
+        top (int): First row to read.
+        bottom (int): Row after the last row to read.
+    Returns:
+        rows (numpy.ndarray): Pixels with the shape (rows, width, samples).
+    """
+    width, samples = info["width"], info["samples_per_pixel"]
+    dtype = np.dtype("{}u{}".format(info["byte_order"], info["bits_per_sample"][0] // 8))
+    rows = np.empty((bottom - top, width, samples), dtype=dtype)
+    if "tile_offsets" in info:
+        tile_width, tile_length = info["tile_width"], info["tile_length"]
+        tiles_across = -(-width // tile_width)
+        for tile_row in range(top // tile_length, (bottom - 1) // tile_length + 1):
+            tile_top = tile_row * tile_length
+            first, last = max(top, tile_top), min(bottom, tile_top + tile_length)
+            for column in range(tiles_across):
+                index = tile_row * tiles_across + column
+                f.seek(info["tile_offsets"][index])
+                tile = np.frombuffer(
+                    f.read(tile_length * tile_width * samples * dtype.itemsize),
+                    dtype=dtype).reshape(tile_length, tile_width, samples)
+                left = column * tile_width
+                right = min(width, left + tile_width)
+                rows[first - top:last - top, left:right] = tile[
+                    first - tile_top:last - tile_top, :right - left]
+    else:
+        rows_per_strip = info["rows_per_strip"]
+        first, last = top // rows_per_strip, (bottom - 1) // rows_per_strip
+        offsets = info["strip_offsets"][first:last + 1]
+        counts = info["strip_byte_counts"][first:last + 1]
+        row_bytes = width * samples * dtype.itemsize
+        if all(offsets[i] + counts[i] == offsets[i + 1] for i in range(len(offsets) - 1)):
+            strip_rows = min(info["height"], (last + 1) * rows_per_strip) - first * rows_per_strip
+            mapped = np.memmap(f, dtype=dtype, mode="r", offset=offsets[0],
+                               shape=(strip_rows, width, samples))
+            start = top - first * rows_per_strip
+            rows[:] = mapped[start:start + bottom - top]
+            del mapped
+        else:
+            for strip, offset in enumerate(offsets, start=first):
+                strip_top = strip * rows_per_strip
+                strip_bottom = min(info["height"], strip_top + rows_per_strip)
+                f.seek(offset)
+                pixels = np.frombuffer(
+                    f.read((strip_bottom - strip_top) * row_bytes),
+                    dtype=dtype).reshape(-1, width, samples)
+                lower, upper = max(top, strip_top), min(bottom, strip_bottom)
+                rows[lower - top:upper - top] = pixels[lower - strip_top:upper - strip_top]
+    if info.get("photometric") == 0:
+        rows = np.iinfo(dtype).max - rows
+    return rows
+
+
+ENCODERS = {encoder.name: encoder for encoder in [
+    OpenJPEGEncoder, GrokEncoder, PillowEncoder, StreamingEncoder]}
+
+
+def get_encoder(name):
+    """Gets an encoder by name.
+
+    Args:
+        name (str): Name of the encoder, one of the keys of `ENCODERS`.
+    Returns:
+        encoder (Encoder): The encoder.
+    """
+    if name not in ENCODERS:
+        raise Exception(
+            "Unknown JPEG2000 encoder {}, expected one of {}".format(name, ", ".join(ENCODERS)))
+    encoder = ENCODERS[name]()
+    if not encoder.available():
+        raise Exception("JPEG2000 encoder {} is not available on this host".format(name))
+    return encoder
+
+
+def benchmark_encoders(pages, output_dir, profile):
+    """Encodes the same pages with every available encoder.
+
+    Each encoder is run in a new process, so that its peak memory use is not
+    affected by the other encoders. Encoders which cannot apply the profile
+    are skipped.
+
+    Args:
+        pages (list): A record for each page, with the path to its source
+            TIFF and its number of layers.
+        output_dir (str): Directory in which to create JP2 files.
+        profile (dict): Encoding settings.
+    Returns:
+        results (list): Results of `benchmark_encoder` for each available encoder.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name, encoder in ENCODERS.items():
+        if not (encoder().available() and encoder().supports(profile)):
+            continue
+        with context.Pool(1) as pool:
+            results.append(pool.apply(benchmark_encoder, (name, pages, output_dir, profile)))
+    return results
+
+
+def benchmark_encoder(name, pages, output_dir, profile):
+    """Encodes pages one at a time with an encoder and measures its performance.
+
+    Args:
+        name (str): Name of the encoder.
+        pages (list): A record for each page, with the path to its source
+            TIFF and its number of layers.
+        output_dir (str): Directory in which to create JP2 files, which are
+            removed once they have been measured.
+        profile (dict): Encoding settings.
+    Returns:
+        result (dict): Pages and megabytes of source TIFF encoded per second,
+            peak resident memory of the process and any encoder subprocesses
+            in megabytes, and total size of the JP2 files in bytes.
+    """
+    encoder = ENCODERS[name]()
+    directory = os.path.join(output_dir, name)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    source_bytes = 0
+    output_bytes = 0
+    start = time.time()
+    for page in pages:
+        destination = os.path.join(
+            directory, "{}.jp2".format(os.path.splitext(os.path.basename(page["source"]))[0]))
+        encoder.encode(page["source"], destination, page["layers"], profile)
+        source_bytes += os.path.getsize(page["source"])
+        output_bytes += os.path.getsize(destination)
+    seconds = time.time() - start
+    shutil.rmtree(directory)
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {
+        "encoder": name,
+        "pages": len(pages),
+        "seconds": seconds,
+        "pages_per_second": len(pages) / seconds if seconds else 0,
+        "mb_per_second": source_bytes / 1024 / 1024 / seconds if seconds else 0,
+        "peak_rss": peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024),
+        "output_bytes": output_bytes}
@@ -0,0 +1,520 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import socket
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+COUNTS = ["bytes_in", "bytes_out", "pages"]
+
+_sinks = []
+_local = threading.local()
+
+
+class Span:
+    def __init__(self, name, labels=None, details=None, parent=None):
+        """A timed unit of work, such as encoding a page or uploading a file.
+
+        Args:
+            name (str): Name of the kind of work.
+            labels (dict): Values which spans are grouped by in metrics, such
+                as the encoder. These should have few distinct values.
+            details (dict): Other values describing this piece of work, such
+                as the ref_id of the object.
+            parent (Span): Span in which this span started, which may be
+                running on another thread.
+        """
+        self.name = name
+        self.labels = labels or {}
+        self.details = details or {}
+        self.parent = parent
+        self.thread = threading.current_thread()
+        self.start = time.time()
+        self.wall_seconds = 0
+        self.cpu_seconds = 0
+        self.failed = False
+        self.counts = dict.fromkeys(COUNTS, 0)
+        self.detached = False
+        self._clock = time.perf_counter()
+        self._cpu = _thread_time()
+
+    def add(self, **counts):
+        """Adds to the bytes read and written, or pages processed, by the span.
+
+        Args:
+            counts: Amounts to add, keyed by one of `COUNTS`.
+        """
+        for key, value in counts.items():
+            self.counts[key] += value
+
+    def add_cpu(self, seconds):
+        """Adds CPU time used outside the span's thread, such as by a subprocess.
+
+        The time is also added to the spans which enclose this one on the
+        same thread, so that the CPU time of a span always includes that of
+        the spans within it.
+
+        Args:
+            seconds (float): CPU seconds to add.
+        """
+        span = self
+        while span and span.thread is self.thread:
+            span.cpu_seconds += seconds
+            span = span.parent
+
+    def finish(self):
+        """Records the elapsed wall and CPU time.
+
+        The CPU time of a detached span, which may finish on another thread,
+        is not recorded.
+        """
+        self.wall_seconds = time.perf_counter() - self._clock
+        if not self.detached:
+            self.cpu_seconds += _thread_time() - self._cpu
+
+    def context(self):
+        """Gets the details of this span and every span enclosing it.
+
+        Returns:
+            details (dict): Details of the spans, with those of inner spans
+                taking precedence.
+        """
+        details = {}
+        span = self
+        while span:
+            details = dict(span.details, **details)
+            span = span.parent
+        return details
+
+
+class _NullSpan:
+    def __init__(self):
+        """Stands in for a span while no sink is added, so that untimed work is not slowed down."""
+        self.labels = {}
+        self.details = {}
+        self.parent = None
+        self.thread = None
+
+    def add(self, **counts):
+        pass
+
+    def add_cpu(self, seconds):
+        pass
+
+
+def _thread_time():
+    """Gets the CPU time of the current thread, as `time.thread_time` does from Python 3.7."""
+    return time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+
+
+def add_sink(sink):
+    """Sends spans to a sink.
+
+    A sink has `start` and `finish` methods, which are called with each span
+    as it starts and finishes. Spans are only timed while a sink is added.
+
+    Args:
+        sink: The sink to add.
+    """
+    _sinks.append(sink)
+
+
+def remove_sink(sink):
+    """Stops sending spans to a sink.
+
+    Args:
+        sink: The sink to remove.
+    """
+    _sinks.remove(sink)
+
+
+def current_span():
+    """Gets the innermost span running on the current thread, if any."""
+    return getattr(_local, "span", None)
+
+
+@contextmanager
+def activate(parent):
+    """Runs a block as if it were within a span, which may be running on another thread.
+
+    Spans started in the block are enclosed by the span, so work handed to a
+    pool of threads can be attributed to the stage and object it is part of.
+
+    Args:
+        parent (Span): The enclosing span, or None.
+    """
+    previous = current_span()
+    _local.span = parent
+    try:
+        yield parent
+    finally:
+        _local.span = previous
+
+
+def in_current_span(func):
+    """Wraps a function so that it runs within the span which is current now.
+
+    Args:
+        func (callable): A function which will be called on another thread.
+    Returns:
+        func (callable): The wrapped function.
+    """
+    parent = current_span()
+
+    def run_in_span(*args, **kwargs):
+        with activate(parent):
+            return func(*args, **kwargs)
+    return run_in_span
+
+
+def open_span(name, labels=None, **details):
+    """Starts a span which is not tied to a block or a thread, such as an object.
+
+    Args:
+        name (str): Name of the kind of work.
+        labels (dict): Values which spans are grouped by in metrics.
+        details: Other values describing this piece of work.
+    Returns:
+        span (Span): The started span, which must be passed to `close_span`.
+    """
+    if not _sinks:
+        return _NullSpan()
+    current = Span(name, labels, details)
+    current.detached = True
+    for sink in list(_sinks):
+        sink.start(current)
+    return current
+
+
+def close_span(current, failed=False):
+    """Finishes a span started by `open_span`.
+
+    Args:
+        current (Span): The span.
+        failed (bool): Flag indicating the work failed.
+    """
+    if isinstance(current, _NullSpan):
+        return
+    current.failed = failed
+    current.finish()
+    for sink in list(_sinks):
+        sink.finish(current)
+
+
+@contextmanager
+def span(name, labels=None, **details):
+    """Times a block of work and sends it to every sink.
+
+    Args:
+        name (str): Name of the kind of work.
+        labels (dict): Values which spans are grouped by in metrics.
+        details: Other values describing this piece of work.
+    Yields:
+        span (Span): The running span, to which counts can be added.
+    """
+    sinks = list(_sinks)
+    if not sinks:
+        yield _NullSpan()
+        return
+    previous = current_span()
+    current = Span(name, labels, details, previous)
+    _local.span = current
+    for sink in sinks:
+        sink.start(current)
+    try:
+        yield current
+    except BaseException:
+        current.failed = True
+        raise
+    finally:
+        current.finish()
+        _local.span = previous
+        for sink in sinks:
+            sink.finish(current)
+
+
+def run_command(args, check=False, **kwargs):
+    """Runs a command in a span, including the CPU time of the command in it.
+
+    Behaves like `subprocess.run`, except that only stderr may be piped.
+
+    Args:
+        args (list): The command and its arguments.
+        check (bool): Raise CalledProcessError if the command fails.
+        kwargs: Other arguments passed to `subprocess.Popen`.
+    Returns:
+        result (CompletedProcess): The return code and any stderr of the command.
+    """
+    with span("command", {"command": os.path.basename(args[0])}) as current:
+        process = subprocess.Popen(args, **kwargs)
+        stderr = process.stderr.read() if process.stderr else None
+        if process.stderr:
+            process.stderr.close()
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        current.add_cpu(usage.ru_utime + usage.ru_stime)
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args, stderr=stderr)
+    return subprocess.CompletedProcess(args, process.returncode, None, stderr)
+
+
+class MetricsSink:
+    def __init__(self):
+        """Totals the wall time, CPU time, bytes and pages of spans.
+
+        Spans are totalled by name and labels.
+        """
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.totals = {}
+
+    def start(self, span):
+        pass
+
+    def finish(self, span):
+        key = (span.name, tuple(sorted(span.labels.items())))
+        with self.lock:
+            totals = self.totals.setdefault(key, dict(
+                {"count": 0, "errors": 0, "wall_seconds": 0, "cpu_seconds": 0}, **dict.fromkeys(COUNTS, 0)))
+            totals["count"] += 1
+            totals["errors"] += int(span.failed)
+            totals["wall_seconds"] += span.wall_seconds
+            totals["cpu_seconds"] += span.cpu_seconds
+            for count in COUNTS:
+                totals[count] += span.counts[count]
+
+    def summary(self):
+        """Summarizes the spans recorded so far.
+
+        Returns:
+            summary (dict): The host, start and end times of the run, and the
+                totals and throughput of each kind of span.
+        """
+        finished = time.time()
+        spans = []
+        with self.lock:
+            for (name, labels), totals in sorted(self.totals.items()):
+                wall = totals["wall_seconds"]
+                spans.append(dict(
+                    totals, span=name, labels=dict(labels),
+                    pages_per_second=totals["pages"] / wall if wall else 0,
+                    mb_per_second=(totals["bytes_in"] + totals["bytes_out"]) / wall / 1024 / 1024 if wall else 0))
+        return {"host": socket.gethostname(), "started": self.started, "finished": finished,
+                "elapsed_seconds": finished - self.started, "spans": spans}
+
+    def write_summary(self, path):
+        """Writes a JSON summary of the run.
+
+        Args:
+            path (str): Path of the JSON file.
+        """
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+    def write_prometheus(self, path):
+        """Writes the totals in the Prometheus text format.
+
+        The file is replaced atomically, so it can be read by the textfile
+        collector of the Prometheus node exporter at any time.
+
+        Args:
+            path (str): Path of the file, which should end in `.prom`.
+        """
+        summary = self.summary()
+        lines = []
+        for metric, key, description in [
+                ("count", "count", "Number of spans"),
+                ("errors", "errors", "Number of spans which raised an exception"),
+                ("wall_seconds", "wall_seconds", "Wall time of spans"),
+                ("cpu_seconds", "cpu_seconds", "CPU time of spans, including the commands they ran"),
+                ("bytes_in", "bytes_in", "Bytes read by spans"),
+                ("bytes_out", "bytes_out", "Bytes written by spans"),
+                ("pages", "pages", "Pages processed by spans")]:
+            lines.append("# HELP iiif_pipeline_span_{} {} in the last run.".format(metric, description))
+            lines.append("# TYPE iiif_pipeline_span_{} gauge".format(metric))
+            for totals in summary["spans"]:
+                labels = dict(totals["labels"], span=totals["span"], host=summary["host"])
+                lines.append("iiif_pipeline_span_{}{{{}}} {}".format(metric, ",".join(
+                    '{}="{}"'.format(name, _escape(value)) for name, value in sorted(labels.items())), totals[key]))
+        for metric, value, description in [
+                ("last_run_timestamp_seconds", summary["finished"], "Time at which the last run finished"),
+                ("last_run_seconds", summary["elapsed_seconds"], "Elapsed time of the last run")]:
+            lines.append("# HELP iiif_pipeline_{} {}.".format(metric, description))
+            lines.append("# TYPE iiif_pipeline_{} gauge".format(metric))
+            lines.append('iiif_pipeline_{}{{host="{}"}} {}'.format(metric, _escape(summary["host"]), value))
+        with open("{}.tmp".format(path), "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace("{}.tmp".format(path), path)
+
+
+class TraceSink:
+    def __init__(self):
+        """Records spans as a timeline in the Chrome trace event format.
+
+        Spans which run within a block are shown on the thread which ran them,
+        and detached spans, such as objects, are shown as asynchronous tracks.
+        Each event is tagged with the details of its span and every span
+        enclosing it, such as the ref_id and identifier of the object. Traces
+        can be viewed with Perfetto or `chrome://tracing`.
+        """
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.events = []
+        self.threads = {}
+        self.ids = {}
+
+    def start(self, span):
+        if span.detached:
+            self._add_async(span, "b", span.start)
+
+    def finish(self, span):
+        if span.detached:
+            self._add_async(span, "e", span.start + span.wall_seconds)
+            return
+        self._add(span, {"ph": "X", "ts": self._timestamp(span.start),
+                         "dur": round(span.wall_seconds * 1000000)})
+
+    def write(self, path):
+        """Writes the trace as JSON.
+
+        Args:
+            path (str): Path of the trace file.
+        """
+        with self.lock:
+            events = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                       "args": {"name": name}} for tid, name in self.threads.items()] + self.events
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def _add_async(self, span, phase, timestamp):
+        with self.lock:
+            span_id = self.ids.setdefault(id(span), len(self.ids) + 1)
+        self._add(span, {"ph": phase, "ts": self._timestamp(timestamp), "id": span_id})
+
+    def _add(self, span, event):
+        args = dict(span.context(), **span.counts)
+        args.update(span.labels)
+        if span.failed:
+            args["failed"] = True
+        event.update({
+            "name": _trace_name(span), "cat": span.name, "pid": os.getpid(),
+            "tid": span.thread.ident, "args": {key: str(value) for key, value in args.items()}})
+        with self.lock:
+            self.threads[span.thread.ident] = span.thread.name
+            self.events.append(event)
+
+    def _timestamp(self, timestamp):
+        return round((timestamp - self.started) * 1000000)
+
+
+class ProfileSink:
+    def __init__(self, directory, limit=50):
+        """Profiles the Python code run by spans with cProfile.
+
+        A profiler is started by each span which starts on a thread without a
+        running profiler, such as a stage or a page encoded on a worker thread,
+        and covers every span within it on that thread. Profiles are combined
+        for each stage, for each object and for the whole run. The report for
+        an object is written when it finishes, and the others by `write`.
+
+        Only one profiler can run at a time from Python 3.12, so on those
+        versions spans which start while another thread is being profiled are
+        not profiled.
+
+        Args:
+            directory (str): Directory in which to write reports.
+            limit (int): Number of functions listed in each report.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stages = {}
+        self.objects = {}
+        self.run = None
+        self.skipped = 0
+
+    def start(self, span):
+        if span.detached or getattr(self.local, "span", None):
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            with self.lock:
+                self.skipped += 1
+            return
+        self.local.span = span
+        self.local.profiler = profiler
+
+    def finish(self, span):
+        if span.detached:
+            if span.name == "object":
+                with self.lock:
+                    stats = self.objects.pop(span.details["ref_id"], None)
+                if stats:
+                    self._write(stats, "object_{}".format(span.details["ref_id"]))
+            return
+        if getattr(self.local, "span", None) is not span:
+            return
+        self.local.profiler.disable()
+        profiler = self.local.profiler
+        self.local.span = self.local.profiler = None
+        stage = span.labels.get("stage")
+        parent = span.parent
+        while parent and not stage:
+            stage = parent.labels.get("stage")
+            parent = parent.parent
+        ref_id = span.context().get("ref_id")
+        with self.lock:
+            for stats, key in [(self.stages, stage or span.name), (self.objects, ref_id)]:
+                if key:
+                    stats[key] = self._add(stats.get(key), profiler)
+            self.run = self._add(self.run, profiler)
+
+    def write(self):
+        """Writes reports for each stage, for the whole run and for any unfinished objects."""
+        with self.lock:
+            reports = [(stats, "stage_{}".format(stage)) for stage, stats in self.stages.items()]
+            reports += [(stats, "object_{}".format(ref_id)) for ref_id, stats in self.objects.items()]
+            if self.run:
+                reports.append((self.run, "run"))
+        for stats, name in reports:
+            self._write(stats, name)
+
+    def _add(self, stats, profiler):
+        if stats is None:
+            return pstats.Stats(profiler)
+        stats.add(profiler)
+        return stats
+
+    def _write(self, stats, name):
+        """Writes profile data, and a report of the hottest functions by own and cumulative time."""
+        path = os.path.join(self.directory, name)
+        stats.dump_stats("{}.prof".format(path))
+        report = io.StringIO()
+        stats.stream = report
+        for sort in ["tottime", "cumulative"]:
+            report.write("Sorted by {}\n".format(sort))
+            stats.sort_stats(sort).print_stats(self.limit)
+        with open("{}.txt".format(path), "w") as f:
+            f.write(report.getvalue())
+
+
+def _trace_name(span):
+    """Names a span in a trace, including its labels."""
+    if not span.labels:
+        return span.name
+    return "{} ({})".format(span.name, ", ".join(
+        "{}={}".format(name, value) for name, value in sorted(span.labels.items())))
+
+
+def _escape(value):
+    """Escapes a Prometheus label value."""
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -0,0 +1,178 @@
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+
+class Journal:
+    def __init__(self, path, read_only=False):
+        """A persistent record of the steps and pages completed for each object,
+        and of the analysis of each page.
+
+        Args:
+            path (str): Path to the SQLite database file used to store the journal.
+            read_only (bool): Open an existing journal without creating or
+                changing it.
+        """
+        self.lock = threading.Lock()
+        if read_only:
+            self.connection = sqlite3.connect(
+                "{}?mode=ro".format(pathlib.Path(path).absolute().as_uri()), uri=True, check_same_thread=False)
+            return
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS steps (ref_id TEXT, identifier TEXT, step TEXT, completed REAL, PRIMARY KEY (ref_id, step))")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS pages (ref_id TEXT, identifier TEXT, page TEXT, completed REAL, PRIMARY KEY (ref_id, page))")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS analysis (ref_id TEXT, page TEXT, analysis TEXT, PRIMARY KEY (ref_id, page))")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS throughput (host TEXT, stage TEXT, pages INTEGER, pixels INTEGER, seconds REAL, recorded REAL)")
+
+    def complete_step(self, ref_id, identifier, step):
+        """Records that a step has been completed for an object.
+
+        Args:
+            ref_id (str): ArchivesSpace refid of the object.
+            identifier (str): Identifier of the object's derivatives.
+            step (str): Name of the completed step.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO steps (ref_id, identifier, step, completed) VALUES (?, ?, ?, ?)",
+                (ref_id, identifier, step, time.time()))
+
+    def complete_page(self, ref_id, identifier, page):
+        """Records that a page has been encoded for an object.
+
+        Args:
+            ref_id (str): ArchivesSpace refid of the object.
+            identifier (str): Identifier of the object's derivatives.
+            page (str): Page number of the encoded page.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO pages (ref_id, identifier, page, completed) VALUES (?, ?, ?, ?)",
+                (ref_id, identifier, page, time.time()))
+
+    def record_analysis(self, ref_id, analyses):
+        """Records the analysis of an object's pages.
+
+        Args:
+            ref_id (str): ArchivesSpace refid of the object.
+            analyses (dict): Results of `analyze_page`, keyed by page number.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO analysis (ref_id, page, analysis) VALUES (?, ?, ?)",
+                [(ref_id, page, json.dumps(analysis)) for page, analysis in analyses.items()])
+
+    def record_throughput(self, host, stage, pages, pixels, seconds):
+        """Records how long a stage took to process an object.
+
+        Args:
+            host (str): Name of the host which processed the object.
+            stage (str): Name of the stage.
+            pages (int): Number of pages in the object.
+            pixels (int): Number of pixels in the object's source images.
+            seconds (float): Elapsed time.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO throughput (host, stage, pages, pixels, seconds, recorded) VALUES (?, ?, ?, ?, ?, ?)",
+                (host, stage, pages, pixels, seconds, time.time()))
+
+    def throughput(self, host, limit=100):
+        """Summarizes the throughput of each stage in recent runs on a host.
+
+        Args:
+            host (str): Name of the host.
+            limit (int): Number of most recent objects to summarize for each stage.
+        Returns:
+            throughput (dict): Total objects, pages, pixels and seconds, keyed by stage.
+        """
+        with self.lock:
+            stages = [row[0] for row in self.connection.execute(
+                "SELECT DISTINCT stage FROM throughput WHERE host = ?", (host,))]
+            throughput = {}
+            for stage in stages:
+                objects, pages, pixels, seconds = self.connection.execute(
+                    "SELECT COUNT(*), SUM(pages), SUM(pixels), SUM(seconds) FROM (SELECT * FROM throughput "
+                    "WHERE host = ? AND stage = ? ORDER BY recorded DESC, rowid DESC LIMIT ?)", (host, stage, limit)).fetchone()
+                throughput[stage] = {"objects": objects, "pages": pages, "pixels": pixels, "seconds": seconds}
+        return throughput
+
+    def completed_steps(self, ref_id):
+        """Gets the steps completed for an object.
+
+        Args:
+            ref_id (str): ArchivesSpace refid of the object.
+        Returns:
+            steps (set): Names of the completed steps.
+        """
+        with self.lock:
+            return set(row[0] for row in self.connection.execute(
+                "SELECT step FROM steps WHERE ref_id = ?", (ref_id,)))
+
+    def completed_pages(self, ref_id):
+        """Gets the pages encoded for an object.
+
+        Args:
+            ref_id (str): ArchivesSpace refid of the object.
+        Returns:
+            pages (set): Page numbers of the encoded pages.
+        """
+        with self.lock:
+            return set(row[0] for row in self.connection.execute(
+                "SELECT page FROM pages WHERE ref_id = ?", (ref_id,)))
+
+    def page_analysis(self, ref_id):
+        """Gets the recorded analysis of an object's pages.
+
+        Args:
+            ref_id (str): ArchivesSpace refid of the object.
+        Returns:
+            analyses (dict): Results of `analyze_page`, keyed by page number.
+        """
+        with self.lock:
+            return {page: json.loads(analysis) for page, analysis in self.connection.execute(
+                "SELECT page, analysis FROM analysis WHERE ref_id = ?", (ref_id,))}
+
+    def reset(self, ref_id):
+        """Removes all records for an object.
+
+        Args:
+            ref_id (str): ArchivesSpace refid of the object.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM steps WHERE ref_id = ?", (ref_id,))
+            self.connection.execute("DELETE FROM pages WHERE ref_id = ?", (ref_id,))
+            self.connection.execute("DELETE FROM analysis WHERE ref_id = ?", (ref_id,))
+
+    def status(self):
+        """Summarizes the progress of every object in the journal.
+
+        Returns:
+            status (list): A dict for each object with its ref_id, identifier,
+                completed steps, number of encoded pages and time of the last update.
+        """
+        with self.lock:
+            objects = {}
+            for ref_id, identifier, step, completed in self.connection.execute(
+                    "SELECT ref_id, identifier, step, completed FROM steps ORDER BY completed"):
+                obj = objects.setdefault(
+                    ref_id, {"ref_id": ref_id, "identifier": identifier, "steps": [], "pages": 0, "updated": 0})
+                obj["steps"].append(step)
+                obj["updated"] = max(obj["updated"], completed)
+            for ref_id, identifier, pages, completed in self.connection.execute(
+                    "SELECT ref_id, identifier, COUNT(page), MAX(completed) FROM pages GROUP BY ref_id, identifier"):
+                obj = objects.setdefault(
+                    ref_id, {"ref_id": ref_id, "identifier": identifier, "steps": [], "pages": 0, "updated": 0})
+                obj["pages"] = pages
+                obj["updated"] = max(obj["updated"], completed)
+        return sorted(objects.values(), key=lambda obj: obj["updated"])
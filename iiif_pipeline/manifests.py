@@ -3,7 +3,8 @@ import os
 
 from iiif_prezi.factory import ManifestFactory
 from iiif_prezi_upgrader import Upgrader
-from PIL import Image
+
+from .probe import probe_jp2
 
 THUMBNAIL_HEIGHT = 200
 THUMBNAIL_WIDTH = 200
@@ -23,7 +24,7 @@ class ManifestMaker:
         self.upgrader = Upgrader()
 
     def create_manifest(self, files, image_dir, identifier,
-                        obj_data, replace=False):
+                        obj_data, replace=False, pages=None):
         """Method that runs the other methods to build a manifest file and populate
         it with information.
 
@@ -33,12 +34,16 @@ class ManifestMaker:
             identifier (str): A unique identifier.
             obj_data (dict): Data about the archival object.
             replace (bool): Replace existing files.
+            pages (list): Page records returned by `create_jp2`. Image dimensions
+                are read from these records instead of from the image files.
         """
         manifest_path = "{}.json".format(
             os.path.join(self.manifest_dir, identifier))
         if (os.path.isfile(manifest_path) and not replace):
             raise FileExistsError(
                 "Error creating manifest: {} already exists".format(manifest_path))
+        dimensions = {os.path.basename(page["derivative"]): (page["width"], page["height"])
+                      for page in pages or []}
         page_number = 1
         manifest = self.fac.manifest(ident=identifier, label=obj_data["title"])
         manifest.set_metadata({"Date": obj_data["dates"]})
@@ -46,7 +51,7 @@ class ManifestMaker:
         sequence = manifest.sequence(ident="{}.json".format(identifier))
         for file in files:
             page_ref = os.path.splitext(file)[0]
-            width, height = self.get_image_info(image_dir, file)
+            width, height = dimensions.get(file) or self.get_image_info(image_dir, file)
             canvas = sequence.canvas(
                 ident=page_ref,
                 label="Page {}".format(
@@ -66,6 +71,8 @@ class ManifestMaker:
     def get_image_info(self, image_dir, file):
         """Gets information about the image file.
 
+        Only the headers of the image file are read.
+
         Args:
             image_dir (str): path to the directory containing the image file
             file (str): filename of the image file
@@ -73,9 +80,8 @@ class ManifestMaker:
             width (int): Pixel width of the image file
             height (int): Pixel height of the image file
         """
-        with Image.open(os.path.join(image_dir, file)) as img:
-            width, height = img.size
-        return width, height
+        info = probe_jp2(os.path.join(image_dir, file))
+        return info["width"], info["height"]
 
     def set_image_data(self, img, height, width, ref):
         """Sets the image height and width. Creates the image object.
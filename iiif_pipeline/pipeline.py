@@ -1,13 +1,32 @@
 import logging
 import os
+import socket
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from configparser import ConfigParser
+from functools import partial
 
 import shortuuid
 
+from .analysis import analyze_pages
+from .cache import DerivativeCache, MetadataCache
 from .clients import ArchivesSpaceClient, AWSClient
-from .derivatives import compress_pdf, create_jp2, create_pdf, ocr_pdf
-from .helpers import cleanup_dir, cleanup_files, matching_files, refid_dirs
+from .derivatives import (DERIVATIVE_FORMATS, ENCODING_PROFILES,
+                          PDF_MAX_PIXELS, create_access_pdf, create_jp2,
+                          layers_for_dimensions)
+from .encoders import benchmark_encoders, get_encoder
+from .helpers import (cleanup_dir, cleanup_files, get_page_number,
+                      matching_files, refid_dirs)
+from .instrumentation import (MetricsSink, ProfileSink, TraceSink, activate,
+                              add_sink, close_span, open_span, remove_sink,
+                              span)
+from .journal import Journal
 from .manifests import ManifestMaker
+from .planner import (STAGES, estimate_batch, estimate_seconds, find_conflicts,
+                      plan_object)
+from .probe import probe_files, probe_tiff
+from .scheduling import MemoryBudget, estimate_makespan, plan_jobs
+from .stages import Stage, run_stages
 
 
 class IIIFPipeline:
@@ -20,88 +39,607 @@ class IIIFPipeline:
         self.config = ConfigParser()
         self.config.read("local_settings.cfg")
 
-    def run(self, source_dir, target_dir, skip, replace, cleanup_source):
+    def run(self, source_dir, target_dir, skip, replace, cleanup_source,
+            bypass_cache=False, resume=False, restart=False, priority=None,
+            metrics_dir=None, trace_path=None, profile_dir=None):
         """Instantiates and runs derivative creation, manifest creation, and AWS upload files.
 
+        Objects are passed through a series of stages (ArchivesSpace lookup,
+        image derivatives and manifest, PDF derivatives, upload), each with its
+        own pool of workers, so that different objects can be in different
+        stages at the same time.
+
+        If a journal is configured, each completed step and encoded page is
+        recorded in it, and the derivatives and journal of objects which fail
+        are kept unless restarting or replacing. When resuming, steps and pages
+        already recorded are skipped.
+
+        Objects start in order of the pixel volume of their source images,
+        largest first, so that the batch does not end with one large object
+        running on its own.
+
         Args:
             source_dir (str): A directory containing subdirectories (named using ref ids) for archival objects.
             skip (bool): Flag to should skip files ending with `_001`.
             replace (bool): Flag to replace existing files.
+            bypass_cache (bool): Flag to ignore cached data and derivatives, which are refreshed instead.
+            resume (bool): Flag to continue objects from the first step not completed in an earlier run.
+            restart (bool): Flag to discard progress and local derivatives from earlier runs.
+            priority (list): ref_ids of objects to start before all others, in order.
+            metrics_dir (str): Directory in which to write the time, bytes and
+                pages of each stage, as a Prometheus textfile and a JSON summary.
+            trace_path (str): Path at which to write a timeline of every object,
+                stage, page, command and S3 request in the Chrome trace event format.
+            profile_dir (str): Directory in which to write cProfile reports of
+                the Python code run for each stage, each object and the whole run.
         """
         if not os.path.isdir(source_dir):
             raise Exception(
                 "{} is not a path to a directory.".format(source_dir))
-        as_client = ArchivesSpaceClient(
+        self.source_dir = source_dir
+        self.skip = skip
+        self.replace = replace
+        self.cleanup_source = cleanup_source
+        self.resume = resume
+        self.restart = restart
+        self.journal = self.get_journal()
+        cache_dir = self.config.get("Cache", "directory", fallback=None)
+        self.derivative_cache = DerivativeCache(
+            os.path.join(cache_dir, "derivatives"),
+            self.config.getint("Cache", "derivative_cache_size", fallback=10240) * 1024 * 1024,
+            bypass=bypass_cache) if cache_dir else None
+        self.ocr_cache = DerivativeCache(
+            os.path.join(cache_dir, "ocr"),
+            self.config.getint("Cache", "ocr_cache_size", fallback=1024) * 1024 * 1024,
+            bypass=bypass_cache) if cache_dir else None
+        memory_budget = self.config.getint("Pipeline", "memory_budget", fallback=None)
+        self.memory_budget = MemoryBudget(memory_budget * 1024 * 1024 if memory_budget else None)
+        self.encoder = get_encoder(self.config.get("Derivatives", "encoder", fallback="opj"))
+        self.derivative_format = self.config.get("Derivatives", "format", fallback="jp2")
+        if not self.encoder.supports(DERIVATIVE_FORMATS.get(self.derivative_format, {})):
+            raise Exception("JPEG2000 encoder {} cannot create {} derivatives".format(
+                self.encoder.name, self.derivative_format))
+        metadata_cache = self.get_clients(bypass_cache)
+        self.jp2_dir = os.path.join(target_dir, "images")
+        self.pdf_dir = os.path.join(target_dir, "pdfs")
+        self.manifest_dir = os.path.join(target_dir, "manifests")
+        for path in [self.jp2_dir, self.pdf_dir, self.manifest_dir]:
+            if not os.path.exists(path):
+                os.makedirs(path)
+        object_dirs = refid_dirs(
+            source_dir, [self.jp2_dir, self.pdf_dir, self.manifest_dir])
+        jobs = [{"directory": directory,
+                 "ref_id": directory.split('/')[-1],
+                 "identifier": None} for directory in object_dirs]
+        metrics = MetricsSink() if metrics_dir else None
+        trace = TraceSink() if trace_path else None
+        profile = ProfileSink(profile_dir) if profile_dir else None
+        for sink in [metrics, trace, profile]:
+            if sink:
+                add_sink(sink)
+        try:
+            self.lookups = self.prefetch_metadata(jobs)
+            listed = jobs
+            jobs = plan_jobs(
+                jobs, skip, priority,
+                self.config.getint("Pipeline", "planning_workers", fallback=4))
+            logging.info("Processing order: {}".format(", ".join(
+                "{} ({:.0f} MP)".format(job["ref_id"], job["volume"]["pixels"] / 1000000) for job in jobs)))
+            image_workers = self.config.getint("Pipeline", "image_workers", fallback=1)
+            logging.info(
+                "Planned image derivatives: {:.0f} MP on the busiest of {} workers, {:.0f} MP in listed order".format(
+                    estimate_makespan(jobs, image_workers) / 1000000, image_workers,
+                    estimate_makespan(listed, image_workers) / 1000000))
+            run_stages(
+                jobs,
+                [Stage("metadata", self.timed("metadata", self.get_metadata),
+                       self.config.getint("Pipeline", "metadata_workers", fallback=1)),
+                 Stage("images", self.timed("images", self.create_image_derivatives),
+                       self.config.getint("Pipeline", "image_workers", fallback=1)),
+                 Stage("pdfs", self.timed("pdfs", self.create_pdf_derivatives),
+                       self.config.getint("Pipeline", "pdf_workers", fallback=1)),
+                 Stage("upload", self.timed("upload", self.upload),
+                       self.config.getint("Pipeline", "upload_workers", fallback=1))],
+                self.handle_error,
+                self.config.getint("Pipeline", "queue_size", fallback=1))
+        finally:
+            for sink in [metrics, trace, profile]:
+                if sink:
+                    remove_sink(sink)
+            if metrics:
+                self.write_metrics(metrics, metrics_dir)
+            if trace:
+                trace.write(trace_path)
+                logging.info("Trace written to {}".format(trace_path))
+            if profile:
+                profile.write()
+                logging.info("Profiles written to {} ({} spans not profiled while another thread was)".format(
+                    profile_dir, profile.skipped))
+        logging.info(
+            "ArchivesSpace requests saved by in-memory caches: {}".format(
+                self.as_client.requests_saved))
+        if metadata_cache:
+            logging.info(
+                "ArchivesSpace cache: {} hits, {} misses".format(
+                    metadata_cache.hits, metadata_cache.misses))
+        if self.derivative_cache:
+            logging.info(
+                "JPEG2000 cache: {} hits, {} misses ({:.0%} hit rate)".format(
+                    self.derivative_cache.hits, self.derivative_cache.misses,
+                    self.derivative_cache.hit_rate))
+        if self.memory_budget.limit:
+            logging.info(
+                "Memory budget: {:.0f} MB peak reserved of {:.0f} MB, {} waits for memory".format(
+                    self.memory_budget.peak / 1024 / 1024, self.memory_budget.limit / 1024 / 1024,
+                    self.memory_budget.waits))
+        if self.ocr_cache:
+            logging.info(
+                "OCR cache: {} hits, {} misses ({:.0%} hit rate)".format(
+                    self.ocr_cache.hits, self.ocr_cache.misses,
+                    self.ocr_cache.hit_rate))
+
+    def get_clients(self, bypass_cache=False, use_cache=True):
+        """Sets up the ArchivesSpace and AWS clients configured in local_settings.cfg.
+
+        Args:
+            bypass_cache (bool): Flag to ignore cached ArchivesSpace data, which is refreshed instead.
+            use_cache (bool): Flag to cache ArchivesSpace data, if a cache directory is configured.
+        Returns:
+            metadata_cache (MetadataCache): Cache of ArchivesSpace data, if a cache directory is configured.
+        """
+        cache_dir = self.config.get("Cache", "directory", fallback=None) if use_cache else None
+        metadata_cache = MetadataCache(
+            os.path.join(cache_dir, "metadata.db"),
+            self.config.getint("Cache", "metadata_ttl", fallback=None)) if cache_dir else None
+        self.as_client = ArchivesSpaceClient(
             self.config.get("ArchivesSpace", "baseurl"),
             self.config.get("ArchivesSpace", "username"),
             self.config.get("ArchivesSpace", "password"),
-            self.config.get("ArchivesSpace", "repository"))
-        aws_client = AWSClient(
+            self.config.get("ArchivesSpace", "repository"),
+            cache=metadata_cache,
+            bypass_cache=bypass_cache)
+        self.aws_client = AWSClient(
             self.config.get("S3", "region_name"),
             self.config.get("S3", "aws_access_key_id"),
             self.config.get("S3", "aws_secret_access_key"),
-            self.config.get("S3", "bucketname"))
-        jp2_dir = os.path.join(target_dir, "images")
-        pdf_dir = os.path.join(target_dir, "pdfs")
-        manifest_dir = os.path.join(target_dir, "manifests")
-        for path in [jp2_dir, pdf_dir, manifest_dir]:
-            if not os.path.exists(path):
-                os.makedirs(path)
-        object_dirs = refid_dirs(source_dir, [jp2_dir, pdf_dir, manifest_dir])
-        for directory in object_dirs:
-            identifier = None
-            ref_id = directory.split('/')[-1]
+            self.config.get("S3", "bucketname"),
+            workers=self.config.getint("S3", "upload_workers", fallback=1),
+            chunk_size=self.config.getint("S3", "multipart_chunk_size", fallback=8),
+            part_workers=self.config.getint("S3", "multipart_workers", fallback=4),
+            endpoint_url=self.config.get("S3", "endpoint_url", fallback=None))
+        return metadata_cache
+
+    def timed(self, stage, func):
+        """Wraps a stage's function so that its throughput is recorded in the journal.
+
+        Objects which are resumed are not recorded, since steps completed in
+        an earlier run are skipped. Each stage runs in a span within the span
+        of its object, which starts with the object's first stage.
+
+        Args:
+            stage (str): Name of the stage.
+            func (callable): Function called with each job passed to the stage.
+        Returns:
+            func (callable): The wrapped function.
+        """
+        def run_timed(job):
+            start = time.time()
+            if "span" not in job:
+                job["span"] = open_span("object", ref_id=job["ref_id"])
+            with activate(job["span"]), span("stage", {"stage": stage}) as current:
+                current.add(pages=job["volume"]["pages"], bytes_in=job["volume"]["bytes"])
+                try:
+                    func(job)
+                finally:
+                    job["span"].details["identifier"] = job["identifier"]
+            if self.journal and not job.get("completed_steps"):
+                self.journal.record_throughput(
+                    socket.gethostname(), stage, job["volume"]["pages"],
+                    job["volume"]["pixels"], time.time() - start)
+        return run_timed
+
+    def write_metrics(self, metrics, metrics_dir):
+        """Writes the metrics of a run as a Prometheus textfile and a JSON summary.
+
+        The Prometheus textfile is replaced by each run, while a JSON summary
+        named for the time the run started is kept for every run.
+
+        Args:
+            metrics (MetricsSink): Metrics recorded during the run.
+            metrics_dir (str): Directory in which to write the files.
+        """
+        if not os.path.isdir(metrics_dir):
+            os.makedirs(metrics_dir)
+        metrics.write_prometheus(os.path.join(metrics_dir, "iiif_pipeline.prom"))
+        summary_path = os.path.join(metrics_dir, "iiif_pipeline_{}.json".format(
+            time.strftime("%Y%m%dT%H%M%S", time.localtime(metrics.started))))
+        metrics.write_summary(summary_path)
+        logging.info("Metrics written to {}".format(summary_path))
+
+    def prefetch_metadata(self, jobs, report=True):
+        """Starts fetching ArchivesSpace data for all objects.
+
+        Lookups run in the background on a bounded pool of threads, and failed
+        lookups are reported as soon as they fail. Lookups start in the order
+        objects are listed, while the objects are measured and ordered.
+
+        Args:
+            jobs (list): Data about the objects being processed.
+            report (bool): Flag to report failed lookups as soon as they fail.
+        Returns:
+            lookups (dict): Futures for ArchivesSpace data, keyed by ref_id.
+        """
+        executor = ThreadPoolExecutor(
+            max_workers=self.config.getint("ArchivesSpace", "prefetch_workers", fallback=4))
+        lookups = {}
+        for job in jobs:
+            future = executor.submit(self.as_client.get_object, job["ref_id"])
+            if report:
+                future.add_done_callback(partial(self.report_lookup, job["ref_id"]))
+            lookups[job["ref_id"]] = future
+        executor.shutdown(wait=False)
+        return lookups
+
+    def report_lookup(self, ref_id, future):
+        """Reports a failed ArchivesSpace lookup.
+
+        Args:
+            ref_id (str): The ref_id which was looked up.
+            future (Future): The completed lookup.
+        """
+        if not future.cancelled() and future.exception():
+            print("ArchivesSpace lookup failed for ref_id {}: {}".format(
+                ref_id, future.exception()))
+            logging.warning("ArchivesSpace lookup failed for ref_id {}: {}".format(
+                ref_id, future.exception()))
+
+    def get_metadata(self, job):
+        """Gets prefetched ArchivesSpace data for an object and assigns its identifier.
+
+        If the prefetch has not yet started the lookup for the object, the
+        lookup is made here instead, so that objects which start early do not
+        wait for the lookups of objects listed before them.
+
+        Unless files are being replaced, fails if any files for the identifier
+        already exist in S3, before any derivatives are created.
+
+        Args:
+            job (dict): Data about the object being processed.
+        """
+        obj_source_dir = os.path.join(job["directory"], "master")
+        if not os.path.isdir(os.path.join(self.source_dir, obj_source_dir)):
+            raise Exception(
+                "Object directory {} does not have a subdirectory named `master`".format(job["directory"]))
+        job["source_dir"] = obj_source_dir
+        lookup = self.lookups[job["ref_id"]]
+        if lookup.cancel():
+            lookup = Future()
             try:
-                obj_source_dir = os.path.join(directory, "master")
-                if not os.path.isdir(os.path.join(source_dir, obj_source_dir)):
-                    raise Exception(
-                        "Object directory {} does not have a subdirectory named `master`".format(directory))
-                obj_data = as_client.get_object(ref_id)
-                identifier = shortuuid.uuid(name=obj_data["uri"])
-                logging.info(
-                    "Processing started for identifier {} created for ref_id {}".format(identifier, ref_id))
-                tiff_files = matching_files(
-                    obj_source_dir, suffix=".tif", skip=skip, prepend=True)
-                create_jp2(tiff_files, identifier, jp2_dir, replace)
-                logging.info(
-                    "JPEG2000 derivatives with identifier {} created for ref_id {}".format(identifier, ref_id))
+                lookup.set_result(self.as_client.get_object(job["ref_id"]))
+            except Exception as e:
+                lookup.set_exception(e)
+            self.report_lookup(job["ref_id"], lookup)
+        job["obj_data"] = lookup.result()
+        job["identifier"] = shortuuid.uuid(name=job["obj_data"]["uri"])
+        job["completed_steps"] = set()
+        if self.restart:
+            cleanup_files(job["identifier"], [self.jp2_dir, self.pdf_dir, self.manifest_dir])
+        if self.journal:
+            if self.resume:
+                job["completed_steps"] = self.journal.completed_steps(job["ref_id"])
+            elif self.restart or self.replace or "complete" in self.journal.completed_steps(job["ref_id"]):
+                self.journal.reset(job["ref_id"])
+            elif self.journal.completed_steps(job["ref_id"]) or self.journal.completed_pages(job["ref_id"]):
+                raise Exception(
+                    "ref_id {} was not completed by an earlier run: use --resume to continue it "
+                    "or --restart to discard its progress".format(job["ref_id"]))
+        if not (self.replace or job["completed_steps"]):
+            existing = self.aws_client.existing_objects(job["identifier"])
+            if existing:
+                raise FileExistsError(
+                    "Error uploading files to AWS: {} already exist in {}".format(
+                        ", ".join(existing), self.aws_client.bucket))
+        logging.info(
+            "Processing started for identifier {} created for ref_id {}".format(job["identifier"], job["ref_id"]))
+
+    def create_image_derivatives(self, job):
+        """Creates JPEG2000 derivatives and a IIIF Manifest for an object.
+
+        Before any pages are encoded, every source TIFF is analyzed to find
+        blank pages and to choose how each page is encoded, unless the PDF has
+        already been created. Analyses are recorded in the journal. When
+        resuming, pages which were already analyzed or encoded are not
+        analyzed or encoded again.
+
+        Args:
+            job (dict): Data about the object being processed.
+        """
+        identifier = job["identifier"]
+        ref_id = job["ref_id"]
+        job["pages"] = []
+        job["page_analysis"] = {}
+        if "pdf" not in job["completed_steps"]:
+            job["page_analysis"] = self.journal.page_analysis(
+                ref_id) if (self.journal and self.resume) else {}
+            tiff_files = [f for f in matching_files(
+                job["source_dir"], suffix=".tif", skip=self.skip, prepend=True)
+                if get_page_number(f) not in job["page_analysis"]]
+            analyses = dict(zip(
+                [get_page_number(f) for f in tiff_files],
+                analyze_pages(
+                    tiff_files,
+                    workers=self.config.getint("Derivatives", "analysis_workers", fallback=1),
+                    budget=self.memory_budget)))
+            if self.journal:
+                self.journal.record_analysis(ref_id, analyses)
+            job["page_analysis"].update(analyses)
+            logging.info(
+                "{} of {} pages are blank for ref_id {}".format(
+                    len(self.blank_pages(job)), len(job["page_analysis"]), ref_id))
+        if self.pending(job, "jp2"):
+            completed_pages = self.journal.completed_pages(
+                ref_id) if (self.journal and self.resume) else set()
+            tiff_files = [f for f in matching_files(
+                job["source_dir"], suffix=".tif", skip=self.skip, prepend=True)
+                if get_page_number(f) not in completed_pages]
+            job["pages"] = create_jp2(
+                tiff_files, identifier, self.jp2_dir, self.replace or self.resume,
+                workers=self.config.getint("Derivatives", "jp2_workers", fallback=1),
+                on_page_complete=partial(self.complete_page, job),
+                cache=self.derivative_cache,
+                analyses=job["page_analysis"],
+                encoder=self.encoder,
+                derivative_format=self.derivative_format,
+                stream_pixels=self.config.getint("Derivatives", "stream_pixels", fallback=None),
+                budget=self.memory_budget)
+            self.complete(job, "jp2")
+            logging.info(
+                "JPEG2000 derivatives with identifier {} created for ref_id {}".format(identifier, ref_id))
+        if self.pending(job, "manifest"):
+            with span("manifest", identifier=identifier):
                 ManifestMaker(
-                    self.config.get("ImageServer", "baseurl"), manifest_dir).create_manifest(
-                        matching_files(jp2_dir, prefix=identifier), jp2_dir, identifier, obj_data, replace)
-                logging.info(
-                    "IIIF Manifest with identifier {} created for ref_id {}".format(
-                        identifier, ref_id))
-                jp2_files = matching_files(
-                    jp2_dir, prefix=identifier, prepend=True)
-                create_pdf(jp2_files, identifier, pdf_dir, replace)
-                logging.info(
-                    "Concatenated PDF with identifier {} created for ref_id {}".format(identifier, ref_id))
-                compress_pdf(identifier, pdf_dir)
-                logging.info(
-                    "Compressed PDF with identifier {} created for {}".format(identifier, ref_id))
-                ocr_pdf(identifier, pdf_dir)
-                logging.info(
-                    "OCRed PDF with identifier {} created for {}".format(identifier, ref_id))
-                for src_dir, target_dir, file_type in [
-                        (jp2_dir, "images", "JPEG2000 files"),
-                        (pdf_dir, "pdfs", "PDF file"),
-                        (manifest_dir, "manifests", "Manifest file")]:
-                    uploads = matching_files(
-                        src_dir, prefix=identifier, prepend=True)
-                    aws_client.upload_files(uploads, target_dir, replace)
-                    logging.info(
-                        "{} uploaded for {}".format(
-                            file_type, identifier))
-                cleanup_files(identifier, [jp2_dir, pdf_dir, manifest_dir])
-                if cleanup_source:
-                    cleanup_dir(directory)
+                    self.config.get("ImageServer", "baseurl"), self.manifest_dir).create_manifest(
+                        matching_files(self.jp2_dir, prefix=identifier), self.jp2_dir, identifier, job["obj_data"],
+                        self.replace or self.resume, pages=job["pages"])
+            self.complete(job, "manifest")
+            logging.info(
+                "IIIF Manifest with identifier {} created for ref_id {}".format(
+                    identifier, ref_id))
+
+    def create_pdf_derivatives(self, job):
+        """Creates a compressed, OCRed PDF for an object.
+
+        Args:
+            job (dict): Data about the object being processed.
+        """
+        identifier = job["identifier"]
+        ref_id = job["ref_id"]
+        if self.pending(job, "pdf"):
+            jp2_files = matching_files(
+                self.jp2_dir, prefix=identifier, prepend=True)
+            create_access_pdf(
+                jp2_files, identifier, self.pdf_dir, self.replace or self.resume,
+                workers=self.config.getint("Derivatives", "ocr_workers", fallback=1),
+                cache=self.ocr_cache,
+                blank_pages=self.blank_pages(job),
+                budget=self.memory_budget,
+                max_pixels=self.config.getint("Derivatives", "pdf_max_pixels", fallback=PDF_MAX_PIXELS))
+            self.complete(job, "pdf")
+            logging.info(
+                "Compressed, OCRed PDF with identifier {} created for ref_id {}".format(identifier, ref_id))
+
+    def upload(self, job):
+        """Uploads derivatives to AWS and removes local files.
+
+        Args:
+            job (dict): Data about the object being processed.
+        """
+        identifier = job["identifier"]
+        for src_dir, destination_dir, file_type in [
+                (self.jp2_dir, "images", "JPEG2000 files"),
+                (self.pdf_dir, "pdfs", "PDF file"),
+                (self.manifest_dir, "manifests", "Manifest file")]:
+            step = "upload_{}".format(destination_dir)
+            if not self.pending(job, step):
+                continue
+            uploads = matching_files(
+                src_dir, prefix=identifier, prepend=True)
+            stats = self.aws_client.upload_files(
+                uploads, destination_dir, self.replace or self.resume)
+            self.complete(job, step)
+            logging.info(
+                "{} uploaded for {} ({} bytes at {:.2f} MB/s)".format(
+                    file_type, identifier, stats["bytes"],
+                    stats["bytes_per_second"] / (1024 * 1024)))
+        cleanup_files(identifier, [self.jp2_dir, self.pdf_dir, self.manifest_dir])
+        if self.cleanup_source:
+            cleanup_dir(job["directory"])
+        self.complete(job, "complete")
+        close_span(job["span"])
+
+    def blank_pages(self, job):
+        """Gets the page numbers of an object's blank pages.
+
+        Args:
+            job (dict): Data about the object being processed.
+        Returns:
+            pages (set): Page numbers of pages classified as blank.
+        """
+        return set(page for page, analysis in job.get("page_analysis", {}).items()
+                   if analysis["blank"])
+
+    def pending(self, job, step):
+        """Checks whether a step still needs to be run for an object.
+
+        Args:
+            job (dict): Data about the object being processed.
+            step (str): Name of the step.
+        Returns:
+            boolean: False if the step was completed in an earlier run which is being resumed.
+        """
+        if step in job["completed_steps"]:
+            logging.info(
+                "Skipping {} for identifier {}, completed in an earlier run".format(step, job["identifier"]))
+            return False
+        return True
+
+    def complete(self, job, step):
+        """Records a completed step in the journal.
+
+        Args:
+            job (dict): Data about the object being processed.
+            step (str): Name of the step.
+        """
+        if self.journal:
+            self.journal.complete_step(job["ref_id"], job["identifier"], step)
+
+    def complete_page(self, job, page):
+        """Records an encoded page in the journal.
+
+        Args:
+            job (dict): Data about the object being processed.
+            page (dict): Record for the encoded page.
+        """
+        if self.journal:
+            self.journal.complete_page(job["ref_id"], job["identifier"], page["page"])
+
+    def handle_error(self, job, e):
+        """Reports an error processing an object.
+
+        If a journal is configured, the object's derivatives and journal are
+        kept so that a later run can resume from the step which failed, unless
+        restarting or replacing. Otherwise its derivatives are removed.
+
+        Args:
+            job (dict): Data about the object being processed.
+            e (Exception): The exception raised while processing the object.
+        """
+        identifier = job["identifier"]
+        ref_id = job["ref_id"]
+        if "span" in job:
+            close_span(job["span"], failed=True)
+        print(
+            "Error processing identifier {} with ref_id {}: {}".format(
+                identifier, ref_id, e))
+        if identifier and (not self.journal or self.restart or self.replace):
+            cleanup_files(identifier, [self.jp2_dir, self.pdf_dir, self.manifest_dir])
+            if self.journal:
+                self.journal.reset(ref_id)
+        logging.error(
+            "Error processing identifier {} with ref_id {}: {}".format(
+                identifier, ref_id, e))
+
+    def status(self):
+        """Prints the progress of every object recorded in the journal."""
+        journal = self.get_journal()
+        if not journal:
+            raise Exception("No journal is configured in local_settings.cfg")
+        for obj in journal.status():
+            print("{}\t{}\t{} pages encoded\t{}\t{}".format(
+                obj["ref_id"], obj["identifier"], obj["pages"],
+                obj["steps"][-1] if obj["steps"] else "started",
+                time.strftime("%m/%d/%Y %I:%M:%S %p", time.localtime(obj["updated"]))))
+
+    def benchmark_encoders(self, source_dir, target_dir):
+        """Prints how quickly each available JPEG2000 encoder encodes a set of TIFFs.
+
+        Each encoder is run once for every derivative format it supports.
+
+        Args:
+            source_dir (str): Directory containing sample TIFF files.
+            target_dir (str): Directory in which to create temporary JP2 files.
+        """
+        tiff_files = matching_files(source_dir, suffix=".tif", prepend=True)
+        if not tiff_files:
+            raise Exception("No TIFF files found in {}".format(source_dir))
+        pages = [{"source": f, "layers": layers_for_dimensions(info["width"], info["height"])}
+                 for f, info in zip(tiff_files, probe_files(tiff_files, probe_tiff))]
+        print("encoder\tformat\tpages/s\tMB/s\tpeak RSS (MB)\toutput (MB)")
+        for derivative_format, options in DERIVATIVE_FORMATS.items():
+            for result in benchmark_encoders(
+                    pages, target_dir, dict(ENCODING_PROFILES["default"], **options)):
+                print("{}\t{}\t{:.2f}\t{:.2f}\t{:.0f}\t{:.2f}".format(
+                    result["encoder"], derivative_format, result["pages_per_second"],
+                    result["mb_per_second"], result["peak_rss"],
+                    result["output_bytes"] / 1024 / 1024))
+
+    def plan(self, source_dir, target_dir, skip):
+        """Prints the estimated cost of processing a batch, without processing it.
+
+        For each object, reports the number of pages and pixels, the number of
+        JPEG2000 layers, the expected size of the JPEG2000 files and the time
+        each stage is expected to take, estimated from the throughput of
+        earlier runs on this host which is recorded in the journal. Existing
+        local derivatives and files in S3 which would conflict with the
+        object's derivatives are also listed.
+
+        No files are created: the journal is only read if it exists, and
+        ArchivesSpace data is neither read from nor written to the cache.
+        Objects are looked up on the prefetch pool while their TIFF headers
+        are read.
+
+        Args:
+            source_dir (str): A directory containing subdirectories (named using ref ids) for archival objects.
+            target_dir (str): A directory in which derivatives would be created.
+            skip (bool): Flag to skip files ending with `_001`.
+        """
+        if not os.path.isdir(source_dir):
+            raise Exception(
+                "{} is not a path to a directory.".format(source_dir))
+        journal = self.get_journal(read_only=True)
+        rates = journal.throughput(socket.gethostname()) if journal else {}
+        self.get_clients(use_cache=False)
+        derivative_dirs = [os.path.join(target_dir, subdir) for subdir in ["images", "pdfs", "manifests"]]
+        workers = {stage: self.config.getint("Pipeline", "{}_workers".format(key), fallback=1)
+                   for stage, key in [("metadata", "metadata"), ("images", "image"),
+                                      ("pdfs", "pdf"), ("upload", "upload")]}
+        plans = []
+        print("ref_id\tidentifier\tpages\tmegapixels\tlayers\tJP2 (MB)\t{}\tconflicts".format(
+            "\t".join("{} (s)".format(stage) for stage in STAGES)))
+        directories = refid_dirs(source_dir, derivative_dirs)
+        lookups = self.prefetch_metadata(
+            [{"ref_id": directory.split('/')[-1]} for directory in directories], report=False)
+        for directory in directories:
+            ref_id = directory.split('/')[-1]
+            try:
+                plan = plan_object(directory, skip, self.config.getint("Pipeline", "planning_workers", fallback=4))
+                identifier = shortuuid.uuid(name=lookups[ref_id].result()["uri"])
+                conflicts = find_conflicts(identifier, derivative_dirs, self.aws_client)
             except Exception as e:
-                print(
-                    "Error processing identifier {} with ref_id {}: {}".format(
-                        identifier, ref_id, e))
-                if identifier:
-                    cleanup_files(identifier, [jp2_dir, pdf_dir, manifest_dir])
-                logging.error(
-                    "Error processing identifier {} with ref_id {}: {}".format(
-                        identifier, ref_id, e))
-                pass
+                print("{}\terror\t{}".format(ref_id, e))
+                continue
+            plan["seconds"] = estimate_seconds(plan, rates)
+            plan["conflicts"] = conflicts
+            plans.append(plan)
+            print("{}\t{}\t{}\t{:.1f}\t{}-{}\t{:.1f}\t{}\t{}".format(
+                ref_id, identifier, plan["pages"], plan["pixels"] / 1000000,
+                plan["layers"][0], plan["layers"][1], plan["output_bytes"] / 1024 / 1024,
+                "\t".join(_format_seconds(plan["seconds"][stage]) for stage in STAGES),
+                ", ".join(conflicts) or "none"))
+        totals = estimate_batch(plans, workers)
+        print("total\t{} objects\t{}\t{:.1f}\t\t{:.1f}\t{}\t{}".format(
+            totals["objects"], totals["pages"], totals["pixels"] / 1000000,
+            totals["output_bytes"] / 1024 / 1024,
+            "\t".join(_format_seconds(totals["seconds"][stage]) for stage in STAGES),
+            sum(1 for plan in plans if plan.get("conflicts"))))
+        print("Estimated elapsed time: {}".format(
+            "{:.1f} hours".format(totals["elapsed"] / 3600) if totals["elapsed"] is not None
+            else "unknown, no throughput is recorded for this host"))
+
+    def get_journal(self, read_only=False):
+        """Opens the journal configured in local_settings.cfg, if any.
+
+        Args:
+            read_only (bool): Flag to only open the journal if it exists, without changing it.
+        Returns:
+            journal (Journal): The journal, or None if there is none to open.
+        """
+        path = self.config.get("Pipeline", "journal", fallback=None)
+        if not path or (read_only and not os.path.isfile(path)):
+            return None
+        return Journal(path, read_only)
+
+
+def _format_seconds(seconds):
+    """Formats an estimated number of seconds, which may be unknown."""
+    return "{:.0f}".format(seconds) if seconds is not None else "?"
@@ -0,0 +1,110 @@
+import os
+
+from .derivatives import (ENCODING_PROFILES, encoding_profile,
+                          layers_for_dimensions)
+from .helpers import matching_files
+from .probe import probe_files, probe_tiff
+
+STAGES = ["metadata", "images", "pdfs", "upload"]
+STAGE_UNITS = {"metadata": "objects", "images": "pixels", "pdfs": "pixels", "upload": "pixels"}
+
+
+def plan_object(directory, skip=False, workers=1):
+    """Estimates the derivatives which will be created for an object.
+
+    Only the headers of the TIFF files in the object's `master` directory are
+    read. The size of each JPEG2000 file is estimated from the compression
+    ratio of the profile chosen from its TIFF header; lossless pages are
+    counted at their uncompressed size.
+
+    Args:
+        directory (str): Path to the object's directory.
+        skip (bool): Ignore files ending in `_001`, as the pipeline does.
+        workers (int): Number of TIFF headers to read concurrently.
+    Returns:
+        plan (dict): Number of pages, total pixels, source bytes, smallest and
+            largest number of layers and expected JPEG2000 bytes.
+    """
+    plan = {"objects": 1, "pages": 0, "pixels": 0, "bytes": 0, "layers": (0, 0), "output_bytes": 0}
+    master_dir = os.path.join(directory, "master")
+    if not os.path.isdir(master_dir):
+        raise Exception("Object directory {} does not have a subdirectory named `master`".format(directory))
+    files = matching_files(master_dir, suffix=".tif", skip=skip, prepend=True)
+    layers = []
+    for file, info in zip(files, probe_files(files, probe_tiff, workers)):
+        uncompressed = info["width"] * info["height"] * info["samples_per_pixel"] * max(info["bits_per_sample"]) / 8
+        rate = ENCODING_PROFILES[encoding_profile({"tiff": info})]["rate"]
+        layers.append(layers_for_dimensions(info["width"], info["height"]))
+        plan["pages"] += 1
+        plan["pixels"] += info["width"] * info["height"]
+        plan["bytes"] += os.path.getsize(file)
+        plan["output_bytes"] += int(uncompressed / rate if rate else uncompressed)
+    if layers:
+        plan["layers"] = (min(layers), max(layers))
+    return plan
+
+
+def estimate_seconds(plan, rates):
+    """Estimates how long each stage will spend on an object.
+
+    Args:
+        plan (dict): Result of `plan_object` for the object.
+        rates (dict): Throughput of each stage in earlier runs, as returned by
+            `Journal.throughput`.
+    Returns:
+        seconds (dict): Estimated seconds for each stage, or None for stages
+            which have no recorded throughput.
+    """
+    seconds = {}
+    for stage in STAGES:
+        rate = rates.get(stage)
+        unit = STAGE_UNITS[stage]
+        seconds[stage] = plan[unit] * rate["seconds"] / rate[unit] if (rate and rate[unit]) else None
+    return seconds
+
+
+def estimate_batch(plans, workers):
+    """Estimates the total work for a batch and how long it will take.
+
+    Stages work on different objects at the same time, so the batch takes
+    about as long as its busiest stage: the total time that stage spends on
+    every object, divided among its workers.
+
+    Args:
+        plans (list): Plans for each object, including their estimated seconds.
+        workers (dict): Number of workers for each stage.
+    Returns:
+        totals (dict): Totals of each count, estimated seconds for each stage
+            and the estimated elapsed seconds for the batch, which are None if
+            any object's estimate is missing.
+    """
+    totals = {key: sum(plan[key] for plan in plans)
+              for key in ["objects", "pages", "pixels", "bytes", "output_bytes"]}
+    totals["seconds"] = {}
+    for stage in STAGES:
+        estimates = [plan["seconds"][stage] for plan in plans]
+        totals["seconds"][stage] = None if None in estimates else sum(estimates)
+    stage_times = [totals["seconds"][stage] / max(1, workers.get(stage, 1)) for stage in STAGES
+                   if totals["seconds"][stage] is not None]
+    totals["elapsed"] = max(stage_times) if len(stage_times) == len(STAGES) else None
+    return totals
+
+
+def find_conflicts(identifier, derivative_dirs, aws_client=None):
+    """Finds derivatives for an identifier which already exist.
+
+    Args:
+        identifier (str): Identifier of the object's derivatives.
+        derivative_dirs (list): Local directories in which derivatives are created.
+        aws_client (AWSClient): Client for the bucket to which derivatives are
+            uploaded. The bucket is not checked if this is not set.
+    Returns:
+        conflicts (list): Paths of local files and keys in the bucket.
+    """
+    conflicts = []
+    for directory in derivative_dirs:
+        if os.path.isdir(directory):
+            conflicts += matching_files(directory, prefix=identifier, prepend=True)
+    if aws_client:
+        conflicts += aws_client.existing_objects(identifier)
+    return conflicts
@@ -0,0 +1,203 @@
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+TIFF_TAGS = {
+    256: "width",
+    257: "height",
+    258: "bits_per_sample",
+    259: "compression",
+    262: "photometric",
+    273: "strip_offsets",
+    277: "samples_per_pixel",
+    278: "rows_per_strip",
+    279: "strip_byte_counts",
+    284: "planar_configuration",
+    322: "tile_width",
+    323: "tile_length",
+    324: "tile_offsets",
+    325: "tile_byte_counts",
+    339: "sample_format",
+}
+TIFF_TYPES = {
+    1: "B", 2: "B", 3: "H", 4: "I", 5: "II", 6: "b", 7: "B", 8: "h",
+    9: "i", 10: "ii", 11: "f", 12: "d", 16: "Q", 17: "q", 18: "Q",
+}
+PROGRESSION_ORDERS = ["LRCP", "RLCP", "RPCL", "PCRL", "CPRL"]
+
+
+def probe_tiff(file):
+    """Reads information about a TIFF image from its first image file directory.
+
+    Only the header and the directory entries are read, not the image data.
+    Both classic TIFF and BigTIFF files are supported.
+
+    Args:
+        file (str): Path to a TIFF file.
+    Returns:
+        info (dict): Width and height, bits per sample, samples per pixel,
+            compression, photometric interpretation and the layout of strips
+            or tiles in the file.
+    """
+    try:
+        with open(file, "rb") as f:
+            header = f.read(16)
+            if header[:2] == b"II":
+                order = "<"
+            elif header[:2] == b"MM":
+                order = ">"
+            else:
+                raise ValueError("{} is not a valid TIFF file".format(file))
+            magic = struct.unpack(order + "H", header[2:4])[0]
+            if magic == 42:
+                count_format, entry_format, offset_size = "H", "HHI", 4
+                ifd_offset = struct.unpack(order + "I", header[4:8])[0]
+            elif magic == 43:
+                count_format, entry_format, offset_size = "Q", "HHQ", 8
+                ifd_offset = struct.unpack(order + "Q", header[8:16])[0]
+            else:
+                raise ValueError("{} is not a valid TIFF file".format(file))
+            f.seek(ifd_offset)
+            count_size = struct.calcsize(count_format)
+            entry_count = struct.unpack(order + count_format, f.read(count_size))[0]
+            entry_size = struct.calcsize(order + entry_format) + offset_size
+            entries = f.read(entry_count * entry_size)
+            info = {"big_tiff": magic == 43, "byte_order": order}
+            for index in range(entry_count):
+                entry = entries[index * entry_size:(index + 1) * entry_size]
+                tag, value_type, value_count = struct.unpack(
+                    order + entry_format, entry[:-offset_size])
+                if tag not in TIFF_TAGS or value_type not in TIFF_TYPES:
+                    continue
+                value_format = "{}{}".format(order, TIFF_TYPES[value_type] * value_count)
+                value_size = struct.calcsize(value_format)
+                if value_size <= offset_size:
+                    data = entry[-offset_size:][:value_size]
+                else:
+                    value_offset = struct.unpack(
+                        order + ("I" if offset_size == 4 else "Q"), entry[-offset_size:])[0]
+                    position = f.tell()
+                    f.seek(value_offset)
+                    data = f.read(value_size)
+                    f.seek(position)
+                info[TIFF_TAGS[tag]] = struct.unpack(value_format, data)
+    except struct.error as e:
+        raise ValueError("{} is not a valid TIFF file: {}".format(file, e)) from e
+    for key in ["width", "height", "compression", "photometric", "samples_per_pixel",
+                "rows_per_strip", "planar_configuration", "tile_width", "tile_length"]:
+        if key in info:
+            info[key] = info[key][0]
+    if "width" not in info or "height" not in info:
+        raise ValueError("{} does not have image dimensions".format(file))
+    info.setdefault("samples_per_pixel", 1)
+    info.setdefault("bits_per_sample", (1,) * info["samples_per_pixel"])
+    info.setdefault("compression", 1)
+    info.setdefault("planar_configuration", 1)
+    info.setdefault("rows_per_strip", info["height"])
+    return info
+
+
+def probe_jp2(file):
+    """Reads information about a JPEG2000 image from its headers.
+
+    Reads the `ihdr` box of a JP2 file, or the SIZ marker of a raw codestream,
+    and the COD marker of the codestream, without decoding any image data.
+
+    Args:
+        file (str): Path to a JP2 file or JPEG2000 codestream.
+    Returns:
+        info (dict): Width, height, number of components, number of
+            resolution levels and quality layers, progression order, code
+            block size, code block style and whether the HT block coder
+            (HTJ2K) is used.
+    """
+    info = {}
+    try:
+        with open(file, "rb") as f:
+            start = f.read(12)
+            if start[:4] == b"\xff\x4f\xff\x51":
+                f.seek(0)
+            elif start[4:8] == b"jP  ":
+                while True:
+                    box_length, box_type = _read_box_header(f)
+                    if box_type is None or (box_length is None and box_type != b"jp2c"):
+                        raise ValueError("{} does not contain a codestream".format(file))
+                    if box_type == b"jp2h":
+                        continue
+                    if box_type == b"ihdr":
+                        height, width, components = struct.unpack(">IIH", f.read(10))
+                        info.update({"width": width, "height": height, "components": components})
+                        f.seek(box_length - 10, 1)
+                    elif box_type == b"jp2c":
+                        break
+                    else:
+                        f.seek(box_length, 1)
+            else:
+                raise ValueError("{} is not a valid JPEG2000 file".format(file))
+            info.update(_read_codestream_header(f, file))
+    except struct.error as e:
+        raise ValueError("{} is not a valid JPEG2000 file: {}".format(file, e)) from e
+    return info
+
+
+def _read_box_header(f):
+    """Reads a JP2 box header.
+
+    Returns:
+        length (int): Length of the box contents, or None if the box extends
+            to the end of the file.
+        box_type (bytes): Type of the box, or None at the end of the file.
+    """
+    header = f.read(8)
+    if len(header) < 8:
+        return None, None
+    length, box_type = struct.unpack(">I4s", header)
+    if length == 1:
+        return struct.unpack(">Q", f.read(8))[0] - 16, box_type
+    return (length - 8 if length else None), box_type
+
+
+def _read_codestream_header(f, file):
+    """Reads the SIZ and COD markers of a JPEG2000 codestream."""
+    if f.read(2) != b"\xff\x4f":
+        raise ValueError("{} does not contain a valid codestream".format(file))
+    info = {}
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker == b"\xff\x90":
+            break
+        length = struct.unpack(">H", f.read(2))[0]
+        segment = f.read(length - 2)
+        if marker == b"\xff\x51":
+            xsiz, ysiz, xosiz, yosiz = struct.unpack(">IIII", segment[2:18])
+            info["width"] = xsiz - xosiz
+            info["height"] = ysiz - yosiz
+            info["components"] = struct.unpack(">H", segment[34:36])[0]
+            info["bits_per_sample"] = tuple(
+                (segment[36 + 3 * c] & 0x7f) + 1 for c in range(info["components"]))
+        elif marker == b"\xff\x52":
+            progression, layers = struct.unpack(">BH", segment[1:4])
+            levels, xcb, ycb, style = struct.unpack(">BBBB", segment[5:9])
+            info.update({
+                "progression": PROGRESSION_ORDERS[progression] if progression < 5 else None,
+                "layers": layers,
+                "levels": levels,
+                "code_block": (2 ** (xcb + 2), 2 ** (ycb + 2)),
+                "code_block_style": style,
+                "htj2k": bool(style & 0x40)})
+    if "width" not in info:
+        raise ValueError("{} does not contain a SIZ marker".format(file))
+    return info
+
+
+def probe_files(files, probe, workers=1):
+    """Probes many files concurrently.
+
+    Args:
+        files (list): Paths of the files to probe.
+        probe (callable): Function which probes a single file.
+        workers (int): Number of files to probe concurrently.
+    Returns:
+        info (list): Information about each file, in the same order as the files.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(executor.map(probe, files))
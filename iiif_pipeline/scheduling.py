@@ -0,0 +1,172 @@
+import heapq
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from .helpers import matching_files
+from .probe import probe_tiff
+
+JP2_MEMORY_FACTOR = 5
+PDF_MEMORY_FACTOR = 2
+OCR_MEMORY_FACTOR = 8
+ANALYSIS_MEMORY_FACTOR = 3
+
+
+def estimate_memory(width, height, samples=1, bits=8, factor=1):
+    """Estimates the memory needed to work on an image.
+
+    Args:
+        width (int): Pixel width of the image.
+        height (int): Pixel height of the image.
+        samples (int): Number of samples per pixel.
+        bits (int): Number of bits per sample.
+        factor (float): Multiple of the size of the uncompressed image which
+            the work needs, such as `JP2_MEMORY_FACTOR` for encoding, which
+            covers the decoded source and the encoder's 32-bit working copy.
+    Returns:
+        memory (int): Estimated number of bytes.
+    """
+    return int(width * height * samples * bits / 8 * factor)
+
+
+class MemoryBudget:
+    def __init__(self, limit=None):
+        """Admits work against a shared memory budget.
+
+        Work which would take the memory reserved over the limit waits until
+        enough memory is released. Work is admitted in the order it asks, so
+        smaller work which would fit waits behind earlier work which does not,
+        rather than overtaking it indefinitely. Work which needs more than the
+        whole budget is admitted once nothing else is running, so that it runs
+        alone rather than never running.
+
+        Args:
+            limit (int): Number of bytes which may be reserved at once. Work is
+                never held back if this is not set.
+        """
+        self.limit = limit
+        self.reserved = 0
+        self.peak = 0
+        self.waits = 0
+        self.tickets = 0
+        self.serving = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, amount):
+        """Reserves memory, waiting until it is available and earlier work has been admitted.
+
+        Args:
+            amount (int): Number of bytes to reserve.
+        """
+        with self.condition:
+            ticket = self.tickets
+            self.tickets += 1
+            if not (self.serving == ticket and self.fits(amount)):
+                self.waits += 1
+                self.condition.wait_for(lambda: self.serving == ticket and self.fits(amount))
+            self.serving += 1
+            self.reserved += amount
+            self.peak = max(self.peak, self.reserved)
+            self.condition.notify_all()
+
+    def release(self, amount):
+        """Releases reserved memory.
+
+        Args:
+            amount (int): Number of bytes to release.
+        """
+        with self.condition:
+            self.reserved -= amount
+            self.condition.notify_all()
+
+    def fits(self, amount):
+        """Checks whether memory can be reserved without exceeding the limit."""
+        return self.limit is None or self.reserved == 0 or self.reserved + amount <= self.limit
+
+    @contextmanager
+    def reserve(self, amount):
+        """Reserves memory for the duration of a block.
+
+        Args:
+            amount (int): Number of bytes to reserve.
+        """
+        self.acquire(amount)
+        try:
+            yield
+        finally:
+            self.release(amount)
+
+
+def measure_object(directory, skip=False):
+    """Measures the volume of source images for an object.
+
+    Only the headers of the TIFF files in the object's `master` directory are
+    read. Files which cannot be probed count towards the number of bytes but
+    not the number of pixels.
+
+    Args:
+        directory (str): Path to the object's directory.
+        skip (bool): Ignore files ending in `_001`, as the pipeline does.
+    Returns:
+        volume (dict): Number of pages, total pixels and total bytes.
+    """
+    volume = {"pages": 0, "pixels": 0, "bytes": 0}
+    master_dir = os.path.join(directory, "master")
+    if not os.path.isdir(master_dir):
+        return volume
+    for file in matching_files(master_dir, suffix=".tif", skip=skip, prepend=True):
+        volume["pages"] += 1
+        volume["bytes"] += os.path.getsize(file)
+        try:
+            info = probe_tiff(file)
+            volume["pixels"] += info["width"] * info["height"]
+        except ValueError:
+            pass
+    return volume
+
+
+def plan_jobs(jobs, skip=False, priority=None, workers=1):
+    """Orders jobs so that the largest objects start first.
+
+    Starting the longest jobs first (longest processing time first) stops a
+    large object which happens to be listed last from running on its own at
+    the end of a batch. Objects in the priority list start before all others,
+    in the order given.
+
+    Args:
+        jobs (list): Data about each object, including its directory.
+        skip (bool): Ignore files ending in `_001` when measuring objects.
+        priority (list): ref_ids of objects to start first.
+        workers (int): Number of objects to measure concurrently.
+    Returns:
+        jobs (list): The jobs, each with its volume, in the order they should start.
+    """
+    priority = priority or []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        volumes = executor.map(lambda job: measure_object(job["directory"], skip), jobs)
+        for job, volume in zip(jobs, volumes):
+            job["volume"] = volume
+    return sorted(jobs, key=lambda job: (
+        priority.index(job["ref_id"]) if job["ref_id"] in priority else len(priority),
+        -job["volume"]["pixels"],
+        -job["volume"]["bytes"]))
+
+
+def estimate_makespan(jobs, workers=1):
+    """Estimates how long jobs take when started in order on a pool of workers.
+
+    Each job is assumed to take time in proportion to its pixels, and starts
+    on whichever worker becomes free first.
+
+    Args:
+        jobs (list): Data about each object, including its volume, in the
+            order they start.
+        workers (int): Number of objects worked on at once.
+    Returns:
+        makespan (int): Number of pixels worked on by the busiest worker.
+    """
+    loads = [0] * max(1, workers)
+    for job in jobs:
+        heapq.heapreplace(loads, loads[0] + job["volume"]["pixels"])
+    return max(loads)
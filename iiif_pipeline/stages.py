@@ -0,0 +1,84 @@
+import logging
+import queue
+import threading
+
+_DONE = object()
+
+
+class Stage:
+    def __init__(self, name, func, workers=1):
+        """A step in a pipeline, run by its own pool of worker threads.
+
+        Args:
+            name (str): Name of the stage, used to name worker threads.
+            func (callable): Function called with each job passed to the stage.
+            workers (int): Number of jobs the stage processes concurrently.
+        """
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+
+
+def run_stages(jobs, stages, on_error, queue_size=1):
+    """Passes jobs through a series of stages.
+
+    Each stage has its own worker threads, and stages are connected by bounded
+    queues, so different jobs can be in different stages at the same time. A
+    job which raises an exception in a stage is passed to `on_error` along
+    with the exception and is not passed to any later stage.
+
+    Args:
+        jobs (iterable): Jobs to process, in the order they should be started.
+        stages (list): Stage objects, in the order jobs should pass through them.
+        on_error (callable): Function called with a failed job and its exception.
+        queue_size (int): Maximum number of jobs waiting in front of each stage.
+    """
+    queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in stages]
+    threads = []
+    for index, stage in enumerate(stages):
+        next_stage = stages[index + 1] if index + 1 < len(stages) else None
+        outbox = queues[index + 1] if next_stage else None
+        remaining = {"workers": stage.workers, "lock": threading.Lock()}
+        for count in range(stage.workers):
+            thread = threading.Thread(
+                target=_work,
+                args=(stage, queues[index], outbox, next_stage, on_error, remaining),
+                name="{}-{}".format(stage.name, count),
+                daemon=True)
+            thread.start()
+            threads.append(thread)
+    for job in jobs:
+        queues[0].put(job)
+    for _ in range(stages[0].workers):
+        queues[0].put(_DONE)
+    for thread in threads:
+        thread.join()
+
+
+def _work(stage, inbox, outbox, next_stage, on_error, remaining):
+    """Processes jobs from a stage's queue until it is told to stop.
+
+    The last worker of a stage to stop tells the workers of the next stage to
+    stop once they have emptied their queue.
+    """
+    while True:
+        job = inbox.get()
+        if job is _DONE:
+            break
+        try:
+            stage.func(job)
+        except Exception as e:
+            try:
+                on_error(job, e)
+            except Exception:
+                logging.exception(
+                    "Error handling failure in stage {}".format(stage.name))
+        else:
+            if outbox:
+                outbox.put(job)
+    with remaining["lock"]:
+        remaining["workers"] -= 1
+        last = remaining["workers"] == 0
+    if last and outbox:
+        for _ in range(next_stage.workers):
+            outbox.put(_DONE)
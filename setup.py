@@ -19,9 +19,11 @@ setup(
         'boto3',
         'iiif-prezi',
         'img2pdf',
+        'numpy',
+        'pikepdf',
         'Pillow',
         'python-magic',
         'shortuuid'
     ],
-    tests_require=['pytest', 'vcrpy'],
+    tests_require=['moto[s3,server]', 'pytest', 'vcrpy'],
     zip_safe=False)
@@ -2,6 +2,7 @@ import os
 import random
 import shutil
 import string
+import struct
 from configparser import ConfigParser
 
 import vcr
@@ -56,3 +57,74 @@ def random_string(length=10):
     """Generates random ascii lowercase letters."""
     letters = string.ascii_lowercase
     return ''.join(random.choice(letters) for i in range(length))
+
+
+def write_tiff(path, height, width, samples=1, rows=None, rows_per_strip=64,
+               tile_size=None, reverse=False):
+    """Writes an uncompressed TIFF without holding the whole image in memory.
+
+    Args:
+        path (str): Path of the TIFF file.
+        height (int): Pixel height.
+        width (int): Pixel width.
+        samples (int): Number of 8-bit samples per pixel.
+        rows (callable): Function called with the first row of a strip or row
+            of tiles and the row after its last row, which returns its pixels
+            as a uint8 array. Defaults to a gradient.
+        rows_per_strip (int): Number of rows in each strip.
+        tile_size (int): Write square tiles of this size instead of strips.
+        reverse (bool): Write strips or tiles in reverse order, so they are not
+            contiguous.
+    """
+    import numpy as np
+    rows = rows or (lambda top, bottom: np.broadcast_to(
+        (np.arange(top, bottom) % 256).astype(np.uint8)[:, np.newaxis, np.newaxis],
+        (bottom - top, width, samples)))
+    band_rows = tile_size or rows_per_strip
+    bands = list(range(0, height, band_rows))
+    if tile_size:
+        tiles_across = -(-width // tile_size)
+        sizes = [tile_size * tile_size * samples] * len(bands) * tiles_across
+    else:
+        sizes = [(min(height, top + band_rows) - top) * width * samples for top in bands]
+    order = list(reversed(range(len(sizes)))) if reverse else list(range(len(sizes)))
+    tags = [(256, 4, 1, width), (257, 4, 1, height), (258, 3, 1, 8), (259, 3, 1, 1),
+            (262, 3, 1, 2 if samples == 3 else 1), (277, 3, 1, samples), (284, 3, 1, 1)]
+    if tile_size:
+        tags += [(322, 4, 1, tile_size), (323, 4, 1, tile_size), (324, 4, len(sizes), None),
+                 (325, 4, len(sizes), None)]
+    else:
+        tags += [(273, 4, len(sizes), None), (278, 4, 1, rows_per_strip),
+                 (279, 4, len(sizes), None)]
+    tags.sort()
+    offsets_position = 8 + 2 + 12 * len(tags) + 4
+    offsets = [0] * len(sizes)
+    position = offsets_position + 8 * len(sizes)
+    for index in order:
+        offsets[index] = position
+        position += sizes[index]
+    with open(path, "wb") as f:
+        f.write(b"II*\x00\x08\x00\x00\x00")
+        f.write(struct.pack("<H", len(tags)))
+        for tag, value_type, count, value in tags:
+            if value is None and count == 1:
+                value = offsets[0] if tag in (273, 324) else sizes[0]
+            elif value is None:
+                value = offsets_position + (0 if tag in (273, 324) else 4 * len(sizes))
+            if value_type == 3:
+                f.write(struct.pack("<HHIHH", tag, value_type, count, value, 0))
+            else:
+                f.write(struct.pack("<HHII", tag, value_type, count, value))
+        f.write(struct.pack("<I", 0))
+        f.write(struct.pack("<{}I".format(len(sizes)), *offsets))
+        f.write(struct.pack("<{}I".format(len(sizes)), *sizes))
+        for top in (reversed(bands) if reverse else bands):
+            band = np.ascontiguousarray(rows(top, min(height, top + band_rows)), dtype=np.uint8)
+            if tile_size:
+                padded = np.zeros((tile_size, tiles_across * tile_size, samples), np.uint8)
+                padded[:band.shape[0], :width] = band
+                tiles = [padded[:, left:left + tile_size] for left in range(0, width, tile_size)]
+                for tile in (reversed(tiles) if reverse else tiles):
+                    f.write(tile.tobytes())
+            else:
+                f.write(band.tobytes())
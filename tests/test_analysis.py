@@ -0,0 +1,100 @@
+import os
+import shutil
+
+import numpy as np
+from helpers import write_tiff
+from iiif_pipeline.analysis import (READ_SAMPLES, analyze_page, analyze_pages,
+                                    read_reduced)
+from iiif_pipeline.probe import probe_tiff
+from iiif_pipeline.scheduling import (ANALYSIS_MEMORY_FACTOR, MemoryBudget,
+                                      estimate_memory)
+from PIL import Image, ImageDraw
+
+ANALYSIS_DIR = os.path.join("/", "analysis")
+
+
+def setup():
+    """Creates blank and printed pages in different modes."""
+    if os.path.isdir(ANALYSIS_DIR):
+        shutil.rmtree(ANALYSIS_DIR)
+    os.makedirs(ANALYSIS_DIR)
+    paper = (235 + np.random.RandomState(0).normal(0, 3, (1200, 900))).clip(0, 255).astype(np.uint8)
+    Image.fromarray(paper).save(os.path.join(ANALYSIS_DIR, "blank_gray.tif"))
+    Image.fromarray(paper.astype(np.uint16) * 257).save(os.path.join(ANALYSIS_DIR, "blank_16bit.tif"))
+    Image.new("RGB", (900, 1200), (20, 20, 20)).save(os.path.join(ANALYSIS_DIR, "blank_separator.tif"))
+    printed = Image.fromarray(paper).convert("RGB")
+    draw = ImageDraw.Draw(printed)
+    for y in range(100, 1100, 30):
+        draw.text((60, y), "Lorem ipsum dolor sit amet, consectetur adipiscing elit " * 2, fill=(20, 20, 20))
+    printed.save(os.path.join(ANALYSIS_DIR, "printed_rgb.tif"))
+    printed.convert("1").save(os.path.join(ANALYSIS_DIR, "printed_bitonal.tif"))
+    draw.rectangle([100, 100, 400, 400], fill=(200, 30, 30))
+    printed.save(os.path.join(ANALYSIS_DIR, "printed_color.tif"))
+    pencil = Image.fromarray(paper)
+    draw = ImageDraw.Draw(pencil)
+    for y in range(100, 1100, 40):
+        draw.line([(60, y), (840, y + 10)], fill=200, width=3)
+    pencil.save(os.path.join(ANALYSIS_DIR, "faint_pencil.tif"))
+    gradient = np.repeat(np.linspace(180, 230, 1200)[:, None], 900, axis=1)
+    Image.fromarray((gradient + paper - 235).clip(0, 255).astype(np.uint8)).save(
+        os.path.join(ANALYSIS_DIR, "low_contrast_photo.tif"))
+
+
+def test_analyze_page():
+    """Ensures blank pages are distinguished from printed pages."""
+    for name in ["blank_gray", "blank_16bit", "blank_separator"]:
+        assert analyze_page(os.path.join(ANALYSIS_DIR, "{}.tif".format(name)))["blank"]
+    for name in ["printed_rgb", "printed_bitonal"]:
+        analysis = analyze_page(os.path.join(ANALYSIS_DIR, "{}.tif".format(name)))
+        assert not analysis["blank"]
+        assert analysis["ink_coverage"] > 0.002
+    for name in ["faint_pencil", "low_contrast_photo"]:
+        analysis = analyze_page(os.path.join(ANALYSIS_DIR, "{}.tif".format(name)))
+        assert not analysis["blank"]
+        assert analysis["ink_coverage"] < 0.002
+
+
+def test_analyze_page_grayscale():
+    """Ensures RGB pages without color are identified as grayscale."""
+    for name in ["blank_gray", "printed_rgb", "printed_bitonal", "blank_separator"]:
+        assert analyze_page(os.path.join(ANALYSIS_DIR, "{}.tif".format(name)))["grayscale"]
+    analysis = analyze_page(os.path.join(ANALYSIS_DIR, "printed_color.tif"))
+    assert not analysis["grayscale"]
+    assert analysis["mode"] == "RGB"
+
+
+def test_analyze_pages():
+    """Ensures results are returned in the same order as the files."""
+    files = [os.path.join(ANALYSIS_DIR, "{}.tif".format(name))
+             for name in ["printed_rgb", "blank_gray", "printed_bitonal", "blank_16bit"]]
+    assert [analysis["blank"] for analysis in analyze_pages(files, workers=2)] == [
+        False, True, False, True]
+    budget = MemoryBudget(1)
+    assert len(analyze_pages(files, workers=2, budget=budget)) == 4
+    assert budget.reserved == 0
+    assert budget.peak == 1200 * 900 * 3 * ANALYSIS_MEMORY_FACTOR
+
+
+def test_read_reduced():
+    """Ensures uncompressed pages are reduced as Pillow reduces them, a band of rows at a time."""
+    pixels = np.random.RandomState(0).randint(0, 256, (1700, 2900, 3), dtype=np.uint8)
+    uncompressed = os.path.join(ANALYSIS_DIR, "large.tif")
+    compressed = os.path.join(ANALYSIS_DIR, "large_lzw.tif")
+    write_tiff(uncompressed, 1700, 2900, 3, rows=lambda top, bottom: pixels[top:bottom])
+    Image.fromarray(pixels).save(compressed, compression="tiff_lzw")
+    band_rows = READ_SAMPLES // (2900 * 3)
+    assert band_rows < 1700
+    expected = np.asarray(Image.fromarray(pixels).reduce(7))
+    assert np.abs(read_reduced(uncompressed, probe_tiff(uncompressed), 7) - expected).max() <= 1
+    streamed, decoded = analyze_page(uncompressed), analyze_page(compressed)
+    assert streamed["mode"] == decoded["mode"] == "RGB"
+    assert abs(streamed["variance"] - decoded["variance"]) < 1
+    for file, rows in [(uncompressed, band_rows), (compressed, 1700)]:
+        budget = MemoryBudget()
+        analyze_pages([file], budget=budget)
+        assert budget.peak == estimate_memory(2900, rows, 3, 8, ANALYSIS_MEMORY_FACTOR)
+
+
+def teardown():
+    """Removes generated pages."""
+    shutil.rmtree(ANALYSIS_DIR)
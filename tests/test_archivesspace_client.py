@@ -1,9 +1,20 @@
+import os
+import shutil
+from unittest.mock import Mock, patch
+
 import pytest
 from helpers import archivesspace_vcr, get_config
+from iiif_pipeline.cache import MetadataCache
 from iiif_pipeline.clients import ArchivesSpaceClient
 
+CACHE_DIR = os.path.join("/", "cache")
+RESOURCE = {"uri": "/repositories/101/resources/4",
+            "dates": [{"expression": "1950s-1980s (Bulk 1982)", "begin": "1950", "end": "1989"}]}
+
 
-def test_run():
+@patch("iiif_pipeline.clients.ArchivesSpaceClient.get_record")
+def test_run(mock_get_record):
+    mock_get_record.return_value = RESOURCE
     config = get_config()
     found_refid = "aspace_b1f076a9f49d369034188c232f7cdf25"
     missing_refid = "aspace_b1f076a9f49d369034188c232f7cdf26"
@@ -17,6 +28,53 @@ def test_run():
         assert "title" in object
         assert "dates" in object
         assert "uri" in object
+        assert object["dates"] == "1950s-1980s (Bulk 1982)"
+        mock_get_record.assert_called_once_with(RESOURCE["uri"])
 
         with pytest.raises(Exception):
             ArchivesSpaceClient().get_object(missing_refid)
+
+
+@patch("iiif_pipeline.clients.ArchivesSpaceClient.get_record")
+def test_get_object_cache(mock_get_record):
+    mock_get_record.return_value = RESOURCE
+    config = get_config()
+    found_refid = "aspace_b1f076a9f49d369034188c232f7cdf25"
+    cache = MetadataCache(os.path.join(CACHE_DIR, "metadata.db"))
+    with archivesspace_vcr.use_cassette("get_ao.json"):
+        client = ArchivesSpaceClient(
+            config.get("ArchivesSpace", "baseurl"),
+            config.get("ArchivesSpace", "username"),
+            config.get("ArchivesSpace", "password"),
+            config.get("ArchivesSpace", "repository"),
+            cache=cache)
+        fetched = client.get_object(found_refid)
+        cached = client.get_object(found_refid)
+        assert fetched == cached
+        assert cache.hits == 1
+        assert cache.misses == 1
+
+
+@patch("iiif_pipeline.clients.ASpace")
+def test_get_closest_dates(mock_aspace):
+    """Ensures ancestor dates are fetched once for sibling archival objects."""
+    series = {"uri": "/repositories/2/archival_objects/1", "dates": [],
+              "ancestors": [{"ref": "/repositories/2/resources/1"}]}
+    resource = {"uri": "/repositories/2/resources/1",
+                "dates": [{"expression": "1950s-1980s"}]}
+    client = ArchivesSpaceClient("http://localhost:8089", "admin", "admin", "2")
+    client.client.get.side_effect = lambda uri: Mock(
+        json=Mock(return_value=series if uri == series["uri"] else resource))
+    for idx in range(5):
+        obj = {"uri": "/repositories/2/archival_objects/{}".format(idx + 2),
+               "ancestors": [{"ref": series["uri"]}, {"ref": resource["uri"]}]}
+        assert client.get_closest_dates(obj) == "1950s-1980s"
+    assert client.client.get.call_count == 2
+    assert client.requests_saved == 8
+    assert client.get_closest_dates(
+        {"dates": [{"expression": "1972"}, {"begin": "1980", "end": "1981"}]}) == "1972, 1980-1981"
+
+
+def teardown():
+    if os.path.isdir(CACHE_DIR):
+        shutil.rmtree(CACHE_DIR)
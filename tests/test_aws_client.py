@@ -3,8 +3,11 @@ import random
 import shutil
 from unittest.mock import patch
 
+import boto3
+import pytest
 from botocore.stub import ANY, Stubber
 from helpers import copy_sample_files, get_config, random_string
+from moto import mock_s3
 from iiif_pipeline.clients import AWSClient
 from iiif_pipeline.helpers import matching_files
 
@@ -30,28 +33,29 @@ def test_object_in_bucket():
     config = get_config()
     key = random.choice(os.listdir(DERIVATIVE_DIR))
     object_path = os.path.join(DERIVATIVE_DIR, key)
+    missing_path = os.path.join(MANIFEST_DIR, key)
     aws = AWSClient(
         config.get("S3", "region_name"),
         config.get("S3", "aws_access_key_id"),
         config.get("S3", "aws_secret_access_key"),
         config.get("S3", "bucketname"))
-    expected_params = {
-        "Bucket": config.get(
-            "S3", "bucketname"), "Key": object_path}
     with Stubber(aws.s3.meta.client) as stubber:
         stubber.add_response(
-            "head_object",
-            service_response={},
-            expected_params=expected_params)
+            "list_objects_v2",
+            service_response={"Contents": [{"Key": object_path}]},
+            expected_params={"Bucket": config.get("S3", "bucketname"), "Prefix": object_path})
         found = aws.object_in_bucket(object_path)
         assert found
+        found_again = aws.object_in_bucket(object_path)
+        assert found_again
 
-        stubber.add_client_error(
-            "head_object",
-            service_error_code='404',
-            expected_params=expected_params)
-        not_found = aws.object_in_bucket(object_path)
+        stubber.add_response(
+            "list_objects_v2",
+            service_response={},
+            expected_params={"Bucket": config.get("S3", "bucketname"), "Prefix": missing_path})
+        not_found = aws.object_in_bucket(missing_path)
         assert not not_found
+        stubber.assert_no_pending_responses()
 
 
 @patch("boto3.s3.transfer.S3Transfer.upload_file")
@@ -65,18 +69,73 @@ def test_upload_files(mock_upload):
         config.get("S3", "bucketname"))
     expected_params = {
         "Bucket": config.get(
-            "S3", "bucketname"), "Key": ANY}
+            "S3", "bucketname"), "Prefix": ANY}
     with Stubber(aws.s3.meta.client) as stubber:
         for src_dir, target_dir in [
                 (DERIVATIVE_DIR, "images"),
                 (MANIFEST_DIR, "manifests")]:
             uploads = matching_files(src_dir, prefix=identifier, prepend=True)
-            for x in range(len(uploads)):
-                stubber.add_client_error(
-                    "head_object",
-                    service_error_code='404',
-                    expected_params=expected_params)
+            stubber.add_response(
+                "list_objects_v2",
+                service_response={},
+                expected_params=expected_params)
             aws.upload_files(uploads, target_dir, False)
+        stubber.assert_no_pending_responses()
+
+
+@mock_s3
+def test_existing_objects():
+    """Ensures existing objects for an identifier are found and cached."""
+    config = get_config()
+    identifier = random.choice(UUIDS)
+    bucket = config.get("S3", "bucketname")
+    boto3.client(
+        "s3", region_name=config.get("S3", "region_name")).create_bucket(Bucket=bucket)
+    aws = AWSClient(
+        config.get("S3", "region_name"),
+        config.get("S3", "aws_access_key_id"),
+        config.get("S3", "aws_secret_access_key"),
+        bucket)
+    assert aws.existing_objects(identifier) == []
+    uploads = matching_files(MANIFEST_DIR, prefix=identifier, prepend=True)
+    aws.upload_files(uploads, "manifests")
+    existing = aws.existing_objects(identifier)
+    assert len(existing) == len(uploads)
+    assert all(key.startswith("manifests/{}".format(identifier)) for key in existing)
+    with pytest.raises(FileExistsError):
+        aws.upload_files(uploads, "manifests")
+
+
+@mock_s3
+def test_upload_files_concurrently():
+    """Ensures files are uploaded concurrently, including multipart uploads."""
+    config = get_config()
+    identifier = random.choice(UUIDS)
+    bucket = config.get("S3", "bucketname")
+    boto3.client(
+        "s3", region_name=config.get("S3", "region_name")).create_bucket(Bucket=bucket)
+    aws = AWSClient(
+        config.get("S3", "region_name"),
+        config.get("S3", "aws_access_key_id"),
+        config.get("S3", "aws_secret_access_key"),
+        bucket, workers=4, chunk_size=5, part_workers=2)
+    large_file = os.path.join(DERIVATIVE_DIR, "{}_large.jp2".format(identifier))
+    with open(large_file, "wb") as f:
+        f.write(os.urandom(12 * 1024 * 1024))
+    uploads = matching_files(DERIVATIVE_DIR, prefix=identifier, prepend=True)
+    stats = aws.upload_files(uploads, "images")
+    assert stats["files"] == len(uploads)
+    assert stats["bytes"] == sum(os.path.getsize(f) for f in uploads)
+    assert stats["bytes_per_second"] > 0
+    keys = [obj["Key"] for obj in aws.s3.meta.client.list_objects_v2(
+        Bucket=bucket, Prefix="images/")["Contents"]]
+    assert sorted(keys) == sorted(
+        "images/{}".format(os.path.splitext(os.path.basename(f))[0]) for f in uploads)
+    large_object = aws.s3.meta.client.head_object(
+        Bucket=bucket, Key="images/{}_large".format(identifier))
+    assert large_object["ContentType"] == "image/jp2"
+    assert large_object["ETag"].endswith('-3"')
+    os.remove(large_file)
 
 
 def teardown():
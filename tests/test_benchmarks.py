@@ -0,0 +1,115 @@
+import hashlib
+import os
+import shutil
+import sys
+from unittest.mock import patch
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, "benchmarks")
+
+from run_benchmarks import compare, generate_tiffs, run_benchmarks  # noqa: E402
+from scale_test import (ArchivesSpaceStub, _percentile,  # noqa: E402
+                        generate_objects, run_scale_test)
+
+BENCHMARK_DIR = os.path.join("/", "benchmark")
+
+
+def setup():
+    if os.path.isdir(BENCHMARK_DIR):
+        shutil.rmtree(BENCHMARK_DIR)
+    os.makedirs(BENCHMARK_DIR)
+
+
+def test_generate_tiffs():
+    """Ensures synthetic pages have the requested size, bit depth and samples."""
+    for bits, samples, mode in [(8, 3, "RGB"), (8, 1, "L"), (16, 1, "I;16")]:
+        directory = os.path.join(BENCHMARK_DIR, "{}_{}".format(bits, samples))
+        os.makedirs(directory)
+        files = generate_tiffs(directory, 2, 64, 96, bits, samples)
+        assert len(files) == 2
+        with Image.open(files[0]) as img:
+            assert img.size == (64, 96)
+            assert img.mode == mode
+
+
+def test_run_benchmarks():
+    """Ensures every benchmark runs and reports its throughput."""
+    results = run_benchmarks(
+        os.path.join(BENCHMARK_DIR, "run"), pages=2, width=200, height=300,
+        canvases=20, files=50, workers=2, repeat=1)
+    assert set(results) == {
+        "create_jp2", "create_jp2_grayscale", "calculate_layers", "create_manifest", "create_access_pdf",
+        "matching_files"}
+    assert results["create_manifest"]["count"] == 20
+    assert all(result["per_second"] > 0 for result in results.values())
+    only = run_benchmarks(os.path.join(BENCHMARK_DIR, "only"), pages=2, width=200, height=300,
+                          canvases=20, files=50, repeat=1, only=["create_access_pdf"])
+    assert set(only) == {"create_access_pdf"}
+
+
+def test_compare():
+    """Ensures only drops in throughput beyond the threshold are regressions."""
+    baseline = {"fast": {"per_second": 100.0}, "slow": {"per_second": 100.0}}
+    results = {"fast": {"per_second": 85.0}, "slow": {"per_second": 70.0}, "new": {"per_second": 1.0}}
+    assert compare(results, baseline, 0.2) == [("slow", 100.0, 70.0, -0.3)]
+    assert compare(results, baseline, 0.1) == [("fast", 100.0, 85.0, -0.15), ("slow", 100.0, 70.0, -0.3)]
+
+
+def test_archivesspace_stub():
+    """Ensures the ArchivesSpace stand-in delays each path by the same amount on every run."""
+    stub = ArchivesSpaceStub(latency=0.1, jitter=0.2, seed=1)
+    try:
+        assert 0.1 <= stub.delay("/version") <= 0.3
+        assert stub.delay("/version") == ArchivesSpaceStub(latency=0.1, jitter=0.2, seed=1).delay("/version")
+        assert stub.delay("/version") != ArchivesSpaceStub(latency=0.1, jitter=0.2, seed=2).delay("/version")
+    finally:
+        stub.server_close()
+
+
+def test_generate_objects():
+    """Ensures the same seed creates the same objects whether pages are linked or copied."""
+    linked_dir = os.path.join(BENCHMARK_DIR, "linked", "source")
+    copied_dir = os.path.join(BENCHMARK_DIR, "copied", "source")
+    linked_pages = generate_objects(linked_dir, 5, 3, 20, 30, seed=4)
+    with patch("scale_test.os.link", side_effect=OSError):
+        copied_pages = generate_objects(copied_dir, 5, 3, 20, 30, seed=4)
+    assert linked_pages == copied_pages
+    assert _object_pages(linked_dir) == _object_pages(copied_dir)
+
+
+def test_percentile():
+    """Ensures percentiles are taken by the nearest rank."""
+    values = list(range(1, 101))
+    assert _percentile(values, 50) == 50
+    assert _percentile(values, 99) == 99
+    assert _percentile([3.0], 95) == 3.0
+
+
+def test_run_scale_test():
+    """Ensures a whole run against the stand-ins is measured."""
+    pytest.importorskip("flask")
+    report = run_scale_test(os.path.join(BENCHMARK_DIR, "scale"), objects=3, pages=2, width=200, height=300,
+                            latency=0, jitter=0.01, settings={"Pipeline": {"image_workers": "2"}})
+    assert report["failed"] == 0
+    assert report["objects_per_hour"] > 0
+    assert report["durations"]["object"]["count"] == 3
+    assert report["durations"]["archivesspace_lookup"]["count"] == 3
+    assert report["durations"]["upload_file"]["count"] >= 6
+    assert report["settings"]["Pipeline"]["image_workers"] == "2"
+
+
+def _object_pages(source_dir):
+    """Gets a digest of the content of each page of each object."""
+    pages = {}
+    for ref_id in sorted(os.listdir(source_dir)):
+        master_dir = os.path.join(source_dir, ref_id, "master")
+        for page in sorted(os.listdir(master_dir)):
+            with open(os.path.join(master_dir, page), "rb") as f:
+                pages[page] = hashlib.md5(f.read()).hexdigest()
+    return pages
+
+
+def teardown():
+    shutil.rmtree(BENCHMARK_DIR)
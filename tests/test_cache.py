@@ -0,0 +1,79 @@
+import os
+import shutil
+from unittest.mock import patch
+
+from helpers import random_string
+from iiif_pipeline.cache import DerivativeCache, MetadataCache
+
+CACHE_DIR = os.path.join("/", "cache")
+
+
+def setup():
+    if os.path.isdir(CACHE_DIR):
+        shutil.rmtree(CACHE_DIR)
+
+
+def test_metadata_cache():
+    """Ensures cached data persists and expires."""
+    ref_id = random_string()
+    data = {"title": random_string(), "dates": "1945-1950", "uri": random_string()}
+    cache = MetadataCache(os.path.join(CACHE_DIR, "metadata.db"), ttl=60)
+    assert cache.get(ref_id) is None
+    cache.set(ref_id, data)
+    assert cache.get(ref_id) == data
+    assert MetadataCache(os.path.join(CACHE_DIR, "metadata.db")).get(ref_id) == data
+    assert (cache.hits, cache.misses) == (1, 1)
+    with patch("iiif_pipeline.cache.time.time") as mock_time:
+        mock_time.return_value = 10 ** 11
+        assert cache.get(ref_id) is None
+    assert cache.misses == 2
+
+
+def test_derivative_cache():
+    """Ensures cached files are returned, and least recently used files are evicted."""
+    source_dir = os.path.join(CACHE_DIR, "source")
+    os.makedirs(source_dir)
+    sources = []
+    for idx in range(3):
+        source = os.path.join(source_dir, "{}.tif".format(idx))
+        with open(source, "wb") as f:
+            f.write(os.urandom(1000))
+        sources.append(source)
+    cache = DerivativeCache(os.path.join(CACHE_DIR, "derivatives"), 2500)
+    keys = [cache.key(source, ["-r", "1.5"]) for source in sources]
+    assert cache.key(sources[0], ["-r", "2"]) != keys[0]
+    destination = os.path.join(source_dir, "derivative.jp2")
+    assert not cache.get(keys[0], destination)
+    for key, source in zip(keys, sources):
+        cache.put(key, source)
+    assert not cache.get(keys[0], destination)
+    assert cache.get(keys[1], destination)
+    with open(destination, "rb") as d, open(sources[1], "rb") as s:
+        assert d.read() == s.read()
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert cache.hit_rate == 1 / 3
+    assert not DerivativeCache(
+        os.path.join(CACHE_DIR, "derivatives"), 2500, bypass=True).get(keys[1], destination)
+
+
+def test_derivative_cache_isolation():
+    """Ensures cached files do not change when their source is rewritten, and evicted files are misses."""
+    source_dir = os.path.join(CACHE_DIR, "isolation")
+    os.makedirs(source_dir)
+    source = os.path.join(source_dir, "derivative.jp2")
+    with open(source, "wb") as f:
+        f.write(b"first")
+    cache = DerivativeCache(os.path.join(CACHE_DIR, "isolated"), 2500)
+    key = cache.key(source, [])
+    cache.put(key, source)
+    with open(source, "wb") as f:
+        f.write(b"second")
+    with open(cache.path(key), "rb") as f:
+        assert f.read() == b"first"
+    with patch("iiif_pipeline.cache._link_or_copy", side_effect=FileNotFoundError):
+        assert not cache.get(key, os.path.join(source_dir, "copy.jp2"))
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def teardown():
+    shutil.rmtree(CACHE_DIR)
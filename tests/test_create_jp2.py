@@ -1,17 +1,24 @@
 import os
 import random
+import re
 import shutil
 
 import pytest
-from helpers import copy_sample_files, random_string
+from helpers import copy_sample_files, random_string, write_tiff
+from iiif_pipeline.analysis import analyze_pages
+from iiif_pipeline.cache import DerivativeCache
 from iiif_pipeline.derivatives import create_jp2
-from iiif_pipeline.helpers import matching_files
+from iiif_pipeline.encoders import StreamingEncoder
+from iiif_pipeline.helpers import cleanup_files, get_page_number, matching_files
+from iiif_pipeline.probe import probe_jp2
+from PIL import Image, ImageDraw
 
 FIXTURES_FILEPATH = os.path.join("fixtures", "tif")
 SOURCES = [os.path.join("/", "source"),
            os.path.join("/", "source folder")]
 DERIVATIVES = [os.path.join("/", "derivatives"),
                os.path.join("/", "derivatives folder")]
+CACHE_DIR = os.path.join("/", "cache")
 UUIDS = [random_string() for x in range(random.randint(2, 3))]
 PAGE_COUNT = random.randint(1, 5)
 
@@ -42,6 +49,105 @@ def test_create_jp2():
             assert ".tif" not in f
 
 
+def test_create_jp2_workers():
+    """Ensure pages encoded in parallel produce the expected files."""
+    for SOURCE_DIR, DERIVATIVE_DIR in zip(SOURCES, DERIVATIVES):
+        uuid = random.choice(UUIDS)
+        tiff_files = matching_files(
+            SOURCE_DIR,
+            prefix=uuid,
+            skip=False,
+            prepend=True)
+        create_jp2(tiff_files, uuid, DERIVATIVE_DIR, replace=True, workers=4)
+        assert len(matching_files(DERIVATIVE_DIR, prefix=uuid)) == PAGE_COUNT
+        cleanup_files(uuid, [DERIVATIVE_DIR])
+
+
+def test_create_jp2_failure():
+    """Ensure a failed page is reported and no invalid files are encoded."""
+    for SOURCE_DIR, DERIVATIVE_DIR in zip(SOURCES, DERIVATIVES):
+        uuid = random.choice(UUIDS)
+        tiff_files = matching_files(
+            SOURCE_DIR,
+            prefix=uuid,
+            skip=False,
+            prepend=True)
+        invalid_file = os.path.join(SOURCE_DIR, "{}_999_se.tif".format(uuid))
+        with open(invalid_file, "w") as f:
+            f.write("not a tiff")
+        with pytest.raises(Exception, match=re.escape(invalid_file)):
+            create_jp2(tiff_files + [invalid_file], uuid, DERIVATIVE_DIR,
+                       replace=True, workers=4)
+        os.remove(invalid_file)
+        with pytest.raises(Exception, match="is not a valid TIFF"):
+            create_jp2(tiff_files + [os.path.join(SOURCE_DIR, "sample.jpg")],
+                       uuid, DERIVATIVE_DIR, replace=True, workers=4)
+        with pytest.raises(Exception, match="unknown derivative format"):
+            create_jp2(tiff_files, uuid, DERIVATIVE_DIR, replace=True,
+                       derivative_format="jpx")
+        cleanup_files(uuid, [DERIVATIVE_DIR])
+
+
+def test_create_jp2_cache():
+    """Ensure pages whose source has not changed are taken from the cache."""
+    for SOURCE_DIR, DERIVATIVE_DIR in zip(SOURCES, DERIVATIVES):
+        uuid = random.choice(UUIDS)
+        tiff_files = matching_files(
+            SOURCE_DIR,
+            prefix=uuid,
+            skip=False,
+            prepend=True)
+        cache = DerivativeCache(CACHE_DIR, 1024 * 1024 * 1024)
+        create_jp2(tiff_files, uuid, DERIVATIVE_DIR, replace=True, cache=cache)
+        assert cache.hits + cache.misses == PAGE_COUNT
+        hits = cache.hits
+        create_jp2(tiff_files, uuid, DERIVATIVE_DIR, replace=True, cache=cache)
+        assert len(matching_files(DERIVATIVE_DIR, prefix=uuid)) == PAGE_COUNT
+        assert cache.hits == hits + PAGE_COUNT
+        derivative = matching_files(DERIVATIVE_DIR, prefix=uuid, prepend=True)[0]
+        linked = os.stat(derivative).st_ino
+        create_jp2(tiff_files, uuid, DERIVATIVE_DIR, replace=True,
+                   cache=DerivativeCache(CACHE_DIR, 1024 * 1024 * 1024, bypass=True))
+        assert os.stat(derivative).st_ino != linked
+        cleanup_files(uuid, [DERIVATIVE_DIR])
+        shutil.rmtree(CACHE_DIR)
+
+
+def test_create_jp2_profiles():
+    """Ensure each page is encoded with a profile suited to its content."""
+    SOURCE_DIR, DERIVATIVE_DIR = SOURCES[0], DERIVATIVES[0]
+    uuid = random_string()
+    gray = Image.new("RGB", (400, 300), (230, 230, 230))
+    ImageDraw.Draw(gray).rectangle([50, 50, 350, 100], fill=(30, 30, 30))
+    gray.save(os.path.join(SOURCE_DIR, "{}_001.tif".format(uuid)))
+    color = gray.copy()
+    ImageDraw.Draw(color).rectangle([50, 150, 350, 250], fill=(200, 30, 30))
+    color.save(os.path.join(SOURCE_DIR, "{}_002.tif".format(uuid)))
+    gray.convert("1").save(os.path.join(SOURCE_DIR, "{}_003.tif".format(uuid)))
+    tiff_files = matching_files(SOURCE_DIR, prefix=uuid, prepend=True)
+    analyses = dict(zip([get_page_number(f) for f in tiff_files], analyze_pages(tiff_files)))
+    pages = create_jp2(tiff_files, uuid, DERIVATIVE_DIR, replace=True, analyses=analyses)
+    assert [page["profile"] for page in pages] == ["grayscale", "default", "bitonal"]
+    assert [probe_jp2(page["derivative"])["components"] for page in pages] == [1, 3, 1]
+    cleanup_files(uuid, [SOURCE_DIR, DERIVATIVE_DIR])
+
+
+@pytest.mark.skipif(not StreamingEncoder().available(), reason="glymur cannot write tiles")
+def test_create_jp2_streaming():
+    """Ensure only large, uncompressed pages are streamed through the encoder."""
+    SOURCE_DIR, DERIVATIVE_DIR = SOURCES[0], DERIVATIVES[0]
+    uuid = random_string()
+    write_tiff(os.path.join(SOURCE_DIR, "{}_001.tif".format(uuid)), 1200, 1100, 3)
+    write_tiff(os.path.join(SOURCE_DIR, "{}_002.tif".format(uuid)), 300, 200, 3)
+    Image.new("RGB", (1200, 1100)).save(
+        os.path.join(SOURCE_DIR, "{}_003.tif".format(uuid)), compression="tiff_lzw")
+    tiff_files = matching_files(SOURCE_DIR, prefix=uuid, prepend=True)
+    pages = create_jp2(tiff_files, uuid, DERIVATIVE_DIR, replace=True, stream_pixels=1000000)
+    assert [page["encoder"] for page in pages] == ["streaming", "opj", "opj"]
+    assert probe_jp2(pages[0]["derivative"])["width"] == 1100
+    cleanup_files(uuid, [SOURCE_DIR, DERIVATIVE_DIR])
+
+
 def test_replace_jp2():
     """Ensure replacing of files is handled correctly.
 
@@ -1,15 +1,25 @@
+import io
 import os
 import random
+import re
 import shutil
+from unittest.mock import patch
 
+import img2pdf
 import pytest
 from helpers import copy_sample_files, random_string
-from iiif_pipeline.derivatives import create_pdf
-from iiif_pipeline.helpers import matching_files
+from iiif_pipeline.cache import DerivativeCache
+from iiif_pipeline.derivatives import (create_access_pdf, create_pdf,
+                                       downsample_levels, downsample_page)
+from iiif_pipeline.helpers import get_page_number, matching_files
+from iiif_pipeline.instrumentation import run_command
+from iiif_pipeline.probe import probe_jp2
+from PIL import Image
 
 FIXTURE_FILEPATH = os.path.join("fixtures", "jp2")
 DERIVATIVE_DIR = os.path.join("/", "derivatives")
 PDF_DIR = os.path.join("/", "pdfs")
+CACHE_DIR = os.path.join("/", "ocr_cache")
 UUIDS = [random_string() for x in range(random.randint(1, 3))]
 PAGE_COUNT = random.randint(1, 5)
 
@@ -53,6 +63,88 @@ def test_replace_pdf():
     create_pdf(jp2_files, identifier, PDF_DIR, replace=True)
 
 
+def test_create_access_pdf():
+    """Ensure the access PDF has one page per file at the same size as the concatenated PDF."""
+    identifier = random.choice(UUIDS)
+    jp2_files = matching_files(
+        DERIVATIVE_DIR,
+        prefix=identifier,
+        prepend=True)
+    create_access_pdf(jp2_files, identifier, PDF_DIR, replace=True, ocr=False)
+    pdf_path = os.path.join(PDF_DIR, "{}.pdf".format(identifier))
+    with open(pdf_path, "rb") as f:
+        pdf = f.read()
+    assert pdf.startswith(b"%PDF")
+    assert len(re.findall(rb"/Type /Page\b", pdf)) == len(jp2_files)
+    expected = img2pdf.convert(jp2_files)
+    assert expected.split(b"/MediaBox")[1][:40] == pdf.split(b"/MediaBox")[1][:40]
+    with pytest.raises(FileExistsError):
+        create_access_pdf(jp2_files, identifier, PDF_DIR, ocr=False)
+    os.remove(pdf_path)
+
+
+def test_create_access_pdf_ocr_cache():
+    """Ensure OCR text layers are cached and reused when a PDF is rebuilt, with or without replace."""
+    identifier = random.choice(UUIDS)
+    jp2_files = matching_files(
+        DERIVATIVE_DIR,
+        prefix=identifier,
+        prepend=True)
+    pdf_path = os.path.join(PDF_DIR, "{}.pdf".format(identifier))
+    cache = DerivativeCache(CACHE_DIR, 1024 * 1024 * 1024)
+    with patch("iiif_pipeline.derivatives.run_command", side_effect=run_command) as mock_run:
+        create_access_pdf(jp2_files, identifier, PDF_DIR, replace=True, workers=2, cache=cache)
+        assert mock_run.call_count == cache.misses
+    hits, misses = cache.hits, cache.misses
+    assert hits + misses == len(jp2_files)
+    os.remove(pdf_path)
+    with patch("iiif_pipeline.derivatives.run_command") as mock_run:
+        create_access_pdf(jp2_files, identifier, PDF_DIR, workers=2, cache=cache)
+        assert mock_run.call_count == 0
+        create_access_pdf(jp2_files, identifier, PDF_DIR, replace=True, workers=2, cache=cache)
+        assert mock_run.call_count == 0
+    assert cache.misses == misses
+    assert cache.hits == hits + 2 * len(jp2_files)
+    with open(pdf_path, "rb") as f:
+        assert len(re.findall(rb"/Type /Page\b", f.read())) == len(jp2_files)
+    os.remove(pdf_path)
+
+
+def test_create_access_pdf_blank_pages():
+    """Ensure blank pages are not OCRed."""
+    identifier = random.choice(UUIDS)
+    jp2_files = matching_files(
+        DERIVATIVE_DIR,
+        prefix=identifier,
+        prepend=True)
+    with patch("iiif_pipeline.derivatives.ocr_page") as mock_ocr_page:
+        create_access_pdf(
+            jp2_files, identifier, PDF_DIR, replace=True,
+            blank_pages=set(get_page_number(f) for f in jp2_files))
+        assert not mock_ocr_page.called
+    os.remove(os.path.join(PDF_DIR, "{}.pdf".format(identifier)))
+
+
+def test_downsample_page():
+    """Ensures large pages are scaled down to the pixel limit and decoded at a reduced resolution level."""
+    path = os.path.join(DERIVATIVE_DIR, "large.jp2")
+    Image.new("RGB", (4000, 3000), (200, 180, 160)).save(path, num_resolutions=5)
+    info = probe_jp2(path)
+    assert downsample_levels(info, 0.75) == (0.75, 0)
+    assert downsample_levels(info, 0.25) == (0.25, 2)
+    scale, reduce = downsample_levels(info, 0.75, 1000000)
+    assert reduce == 1
+    resize = Image.Image.resize
+    with patch.object(Image.Image, "resize", autospec=True, side_effect=resize) as mock_resize:
+        page = downsample_page(path, 0.75, 50, 1000000)
+    assert mock_resize.call_args[0][0].size == (2000, 1500)
+    with Image.open(io.BytesIO(page)) as img:
+        assert img.size == (round(4000 * scale), round(3000 * scale))
+        assert round(img.info["dpi"][0]) == round(96 * scale)
+
+
 def teardown():
     """Remove derivative directory."""
     shutil.rmtree(DERIVATIVE_DIR)
+    if os.path.isdir(CACHE_DIR):
+        shutil.rmtree(CACHE_DIR)
@@ -0,0 +1,244 @@
+import os
+import shutil
+import subprocess
+import sys
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+from helpers import write_tiff
+from iiif_pipeline.derivatives import (DERIVATIVE_FORMATS, ENCODING_PROFILES,
+                                       calculate_layers)
+from iiif_pipeline.encoders import (CONVERSION_PIXELS, ENCODERS, GrokEncoder,
+                                    OpenJPEGEncoder, PillowEncoder,
+                                    StreamingEncoder, benchmark_encoders,
+                                    can_stream, convert_tiff, get_encoder,
+                                    read_rows)
+from iiif_pipeline.probe import probe_jp2, probe_tiff
+from PIL import Image
+
+ENCODER_DIR = os.path.join("/", "encoders")
+SOURCE = os.path.join(ENCODER_DIR, "page.tif")
+LARGE_SOURCE = os.path.join(ENCODER_DIR, "large.tif")
+HTJ2K_FIXTURE = os.path.join("fixtures", "htj2k", "sample.j2c")
+GRK_COMPRESS = """#!{python}
+import shutil, sys
+args = sys.argv[1:]
+with open({log!r}, "a") as f:
+    f.write(" ".join(args) + "\\n")
+shutil.copy({htj2k!r} if "-M" in args else {classic!r}, args[args.index("-o") + 1])
+"""
+PEAK_RSS = """
+import resource, sys
+from iiif_pipeline.derivatives import ENCODING_PROFILES, calculate_layers
+from iiif_pipeline.encoders import StreamingEncoder
+StreamingEncoder().encode(
+    sys.argv[1], sys.argv[2], calculate_layers(sys.argv[1]), ENCODING_PROFILES["default"])
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def setup():
+    """Creates a sample page."""
+    if os.path.isdir(ENCODER_DIR):
+        shutil.rmtree(ENCODER_DIR)
+    os.makedirs(ENCODER_DIR)
+    Image.new("RGB", (600, 400), (200, 180, 160)).save(SOURCE)
+
+
+def test_options():
+    """Ensures profiles are mapped to the options of each encoder."""
+    assert OpenJPEGEncoder().options(5, ENCODING_PROFILES["default"]) == [
+        "-n", "5", "-SOP", "-r", "1.5",
+        "-c", "[256,256],[256,256],[128,128]",
+        "-b", "64,64",
+        "-p", "RPCL"]
+    assert "-r" not in OpenJPEGEncoder().options(5, ENCODING_PROFILES["bitonal"])
+    assert GrokEncoder().options(5, ENCODING_PROFILES["default"])[2] == "-S"
+    options = PillowEncoder().options(5, ENCODING_PROFILES["default"])
+    assert options["num_resolutions"] == 5
+    assert options["quality_layers"] == [1.5]
+    assert options["precinct_size"] == (256, 256)
+    assert not PillowEncoder().options(5, ENCODING_PROFILES["bitonal"])["irreversible"]
+
+
+def test_encode_mode():
+    """Ensures pages converted for a profile are written beside the destination and removed."""
+    destination = os.path.join(ENCODER_DIR, "gray.jp2")
+    converted = []
+
+    def check_source(args, **kwargs):
+        source = args[args.index("-i") + 1]
+        with Image.open(source) as img:
+            converted.append((source, img.mode))
+
+    with patch("iiif_pipeline.encoders.run_command", side_effect=check_source):
+        OpenJPEGEncoder().encode(SOURCE, destination, 4, ENCODING_PROFILES["grayscale"])
+        OpenJPEGEncoder().encode(SOURCE, destination, 4, ENCODING_PROFILES["default"])
+    (source, mode), (original, original_mode) = converted
+    assert os.path.dirname(source) == ENCODER_DIR
+    assert os.path.basename(source).startswith(".")
+    assert mode == "L" and not os.path.exists(source)
+    assert (original, original_mode) == (SOURCE, "RGB")
+
+
+def test_convert_tiff():
+    """Ensures uncompressed pages are converted to grayscale a band of rows at a time, as Pillow converts them."""
+    pixels = np.random.RandomState(0).randint(0, 256, (2100, 2300, 3), dtype=np.uint8)
+    uncompressed = os.path.join(ENCODER_DIR, "color.tif")
+    compressed = os.path.join(ENCODER_DIR, "color_lzw.tif")
+    write_tiff(uncompressed, 2100, 2300, 3, rows=lambda top, bottom: pixels[top:bottom])
+    Image.fromarray(pixels).save(compressed, compression="tiff_lzw")
+    assert CONVERSION_PIXELS // 2300 < 2100
+    expected = np.asarray(Image.fromarray(pixels).convert("L")).astype(int)
+    for source in [uncompressed, compressed]:
+        destination = os.path.join(ENCODER_DIR, "gray.tif")
+        convert_tiff(source, destination, "L")
+        with Image.open(destination) as img:
+            assert img.mode == "L"
+            assert np.abs(np.asarray(img).astype(int) - expected).max() <= 1
+        assert probe_tiff(destination)["samples_per_pixel"] == 1
+
+
+def test_htj2k_options():
+    """Ensures only encoders with the HT block coder accept HTJ2K profiles."""
+    profile = dict(ENCODING_PROFILES["default"], **DERIVATIVE_FORMATS["htj2k"])
+    assert GrokEncoder().supports(profile)
+    assert GrokEncoder().options(5, profile)[-2:] == ["-M", "64"]
+    for encoder in [OpenJPEGEncoder(), PillowEncoder()]:
+        assert not encoder.supports(profile)
+        with pytest.raises(Exception, match="HTJ2K"):
+            encoder.encode(SOURCE, os.path.join(ENCODER_DIR, "page.jp2"), 4, profile)
+
+
+def test_htj2k_command():
+    """Ensures Grok is asked for the HT block coder, and that HTJ2K files are
+    recognized by their code block style.
+
+    `grk_compress` is replaced by a script which records its arguments and
+    copies an HTJ2K fixture, or a classic JP2 file, to the destination.
+    """
+    command = os.path.join(ENCODER_DIR, "grk_compress")
+    log = os.path.join(ENCODER_DIR, "grk_compress.log")
+    classic = os.path.join(ENCODER_DIR, "classic.jp2")
+    Image.open(SOURCE).save(classic)
+    with open(command, "w") as f:
+        f.write(GRK_COMPRESS.format(
+            python=sys.executable, log=log, htj2k=os.path.abspath(HTJ2K_FIXTURE), classic=classic))
+    os.chmod(command, 0o755)
+    destinations = []
+    with patch.object(GrokEncoder, "command", command):
+        assert GrokEncoder().available()
+        for derivative_format, options in DERIVATIVE_FORMATS.items():
+            destination = os.path.join(ENCODER_DIR, "grok_{}.jp2".format(derivative_format))
+            GrokEncoder().encode(SOURCE, destination, 4, dict(ENCODING_PROFILES["default"], **options))
+            destinations.append(destination)
+            assert probe_jp2(destination)["htj2k"] == (derivative_format == "htj2k")
+    with open(log) as f:
+        classic_command, htj2k_command = f.read().splitlines()
+    assert classic_command == " ".join([
+        "-i", SOURCE, "-o", destinations[0], "-n", "4", "-S", "-r", "1.5",
+        "-c", "[256,256],[256,256],[128,128]", "-b", "64,64", "-p", "RPCL"])
+    assert htj2k_command == classic_command.replace(destinations[0], destinations[1]) + " -M 64"
+    info = probe_jp2(HTJ2K_FIXTURE)
+    assert (info["width"], info["height"], info["code_block_style"]) == (64, 48, 64)
+
+
+@pytest.mark.skipif(not GrokEncoder().available(), reason="Grok is not installed")
+def test_htj2k():
+    """Ensures HTJ2K files keep the dimensions and resolution levels of the
+    current profile.
+
+    Encoding speed is compared by `--benchmark_encoders` rather than here.
+    """
+    Image.fromarray(np.random.RandomState(0).randint(
+        0, 256, (3000, 2000, 3), dtype=np.uint8)).save(LARGE_SOURCE)
+    layers = calculate_layers(LARGE_SOURCE)
+    for derivative_format, options in DERIVATIVE_FORMATS.items():
+        destination = os.path.join(ENCODER_DIR, "{}.jp2".format(derivative_format))
+        GrokEncoder().encode(
+            LARGE_SOURCE, destination, layers, dict(ENCODING_PROFILES["default"], **options))
+        info = probe_jp2(destination)
+        assert (info["width"], info["height"]) == (2000, 3000)
+        assert info["levels"] == layers - 1
+        assert info["code_block"] == (64, 64)
+        assert info["htj2k"] == (derivative_format == "htj2k")
+
+
+def test_read_rows():
+    """Ensures bands of rows are read from strips and tiles, in any order."""
+    pixels = np.random.RandomState(0).randint(0, 256, (700, 530, 3), dtype=np.uint8)
+    path = os.path.join(ENCODER_DIR, "layout.tif")
+    for layout in [{}, {"reverse": True}, {"tile_size": 256}, {"tile_size": 256, "reverse": True}]:
+        write_tiff(path, 700, 530, 3, rows=lambda top, bottom: pixels[top:bottom], **layout)
+        info = probe_tiff(path)
+        assert can_stream(info)
+        with open(path, "rb") as f:
+            assert (read_rows(f, info, 100, 650) == pixels[100:650]).all()
+    Image.fromarray(pixels).save(path, compression="tiff_lzw")
+    assert not can_stream(probe_tiff(path))
+
+
+@pytest.mark.skipif(not StreamingEncoder().available(), reason="glymur cannot write tiles")
+def test_streaming_encoder():
+    """Ensures streamed pages are encoded losslessly with the expected
+    dimensions, and that peak memory does not grow with the page height."""
+    pixels = np.random.RandomState(0).randint(0, 256, (1500, 1200, 3), dtype=np.uint8)
+    path = os.path.join(ENCODER_DIR, "streamed.tif")
+    destination = os.path.join(ENCODER_DIR, "streamed.jp2")
+    write_tiff(path, 1500, 1200, 3, rows=lambda top, bottom: pixels[top:bottom], tile_size=512)
+    StreamingEncoder().encode(path, destination, calculate_layers(path), ENCODING_PROFILES["bitonal"])
+    info = probe_jp2(destination)
+    assert (info["width"], info["height"], info["levels"]) == (1200, 1500, calculate_layers(path) - 1)
+    import glymur
+    assert (glymur.Jp2k(destination)[:] == pixels).all()
+    StreamingEncoder().encode(path, destination, calculate_layers(path), ENCODING_PROFILES["grayscale"])
+    assert probe_jp2(destination)["components"] == 1
+    heights = [4000, 16000]
+    peak_rss = []
+    for height in heights:
+        write_tiff(path, height, 2000)
+        output = subprocess.run(
+            [sys.executable, "-c", PEAK_RSS, path, destination],
+            stdout=subprocess.PIPE, check=True)
+        peak_rss.append(int(output.stdout))
+    growth = (heights[1] - heights[0]) * 2000 / 1024
+    assert peak_rss[1] - peak_rss[0] < growth / 4
+
+
+def test_get_encoder():
+    """Ensures unknown and unavailable encoders are reported."""
+    assert isinstance(get_encoder("pillow"), PillowEncoder)
+    with pytest.raises(Exception, match="Unknown JPEG2000 encoder"):
+        get_encoder("kakadu")
+
+
+def test_pillow_encoder():
+    """Ensures the in-process encoder applies the profile, including its mode."""
+    destination = os.path.join(ENCODER_DIR, "page.jp2")
+    PillowEncoder().encode(SOURCE, destination, 4, ENCODING_PROFILES["default"])
+    info = probe_jp2(destination)
+    assert (info["width"], info["height"], info["components"]) == (600, 400, 3)
+    assert info["levels"] == 3
+    assert info["progression"] == "RPCL"
+    assert not info["htj2k"]
+    PillowEncoder().encode(SOURCE, destination, 4, ENCODING_PROFILES["grayscale"])
+    assert probe_jp2(destination)["components"] == 1
+
+
+def test_benchmark_encoders():
+    """Ensures every available encoder is measured."""
+    results = benchmark_encoders(
+        [{"source": SOURCE, "layers": 4}] * 2, ENCODER_DIR, ENCODING_PROFILES["default"])
+    assert [result["encoder"] for result in results] == [
+        name for name, encoder in ENCODERS.items() if encoder().available()]
+    for result in results:
+        assert result["pages"] == 2
+        assert result["pages_per_second"] > 0
+        assert result["peak_rss"] > 0
+        assert result["output_bytes"] > 0
+
+
+def teardown():
+    """Removes the sample page."""
+    shutil.rmtree(ENCODER_DIR)
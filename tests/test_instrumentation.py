@@ -0,0 +1,211 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from iiif_pipeline.instrumentation import (MetricsSink, ProfileSink,
+                                           TraceSink, activate, add_sink,
+                                           close_span, current_span,
+                                           in_current_span, open_span,
+                                           remove_sink, run_command, span)
+
+METRICS_DIR = os.path.join("/", "metrics")
+BUSY_COMMAND = [sys.executable, "-c", "sum(i * i for i in range(3000000))"]
+
+
+class RecordingSink:
+    def __init__(self):
+        self.started = []
+        self.finished = []
+
+    def start(self, span):
+        self.started.append(span.name)
+
+    def finish(self, span):
+        self.finished.append(span)
+
+
+def setup():
+    if os.path.isdir(METRICS_DIR):
+        shutil.rmtree(METRICS_DIR)
+    os.makedirs(METRICS_DIR)
+
+
+def test_span():
+    """Ensures spans are nested, timed, counted and sent to sinks."""
+    sink = RecordingSink()
+    add_sink(sink)
+    try:
+        with span("outer", {"stage": "images"}, ref_id="ref") as outer:
+            with span("inner") as inner:
+                assert current_span() is inner
+                assert inner.parent is outer
+                inner.add(pages=1, bytes_in=10)
+            with pytest.raises(ValueError):
+                with span("failing"):
+                    raise ValueError()
+            assert current_span() is outer
+    finally:
+        remove_sink(sink)
+    assert current_span() is None
+    assert sink.started == ["outer", "inner", "failing"]
+    assert [s.name for s in sink.finished] == ["inner", "failing", "outer"]
+    inner, failing, outer = sink.finished
+    assert inner.counts == {"bytes_in": 10, "bytes_out": 0, "pages": 1}
+    assert failing.failed and not outer.failed
+    assert outer.details == {"ref_id": "ref"}
+    assert outer.wall_seconds >= inner.wall_seconds > 0
+
+
+def test_span_without_sinks():
+    """Ensures nothing is timed or tracked while no sink is added."""
+    with span("outer", {"stage": "images"}) as outer:
+        outer.add(pages=1)
+        outer.labels["cached"] = "true"
+        assert current_span() is None
+        assert run_command([sys.executable, "-c", "pass"]).returncode == 0
+    obj = open_span("object", ref_id="ref")
+    obj.details["identifier"] = "identifier"
+    with activate(obj), span("stage"):
+        pass
+    close_span(obj, failed=True)
+    assert not hasattr(outer, "wall_seconds") and not hasattr(obj, "wall_seconds")
+
+
+def test_run_command():
+    """Ensures the CPU time of commands is added to their span and enclosing spans."""
+    sink = RecordingSink()
+    add_sink(sink)
+    try:
+        with span("outer"):
+            result = run_command(BUSY_COMMAND, stderr=subprocess.PIPE, check=True)
+    finally:
+        remove_sink(sink)
+    command, outer = sink.finished
+    assert result.returncode == 0
+    assert result.stderr == b""
+    assert command.labels == {"command": os.path.basename(sys.executable)}
+    assert command.cpu_seconds > 0.05
+    assert outer.cpu_seconds >= command.cpu_seconds
+    with pytest.raises(subprocess.CalledProcessError):
+        run_command([sys.executable, "-c", "import sys; sys.exit(3)"], check=True)
+    assert run_command([sys.executable, "-c", "import sys; sys.exit(3)"]).returncode == 3
+
+
+def test_metrics_sink():
+    """Ensures spans are totalled by name and labels and exported."""
+    metrics = MetricsSink()
+    add_sink(metrics)
+    try:
+        threads = [threading.Thread(target=_encode, args=(encoder,)) for encoder in ["opj", "opj", "grok"]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        remove_sink(metrics)
+    summary = metrics.summary()
+    totals = {(s["span"], s["labels"].get("encoder")): s for s in summary["spans"]}
+    assert totals[("encode_page", "opj")]["count"] == 2
+    assert totals[("encode_page", "opj")]["pages"] == 2
+    assert totals[("encode_page", "opj")]["bytes_out"] == 200
+    assert totals[("encode_page", "grok")]["count"] == 1
+    metrics.write_summary(os.path.join(METRICS_DIR, "summary.json"))
+    with open(os.path.join(METRICS_DIR, "summary.json")) as f:
+        assert len(json.load(f)["spans"]) == 2
+    metrics.write_prometheus(os.path.join(METRICS_DIR, "iiif_pipeline.prom"))
+    with open(os.path.join(METRICS_DIR, "iiif_pipeline.prom")) as f:
+        lines = f.read().splitlines()
+    assert "# TYPE iiif_pipeline_span_pages gauge" in lines
+    assert 'iiif_pipeline_span_pages{{encoder="opj",host="{}",span="encode_page"}} 2'.format(
+        summary["host"]) in lines
+    assert {"iiif_pipeline.prom", "summary.json"} <= set(os.listdir(METRICS_DIR))
+
+
+def test_cross_thread_spans():
+    """Ensures work on other threads is attributed to the spans it is part of."""
+    sink = RecordingSink()
+    add_sink(sink)
+    try:
+        obj = open_span("object", ref_id="ref")
+        with activate(obj), span("stage", identifier="identifier"):
+            encode = in_current_span(_encode)
+        thread = threading.Thread(target=encode, args=("opj",))
+        thread.start()
+        thread.join()
+        close_span(obj, failed=True)
+    finally:
+        remove_sink(sink)
+    assert current_span() is None
+    assert sink.started == ["object", "stage", "encode_page"]
+    encode_span, obj, stage = sorted(sink.finished, key=lambda s: s.name)
+    assert encode_span.parent is stage and stage.parent is obj
+    assert encode_span.context() == {"ref_id": "ref", "identifier": "identifier"}
+    assert obj.detached and obj.failed and obj.cpu_seconds == 0
+
+
+def test_trace_sink():
+    """Ensures spans are written as Chrome trace events."""
+    trace = TraceSink()
+    add_sink(trace)
+    try:
+        obj = open_span("object", ref_id="ref")
+        with activate(obj):
+            _encode("opj")
+        close_span(obj)
+    finally:
+        remove_sink(trace)
+    trace.write(os.path.join(METRICS_DIR, "trace.json"))
+    with open(os.path.join(METRICS_DIR, "trace.json")) as f:
+        events = json.load(f)["traceEvents"]
+    phases = {event["ph"]: event for event in events}
+    assert set(phases) == {"M", "b", "e", "X"}
+    assert phases["M"]["args"]["name"] == threading.current_thread().name
+    assert phases["b"]["id"] == phases["e"]["id"]
+    assert phases["b"]["ts"] <= phases["X"]["ts"] <= phases["e"]["ts"]
+    assert phases["X"]["name"] == "encode_page (encoder=opj)"
+    assert phases["X"]["args"] == {
+        "ref_id": "ref", "encoder": "opj", "pages": "1", "bytes_in": "0", "bytes_out": "100"}
+
+
+def test_profile_sink():
+    """Ensures Python code is profiled per stage, per object and for the run."""
+    profile_dir = os.path.join(METRICS_DIR, "profiles")
+    profile = ProfileSink(profile_dir)
+    add_sink(profile)
+    try:
+        obj = open_span("object", ref_id="ref")
+        with activate(obj), span("stage", {"stage": "images"}):
+            _busy_function()
+            thread = threading.Thread(target=in_current_span(_encode), args=("opj",))
+            thread.start()
+            thread.join()
+        close_span(obj)
+        assert sorted(os.listdir(profile_dir)) == ["object_ref.prof", "object_ref.txt"]
+    finally:
+        remove_sink(profile)
+    profile.write()
+    assert sorted(os.listdir(profile_dir)) == [
+        "object_ref.prof", "object_ref.txt", "run.prof", "run.txt", "stage_images.prof", "stage_images.txt"]
+    with open(os.path.join(profile_dir, "stage_images.txt")) as f:
+        report = f.read()
+    assert "Sorted by tottime" in report and "Sorted by cumulative" in report
+    assert "(_busy_function)" in report
+    assert "(add)" in report
+
+
+def _busy_function():
+    return sum(i * i for i in range(100000))
+
+
+def _encode(encoder):
+    with span("encode_page", {"encoder": encoder}) as current:
+        current.add(pages=1, bytes_out=100)
+
+
+def teardown():
+    shutil.rmtree(METRICS_DIR)
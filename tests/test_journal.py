@@ -0,0 +1,67 @@
+import os
+import sqlite3
+
+import pytest
+from helpers import random_string
+from iiif_pipeline.journal import Journal
+
+JOURNAL_PATH = os.path.join("/", "journal", "journal.db")
+
+
+def test_journal():
+    """Ensures completed steps, pages and page analyses are recorded, persisted and reset."""
+    ref_id = random_string()
+    identifier = random_string()
+    journal = Journal(JOURNAL_PATH)
+    assert journal.completed_steps(ref_id) == set()
+    journal.complete_page(ref_id, identifier, "001")
+    journal.complete_page(ref_id, identifier, "002")
+    journal.complete_step(ref_id, identifier, "jp2")
+    journal.complete_step(ref_id, identifier, "jp2")
+    reopened = Journal(JOURNAL_PATH)
+    assert reopened.completed_steps(ref_id) == {"jp2"}
+    assert reopened.completed_pages(ref_id) == {"001", "002"}
+    status = [obj for obj in reopened.status() if obj["ref_id"] == ref_id][0]
+    assert status["identifier"] == identifier
+    assert status["steps"] == ["jp2"]
+    assert status["pages"] == 2
+    journal.record_analysis(ref_id, {"001": {"blank": True}, "002": {"blank": False}})
+    assert reopened.page_analysis(ref_id) == {"001": {"blank": True}, "002": {"blank": False}}
+    reopened.reset(ref_id)
+    assert journal.completed_steps(ref_id) == set()
+    assert journal.completed_pages(ref_id) == set()
+    assert journal.page_analysis(ref_id) == {}
+
+
+def test_journal_throughput():
+    """Ensures throughput is summarized per host and stage from recent records."""
+    host = random_string()
+    journal = Journal(JOURNAL_PATH)
+    assert journal.throughput(host) == {}
+    journal.record_throughput(host, "images", 2, 1000, 4.0)
+    journal.record_throughput(host, "images", 3, 3000, 6.0)
+    journal.record_throughput(host, "upload", 3, 3000, 1.0)
+    journal.record_throughput(random_string(), "images", 1, 10, 100.0)
+    throughput = Journal(JOURNAL_PATH).throughput(host)
+    assert throughput == {
+        "images": {"objects": 2, "pages": 5, "pixels": 4000, "seconds": 10.0},
+        "upload": {"objects": 1, "pages": 3, "pixels": 3000, "seconds": 1.0}}
+    assert journal.throughput(host, limit=1)["images"]["pixels"] == 3000
+
+
+def test_journal_read_only():
+    """Ensures a read-only journal can be read but not created or changed."""
+    host = random_string()
+    with pytest.raises(sqlite3.OperationalError):
+        Journal(os.path.join(os.path.dirname(JOURNAL_PATH), "missing.db"), read_only=True)
+    assert not os.path.exists(os.path.join(os.path.dirname(JOURNAL_PATH), "missing.db"))
+    Journal(JOURNAL_PATH).record_throughput(host, "images", 2, 1000, 4.0)
+    journal = Journal(JOURNAL_PATH, read_only=True)
+    assert journal.throughput(host)["images"]["pixels"] == 1000
+    with pytest.raises(sqlite3.OperationalError):
+        journal.complete_step(random_string(), random_string(), "jp2")
+
+
+def teardown():
+    os.remove(JOURNAL_PATH)
+    os.rmdir(os.path.dirname(JOURNAL_PATH))
@@ -1,20 +1,25 @@
+import json
 import os
 import random
 import shutil
-from unittest.mock import patch
+import socket
+from concurrent.futures import Future
+from unittest.mock import Mock, patch
 
 from helpers import archivesspace_vcr, copy_sample_files, random_string
+from iiif_pipeline.journal import Journal
 from iiif_pipeline.pipeline import IIIFPipeline
 
 SOURCE_DIR = os.path.join("/", "source")
 TARGET_DIR = os.path.join("/", "target")
+STATE_DIR = os.path.join("/", "pipeline_state")
 FIXTURES_FILEPATH = os.path.join("fixtures", "tif")
 UUIDS = [random_string() for x in range(random.randint(2, 3))]
 PAGE_COUNT = random.randint(1, 5)
 
 
 def setup():
-    for d in [SOURCE_DIR, TARGET_DIR]:
+    for d in [SOURCE_DIR, TARGET_DIR, STATE_DIR]:
         if os.path.isdir(d):
             shutil.rmtree(d)
     shutil.copytree(FIXTURES_FILEPATH, SOURCE_DIR)
@@ -22,8 +27,169 @@ def setup():
 
 
 @patch("iiif_pipeline.clients.ArchivesSpaceClient.get_object")
+@patch("iiif_pipeline.pipeline.create_jp2")
+def test_pipeline_lookup_failure(mock_create_jp2, mock_get_object, caplog):
+    """Ensures failed ArchivesSpace lookups are reported before derivatives are created."""
+    mock_get_object.side_effect = Exception("Could not find an ArchivesSpace object")
+    with archivesspace_vcr.use_cassette("get_ao.json"):
+        _pipeline("lookup_failure").run(SOURCE_DIR, TARGET_DIR, False, False, False)
+        warnings = [r for r in caplog.records if r.levelname == "WARNING"]
+        errors = [r for r in caplog.records if r.levelname == "ERROR"]
+        assert len(warnings) == len(UUIDS)
+        assert len(errors) == len(UUIDS)
+        assert not mock_create_jp2.called
+
+
+def test_get_metadata_not_prefetched():
+    """Ensures objects whose lookup the prefetch has not started look it up themselves."""
+    pipeline = _pipeline("not_prefetched")
+    pipeline.source_dir = SOURCE_DIR
+    pipeline.as_client = Mock()
+    pipeline.as_client.get_object.return_value = {"title": random_string(), "dates": "1945-1950", "uri": "uri"}
+    pipeline.aws_client = Mock()
+    pipeline.replace, pipeline.restart, pipeline.resume, pipeline.journal = True, False, False, None
+    pending, prefetched = Future(), Future()
+    prefetched.set_result({"title": random_string(), "dates": "1945-1950", "uri": "prefetched"})
+    pipeline.lookups = {UUIDS[0]: pending, UUIDS[1]: prefetched}
+    jobs = [{"directory": os.path.join(SOURCE_DIR, ref_id), "ref_id": ref_id} for ref_id in UUIDS[:2]]
+    for job in jobs:
+        pipeline.get_metadata(job)
+    pipeline.as_client.get_object.assert_called_once_with(UUIDS[0])
+    assert pending.cancelled()
+    assert [job["obj_data"]["uri"] for job in jobs] == ["uri", "prefetched"]
+
+
+@patch("iiif_pipeline.clients.ArchivesSpaceClient.get_object")
+@patch("iiif_pipeline.clients.AWSClient.existing_objects")
+@patch("iiif_pipeline.clients.AWSClient.upload_files")
+def test_pipeline_resume(mock_aws_client, mock_existing_objects, mock_get_object):
+    """Ensures a resumed run continues from the step which failed.
+
+    Derivatives of objects which fail while resuming are kept, and steps
+    completed in an earlier run are not run again.
+    """
+    mock_get_object.side_effect = lambda ref_id: {
+        "title": random_string(), "dates": "1945-1950", "uri": ref_id}
+    mock_existing_objects.return_value = []
+    mock_aws_client.side_effect = Exception()
+    with archivesspace_vcr.use_cassette("get_ao.json"):
+        _pipeline("resume").run(SOURCE_DIR, TARGET_DIR, False, False, False, resume=True)
+        assert len(os.listdir(os.path.join(TARGET_DIR, "images"))) == len(UUIDS) * PAGE_COUNT
+        assert len(os.listdir(os.path.join(TARGET_DIR, "manifests"))) == len(UUIDS)
+    mock_aws_client.side_effect = None
+    mock_aws_client.return_value = {
+        "files": PAGE_COUNT, "bytes": 0, "seconds": 0, "bytes_per_second": 0}
+    with archivesspace_vcr.use_cassette("get_ao.json"), \
+            patch("iiif_pipeline.pipeline.create_jp2") as mock_create_jp2, \
+            patch("iiif_pipeline.pipeline.create_access_pdf") as mock_create_pdf:
+        _pipeline("resume").run(SOURCE_DIR, TARGET_DIR, False, False, False, resume=True)
+        assert not mock_create_jp2.called
+        assert not mock_create_pdf.called
+        for subpath in ["images", "pdfs", "manifests"]:
+            assert len(os.listdir(os.path.join(TARGET_DIR, subpath))) == 0
+
+
+@patch("iiif_pipeline.clients.ArchivesSpaceClient.get_object")
+@patch("iiif_pipeline.clients.AWSClient.existing_objects")
+@patch("iiif_pipeline.clients.AWSClient.upload_files")
+def test_pipeline_resume_analysis(mock_aws_client, mock_existing_objects, mock_get_object):
+    """Ensures page analyses from an earlier run are used to find blank pages when resuming."""
+    mock_get_object.side_effect = lambda ref_id: {
+        "title": random_string(), "dates": "1945-1950", "uri": ref_id}
+    mock_existing_objects.return_value = []
+    mock_aws_client.return_value = {
+        "files": PAGE_COUNT, "bytes": 0, "seconds": 0, "bytes_per_second": 0}
+    with archivesspace_vcr.use_cassette("get_ao.json"), \
+            patch("iiif_pipeline.pipeline.create_access_pdf") as mock_create_pdf:
+        mock_create_pdf.side_effect = Exception()
+        pipeline = _pipeline("resume_analysis")
+        pipeline.run(SOURCE_DIR, TARGET_DIR, False, False, False, resume=True)
+    analyses = {ref_id: pipeline.journal.page_analysis(ref_id) for ref_id in UUIDS}
+    assert all(len(analysis) == PAGE_COUNT for analysis in analyses.values())
+    with archivesspace_vcr.use_cassette("get_ao.json"), \
+            patch("iiif_pipeline.pipeline.analyze_pages") as mock_analyze_pages, \
+            patch("iiif_pipeline.pipeline.create_access_pdf") as mock_create_pdf:
+        mock_analyze_pages.return_value = []
+        pipeline = _pipeline("resume_analysis")
+        pipeline.run(SOURCE_DIR, TARGET_DIR, False, False, False, resume=True)
+        assert all(call[0][0] == [] for call in mock_analyze_pages.call_args_list)
+        assert sorted(call[1]["blank_pages"] for call in mock_create_pdf.call_args_list) == sorted(
+            set(page for page, analysis in analyses[ref_id].items() if analysis["blank"]) for ref_id in UUIDS)
+
+
+@patch("iiif_pipeline.clients.ArchivesSpaceClient.get_object")
+@patch("iiif_pipeline.clients.AWSClient.existing_objects")
 @patch("iiif_pipeline.clients.AWSClient.upload_files")
-def test_pipeline(mock_aws_client, mock_get_object):
+def test_pipeline_failure_resume(mock_aws_client, mock_existing_objects, mock_get_object, caplog):
+    """Ensures derivatives and progress of objects which fail without flags are kept for resuming.
+
+    A rerun without flags refuses to start the unfinished objects again.
+    """
+    mock_get_object.side_effect = lambda ref_id: {
+        "title": random_string(), "dates": "1945-1950", "uri": ref_id}
+    mock_existing_objects.return_value = []
+    mock_aws_client.return_value = {
+        "files": PAGE_COUNT, "bytes": 0, "seconds": 0, "bytes_per_second": 0}
+    with archivesspace_vcr.use_cassette("get_ao.json"), \
+            patch("iiif_pipeline.pipeline.create_access_pdf") as mock_create_pdf:
+        mock_create_pdf.side_effect = Exception()
+        _pipeline("failure_resume").run(SOURCE_DIR, TARGET_DIR, False, False, False)
+        assert len(os.listdir(os.path.join(TARGET_DIR, "images"))) == len(UUIDS) * PAGE_COUNT
+        assert len(os.listdir(os.path.join(TARGET_DIR, "manifests"))) == len(UUIDS)
+        caplog.clear()
+        _pipeline("failure_resume").run(SOURCE_DIR, TARGET_DIR, False, False, False)
+        errors = [r.getMessage() for r in caplog.records if r.levelname == "ERROR"]
+        assert len(errors) == len(UUIDS)
+        assert all("use --resume to continue it" in error for error in errors)
+    with archivesspace_vcr.use_cassette("get_ao.json"), \
+            patch("iiif_pipeline.pipeline.create_jp2") as mock_create_jp2, \
+            patch("iiif_pipeline.pipeline.create_access_pdf") as mock_create_pdf:
+        _pipeline("failure_resume").run(SOURCE_DIR, TARGET_DIR, False, False, False, resume=True)
+        assert not mock_create_jp2.called
+        assert mock_create_pdf.call_count == len(UUIDS)
+        for subpath in ["images", "pdfs", "manifests"]:
+            assert len(os.listdir(os.path.join(TARGET_DIR, subpath))) == 0
+
+
+@patch("iiif_pipeline.clients.ArchivesSpaceClient.get_object")
+@patch("iiif_pipeline.clients.AWSClient.existing_objects")
+def test_pipeline_plan(mock_existing_objects, mock_get_object, capsys):
+    """Ensures a batch is planned without creating derivatives, a journal or a cache.
+
+    An existing journal is read, but not changed.
+    """
+    mock_get_object.side_effect = lambda ref_id: {
+        "title": random_string(), "dates": "1945-1950", "uri": ref_id}
+    mock_existing_objects.return_value = ["pdfs/existing"]
+    before = list(os.walk(TARGET_DIR))
+    with archivesspace_vcr.use_cassette("get_ao.json"):
+        _pipeline("plan").plan(SOURCE_DIR, TARGET_DIR, False)
+    rows = [line.split("\t") for line in capsys.readouterr().out.splitlines()]
+    objects = [row for row in rows if row[0] in UUIDS]
+    assert len(objects) == len(UUIDS)
+    assert all(int(row[2]) == PAGE_COUNT and row[-1] == "pdfs/existing" for row in objects)
+    assert rows[-2][1] == "{} objects".format(len(UUIDS))
+    assert rows[-1][0].startswith("Estimated elapsed time")
+    assert mock_get_object.call_count == len(UUIDS)
+    assert list(os.walk(TARGET_DIR)) == before
+    assert not os.path.exists(os.path.join(STATE_DIR, "plan"))
+    journal_path = os.path.join(STATE_DIR, "plan", "journal.db")
+    Journal(journal_path).record_throughput(socket.gethostname(), "images", 1, 1000000, 1.0)
+    with open(journal_path, "rb") as f:
+        journal = f.read()
+    with archivesspace_vcr.use_cassette("get_ao.json"):
+        _pipeline("plan").plan(SOURCE_DIR, TARGET_DIR, False)
+    rows = [line.split("\t") for line in capsys.readouterr().out.splitlines()]
+    assert all(row[7] != "?" for row in rows if row[0] in UUIDS)
+    assert os.listdir(os.path.join(STATE_DIR, "plan")) == ["journal.db"]
+    with open(journal_path, "rb") as f:
+        assert f.read() == journal
+
+
+@patch("iiif_pipeline.clients.ArchivesSpaceClient.get_object")
+@patch("iiif_pipeline.clients.AWSClient.existing_objects")
+@patch("iiif_pipeline.clients.AWSClient.upload_files")
+def test_pipeline(mock_aws_client, mock_existing_objects, mock_get_object):
     """Ensures that target directories are empty after successful run.
 
     Mock.side_effect is used so that the random_string returned in the URI is
@@ -33,29 +199,57 @@ def test_pipeline(mock_aws_client, mock_get_object):
         {"title": random_string(), "dates": "1945-1950", "uri": random_string()},
         {"title": random_string(), "dates": "1950-1951", "uri": random_string()},
         {"title": random_string(), "dates": "1945-1973", "uri": random_string()}]
+    mock_existing_objects.return_value = []
+    mock_aws_client.return_value = {
+        "files": PAGE_COUNT, "bytes": 0, "seconds": 0, "bytes_per_second": 0}
     with archivesspace_vcr.use_cassette("get_ao.json"):
-        IIIFPipeline().run(SOURCE_DIR, TARGET_DIR, False, False, True)
+        _pipeline("pipeline").run(SOURCE_DIR, TARGET_DIR, False, False, True,
+                           metrics_dir=os.path.join(TARGET_DIR, "metrics"),
+                           trace_path=os.path.join(TARGET_DIR, "trace.json"),
+                           profile_dir=os.path.join(TARGET_DIR, "profiles"))
         for subpath in ["images", "pdfs", "manifests"]:
             assert os.path.isdir(os.path.join(TARGET_DIR, subpath))
             assert len(os.listdir(os.path.join(TARGET_DIR, subpath))) == 0
+        summaries = [f for f in os.listdir(os.path.join(TARGET_DIR, "metrics")) if f.endswith(".json")]
+        with open(os.path.join(TARGET_DIR, "metrics", summaries[0])) as f:
+            spans = {s["span"] for s in json.load(f)["spans"]}
+        assert {"stage", "encode_page", "manifest", "pdf_assemble"} <= spans
+        assert os.path.isfile(os.path.join(TARGET_DIR, "metrics", "iiif_pipeline.prom"))
+        with open(os.path.join(TARGET_DIR, "trace.json")) as f:
+            events = json.load(f)["traceEvents"]
+        objects = [e for e in events if e.get("cat") == "object" and e["ph"] == "e"]
+        assert len(objects) == len(UUIDS)
+        assert all(e["args"]["identifier"] != "None" for e in objects)
+        pages = [e for e in events if e.get("cat") == "encode_page"]
+        assert len(pages) == len(UUIDS) * PAGE_COUNT
+        assert all(e["args"]["ref_id"] in UUIDS for e in pages)
+        with open(os.path.join(TARGET_DIR, "profiles", "stage_images.txt")) as f:
+            assert "create_manifest" in f.read()
+        assert len([f for f in os.listdir(os.path.join(TARGET_DIR, "profiles"))
+                    if f.startswith("object_") and f.endswith(".txt")]) == len(UUIDS)
         assert len(os.listdir(os.path.join(SOURCE_DIR))) == 0
 
 
 @patch("iiif_pipeline.clients.ArchivesSpaceClient.get_object")
+@patch("iiif_pipeline.clients.AWSClient.existing_objects")
 @patch("iiif_pipeline.clients.AWSClient.upload_files")
-def test_pipeline_exception(mock_aws_client, mock_get_object, caplog):
+def test_pipeline_exception(mock_aws_client, mock_existing_objects,
+                            mock_get_object, caplog):
     """Ensures that the pipeline handles exceptions.
 
-    Target directories are expected to be empty, and the exception should be
-    caught and logged.
+    Without a journal, target directories are expected to be empty, and the
+    exception should be caught and logged.
     """
     mock_get_object.return_value = {
         "title": random_string(),
         "dates": "1945-1950",
         "uri": random_string()}
+    mock_existing_objects.return_value = []
     mock_aws_client.side_effect = Exception()
     with archivesspace_vcr.use_cassette("get_ao.json"):
-        IIIFPipeline().run(SOURCE_DIR, TARGET_DIR, False, False, False)
+        pipeline = _pipeline("exception")
+        pipeline.config.remove_option("Pipeline", "journal")
+        pipeline.run(SOURCE_DIR, TARGET_DIR, False, False, False)
         log_records = [r for r in caplog.records if r.levelname == "ERROR"]
         assert len(log_records) == len(UUIDS)
         for subpath in ["images", "pdfs", "manifests"]:
@@ -63,6 +257,15 @@ def test_pipeline_exception(mock_aws_client, mock_get_object, caplog):
             assert len(os.listdir(os.path.join(TARGET_DIR, subpath))) == 0
 
 
+def _pipeline(name):
+    """Creates a pipeline whose journal and cache are kept in a directory for one test."""
+    pipeline = IIIFPipeline()
+    pipeline.config.set("Pipeline", "journal", os.path.join(STATE_DIR, name, "journal.db"))
+    pipeline.config.set("Cache", "directory", os.path.join(STATE_DIR, name, "cache"))
+    return pipeline
+
+
 def teardown():
-    for d in [SOURCE_DIR, TARGET_DIR]:
-        shutil.rmtree(d)
+    for d in [SOURCE_DIR, TARGET_DIR, STATE_DIR]:
+        if os.path.isdir(d):
+            shutil.rmtree(d)
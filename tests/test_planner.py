@@ -0,0 +1,73 @@
+import os
+import shutil
+from unittest.mock import Mock
+
+from helpers import write_tiff
+from iiif_pipeline.planner import (estimate_batch, estimate_seconds,
+                                   find_conflicts, plan_object)
+
+PLANNER_DIR = os.path.join("/", "planner")
+OBJECT_DIR = os.path.join(PLANNER_DIR, "object")
+DERIVATIVE_DIR = os.path.join(PLANNER_DIR, "images")
+
+
+def setup():
+    """Creates an object with pages of different sizes."""
+    if os.path.isdir(PLANNER_DIR):
+        shutil.rmtree(PLANNER_DIR)
+    os.makedirs(os.path.join(OBJECT_DIR, "master"))
+    os.makedirs(DERIVATIVE_DIR)
+    for page, (height, width) in enumerate([(400, 300), (1000, 800)]):
+        write_tiff(os.path.join(OBJECT_DIR, "master", "object_{:03d}.tif".format(page + 1)), height, width, 3)
+
+
+def test_plan_object():
+    """Ensures objects are planned from the headers of their master files."""
+    plan = plan_object(OBJECT_DIR, workers=2)
+    assert plan["objects"] == 1
+    assert plan["pages"] == 2
+    assert plan["pixels"] == 400 * 300 + 1000 * 800
+    assert plan["layers"] == (4, 5)
+    assert plan["output_bytes"] == int(400 * 300 * 3 / 1.5) + int(1000 * 800 * 3 / 1.5)
+    assert plan_object(OBJECT_DIR, skip=True)["pages"] == 1
+
+
+def test_estimate_seconds():
+    """Ensures stage times are estimated from recorded throughput."""
+    plan = {"objects": 1, "pixels": 2000000}
+    rates = {"metadata": {"objects": 4, "pixels": 1, "seconds": 2.0},
+             "images": {"objects": 2, "pixels": 1000000, "seconds": 10.0},
+             "pdfs": {"objects": 2, "pixels": 0, "seconds": 10.0}}
+    assert estimate_seconds(plan, rates) == {
+        "metadata": 0.5, "images": 20.0, "pdfs": None, "upload": None}
+
+
+def test_estimate_batch():
+    """Ensures a batch takes as long as its busiest stage."""
+    seconds = {"metadata": 1.0, "images": 60.0, "pdfs": 30.0, "upload": 10.0}
+    plans = [{"objects": 1, "pages": 2, "pixels": 100, "bytes": 10, "output_bytes": 5, "seconds": seconds}
+             for _ in range(4)]
+    totals = estimate_batch(plans, {"metadata": 1, "images": 4, "pdfs": 1, "upload": 1})
+    assert totals["pages"] == 8
+    assert totals["seconds"]["images"] == 240.0
+    assert totals["elapsed"] == 120.0
+    plans[0]["seconds"] = dict(seconds, upload=None)
+    totals = estimate_batch(plans, {})
+    assert totals["seconds"]["upload"] is None
+    assert totals["elapsed"] is None
+
+
+def test_find_conflicts():
+    """Ensures existing local derivatives and keys in the bucket are reported."""
+    derivative = os.path.join(DERIVATIVE_DIR, "identifier_001.jp2")
+    open(derivative, "w").close()
+    aws_client = Mock()
+    aws_client.existing_objects.return_value = ["pdfs/identifier"]
+    assert find_conflicts("identifier", [DERIVATIVE_DIR, os.path.join(PLANNER_DIR, "pdfs")]) == [derivative]
+    assert find_conflicts("identifier", [DERIVATIVE_DIR], aws_client) == [derivative, "pdfs/identifier"]
+    assert find_conflicts("other", [DERIVATIVE_DIR]) == []
+
+
+def teardown():
+    """Removes generated files."""
+    shutil.rmtree(PLANNER_DIR)
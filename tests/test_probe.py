@@ -0,0 +1,79 @@
+import os
+import shutil
+
+import pytest
+from iiif_pipeline.derivatives import calculate_layers
+from iiif_pipeline.probe import probe_files, probe_jp2, probe_tiff
+from PIL import Image
+
+PROBE_DIR = os.path.join("/", "probe")
+SIZES = [(600, 400), (301, 1201), (97, 97)]
+
+
+def setup():
+    """Creates images of different sizes, modes and compression."""
+    if os.path.isdir(PROBE_DIR):
+        shutil.rmtree(PROBE_DIR)
+    os.makedirs(PROBE_DIR)
+    for idx, size in enumerate(SIZES):
+        Image.new("RGB", size).save(os.path.join(PROBE_DIR, "rgb_{}.tif".format(idx)))
+        Image.new("L", size).save(
+            os.path.join(PROBE_DIR, "gray_{}.tif".format(idx)), compression="tiff_lzw")
+        Image.new("RGB", size).save(
+            os.path.join(PROBE_DIR, "rgb_{}.jp2".format(idx)),
+            num_resolutions=4, progression="RPCL", codeblock_size=(32, 32))
+        Image.new("L", size).save(
+            os.path.join(PROBE_DIR, "gray_{}.j2k".format(idx)), num_resolutions=3)
+    with open(os.path.join(PROBE_DIR, "invalid.tif"), "w") as f:
+        f.write("not a tiff")
+
+
+def test_probe_tiff():
+    """Ensures TIFF dimensions and layout are read from the header."""
+    for idx, (width, height) in enumerate(SIZES):
+        rgb = probe_tiff(os.path.join(PROBE_DIR, "rgb_{}.tif".format(idx)))
+        assert (rgb["width"], rgb["height"]) == (width, height)
+        assert rgb["samples_per_pixel"] == 3
+        assert rgb["bits_per_sample"] == (8, 8, 8)
+        assert rgb["compression"] == 1
+        assert len(rgb["strip_offsets"]) == len(rgb["strip_byte_counts"])
+        gray = probe_tiff(os.path.join(PROBE_DIR, "gray_{}.tif".format(idx)))
+        assert (gray["width"], gray["height"]) == (width, height)
+        assert gray["samples_per_pixel"] == 1
+        assert gray["compression"] == 5
+    with pytest.raises(ValueError, match="invalid.tif"):
+        probe_tiff(os.path.join(PROBE_DIR, "invalid.tif"))
+
+
+def test_probe_jp2():
+    """Ensures JPEG2000 dimensions and coding parameters are read from the headers."""
+    for idx, (width, height) in enumerate(SIZES):
+        jp2 = probe_jp2(os.path.join(PROBE_DIR, "rgb_{}.jp2".format(idx)))
+        assert (jp2["width"], jp2["height"]) == (width, height)
+        assert jp2["components"] == 3
+        assert jp2["levels"] == 3
+        assert jp2["progression"] == "RPCL"
+        assert jp2["code_block"] == (32, 32)
+        j2k = probe_jp2(os.path.join(PROBE_DIR, "gray_{}.j2k".format(idx)))
+        assert (j2k["width"], j2k["height"]) == (width, height)
+        assert j2k["components"] == 1
+        assert j2k["levels"] == 2
+    with pytest.raises(ValueError):
+        probe_jp2(os.path.join(PROBE_DIR, "invalid.tif"))
+
+
+def test_probe_files():
+    """Ensures files probed concurrently are returned in order."""
+    files = [os.path.join(PROBE_DIR, "rgb_{}.tif".format(idx)) for idx in range(len(SIZES))]
+    info = probe_files(files, probe_tiff, workers=3)
+    assert [(i["width"], i["height"]) for i in info] == SIZES
+
+
+def test_calculate_layers():
+    """Ensures layers are calculated from TIFF headers."""
+    for idx, layers in enumerate([4, 5, 2]):
+        assert calculate_layers(os.path.join(PROBE_DIR, "rgb_{}.tif".format(idx))) == layers
+
+
+def teardown():
+    shutil.rmtree(PROBE_DIR)
@@ -0,0 +1,157 @@
+import os
+import shutil
+import threading
+import time
+
+from helpers import write_tiff
+from iiif_pipeline.derivatives import create_jp2
+from iiif_pipeline.scheduling import (JP2_MEMORY_FACTOR, MemoryBudget,
+                                      estimate_makespan, estimate_memory,
+                                      measure_object, plan_jobs)
+
+SCHEDULING_DIR = os.path.join("/", "scheduling")
+
+
+def setup():
+    """Creates pages of different sizes."""
+    if os.path.isdir(SCHEDULING_DIR):
+        shutil.rmtree(SCHEDULING_DIR)
+    os.makedirs(os.path.join(SCHEDULING_DIR, "derivatives"))
+    for page, (height, width) in enumerate([(1200, 900), (300, 200), (300, 200), (300, 200)]):
+        write_tiff(os.path.join(SCHEDULING_DIR, "sample_{:03d}.tif".format(page)), height, width, 3)
+    for ref_id, sizes in [("small", [(100, 100)]), ("large", [(400, 300), (400, 300)]),
+                          ("medium", [(300, 200), (200, 200), (100, 100)])]:
+        master_dir = os.path.join(SCHEDULING_DIR, "objects", ref_id, "master")
+        os.makedirs(master_dir)
+        for page, (height, width) in enumerate(sizes):
+            write_tiff(os.path.join(master_dir, "{}_{:03d}.tif".format(ref_id, page + 1)), height, width)
+    os.makedirs(os.path.join(SCHEDULING_DIR, "objects", "empty"))
+
+
+def test_estimate_memory():
+    """Ensures memory is estimated from dimensions, samples and bit depth."""
+    assert estimate_memory(1000, 2000) == 2000000
+    assert estimate_memory(1000, 2000, 3, 16) == 12000000
+    assert estimate_memory(1000, 2000, 1, 8, 2.5) == 5000000
+
+
+def test_memory_budget():
+    """Ensures work waits until it fits in the budget, and oversized work runs alone."""
+    budget = MemoryBudget(100)
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def work(amount):
+        with budget.reserve(amount):
+            with lock:
+                running.append(amount)
+                peak.append(sum(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(amount)
+
+    threads = [threading.Thread(target=work, args=(amount,)) for amount in [60, 30, 50, 150, 10, 10]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert budget.reserved == 0
+    assert budget.waits > 0
+    assert budget.peak == max(peak)
+    assert all(total <= 100 for total in peak if total != 150)
+    assert 150 in peak
+
+
+def test_memory_budget_order():
+    """Ensures work which does not fit is not overtaken by later work which does."""
+    budget = MemoryBudget(100)
+    admitted = []
+
+    def work(name, amount):
+        budget.acquire(amount)
+        admitted.append(name)
+
+    budget.acquire(60)
+    for name, amount in [("large", 100), ("small", 10)]:
+        waits = budget.waits
+        threading.Thread(target=work, args=(name, amount), daemon=True).start()
+        _wait_until(lambda: budget.waits > waits or admitted)
+    assert admitted == []
+    budget.release(60)
+    _wait_until(lambda: admitted)
+    time.sleep(0.05)
+    assert admitted == ["large"]
+    budget.release(100)
+    _wait_until(lambda: len(admitted) == 2)
+    assert admitted == ["large", "small"]
+    assert budget.reserved == 10
+
+
+def test_memory_budget_unlimited():
+    """Ensures work is never held back without a limit."""
+    budget = MemoryBudget()
+    budget.acquire(10 ** 12)
+    budget.acquire(10 ** 12)
+    assert budget.waits == 0
+    assert budget.peak == 2 * 10 ** 12
+
+
+def test_create_jp2_budget():
+    """Ensures JP2 encoding reserves each page's estimated memory.
+
+    The first page needs more than the whole budget, so it must run alone.
+    """
+    files = sorted(os.path.join(SCHEDULING_DIR, f) for f in os.listdir(SCHEDULING_DIR) if f.endswith(".tif"))
+    small = estimate_memory(200, 300, 3, 8, JP2_MEMORY_FACTOR)
+    budget = MemoryBudget(small * 2)
+    pages = create_jp2(files, "sample", os.path.join(SCHEDULING_DIR, "derivatives"), workers=4, budget=budget)
+    assert [page["memory"] for page in pages] == [
+        estimate_memory(900, 1200, 3, 8, JP2_MEMORY_FACTOR), small, small, small]
+    assert budget.reserved == 0
+    assert budget.peak == pages[0]["memory"]
+
+
+def test_measure_object():
+    """Ensures objects are measured from the headers of their master files."""
+    volume = measure_object(os.path.join(SCHEDULING_DIR, "objects", "medium"))
+    assert volume["pages"] == 3
+    assert volume["pixels"] == 300 * 200 + 200 * 200 + 100 * 100
+    assert volume["bytes"] > volume["pixels"]
+    skipped = measure_object(os.path.join(SCHEDULING_DIR, "objects", "medium"), skip=True)
+    assert skipped["pages"] == 2
+    assert skipped["pixels"] == 200 * 200 + 100 * 100
+    assert measure_object(os.path.join(SCHEDULING_DIR, "objects", "empty")) == {
+        "pages": 0, "pixels": 0, "bytes": 0}
+
+
+def test_plan_jobs():
+    """Ensures the largest objects start first, after any priority objects."""
+    jobs = [{"directory": os.path.join(SCHEDULING_DIR, "objects", ref_id), "ref_id": ref_id}
+            for ref_id in ["empty", "small", "large", "medium"]]
+    planned = plan_jobs(jobs, workers=2)
+    assert [job["ref_id"] for job in planned] == ["large", "medium", "small", "empty"]
+    assert planned[0]["volume"]["pixels"] == 2 * 400 * 300
+    prioritized = plan_jobs(jobs, priority=["small", "empty"])
+    assert [job["ref_id"] for job in prioritized] == ["small", "empty", "large", "medium"]
+
+
+def test_estimate_makespan():
+    """Ensures the busiest worker is found when jobs start in order."""
+    jobs = [{"volume": {"pixels": pixels}} for pixels in [1, 1, 1, 1, 4]]
+    assert estimate_makespan(jobs, 2) == 6
+    assert estimate_makespan(sorted(jobs, key=lambda job: -job["volume"]["pixels"]), 2) == 4
+    assert estimate_makespan(jobs) == 8
+    assert estimate_makespan([], 4) == 0
+
+
+def _wait_until(condition, timeout=5):
+    """Waits for a condition set by another thread."""
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def teardown():
+    """Removes generated pages."""
+    shutil.rmtree(SCHEDULING_DIR)
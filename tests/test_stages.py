@@ -0,0 +1,66 @@
+import threading
+import time
+
+from iiif_pipeline.stages import Stage, run_stages
+
+
+def test_run_stages():
+    """Ensures every job passes through every stage, in order."""
+    processed = []
+    lock = threading.Lock()
+
+    def record(name):
+        def func(job):
+            with lock:
+                processed.append((job["id"], name))
+        return func
+
+    jobs = [{"id": i} for i in range(10)]
+    run_stages(
+        jobs,
+        [Stage("first", record("first"), workers=2),
+         Stage("second", record("second"), workers=3)],
+        lambda job, e: None)
+    assert len(processed) == 20
+    for job in jobs:
+        assert processed.index((job["id"], "first")) < processed.index(
+            (job["id"], "second"))
+
+
+def test_run_stages_overlap():
+    """Ensures different jobs are processed by different stages at the same time."""
+    active = set()
+    overlapped = []
+
+    def work(name):
+        def func(job):
+            active.add(name)
+            if len(active) > 1:
+                overlapped.append(job)
+            time.sleep(0.05)
+            active.discard(name)
+        return func
+
+    run_stages(
+        [{"id": i} for i in range(4)],
+        [Stage("first", work("first")), Stage("second", work("second"))],
+        lambda job, e: None)
+    assert overlapped
+
+
+def test_run_stages_error():
+    """Ensures failed jobs are reported and do not continue to later stages."""
+    errors = []
+    finished = []
+
+    def fail_odd(job):
+        if job["id"] % 2:
+            raise Exception("odd job")
+
+    run_stages(
+        [{"id": i} for i in range(6)],
+        [Stage("first", fail_odd, workers=2),
+         Stage("second", lambda job: finished.append(job["id"]))],
+        lambda job, e: errors.append((job["id"], str(e))))
+    assert sorted(finished) == [0, 2, 4]
+    assert sorted(errors) == [(1, "odd job"), (3, "odd job"), (5, "odd job")]